@@ -4,8 +4,8 @@ Cliente web para administrar el servidor FTP Dahua
 Aplicación Flask separada del servidor FTP
 """
 
-from flask import Flask, render_template, jsonify, request, redirect, url_for, session, flash
-from flask import send_from_directory
+from flask import Flask, render_template, jsonify, request, redirect, url_for, session, flash, g
+from flask import Response, stream_with_context
 from pathlib import PurePosixPath
 import os
 import json
@@ -13,19 +13,75 @@ import time
 from datetime import datetime, timedelta
 from pathlib import Path
 import psutil
-import ftplib
 from functools import wraps
 import subprocess
 import threading
+import urllib.request
+import argparse
+import signal
+import mimetypes
+import tarfile
+import tempfile
+from urllib.parse import quote
+from werkzeug.http import http_date, quote_etag
+from werkzeug.security import safe_join
+from catalog import VideoCatalog, DEFAULT_DB
+from credentials import CredentialStore, DEFAULT_FILE as DEFAULT_CREDENTIALS
+from metrics import Metrics, LATENCY_BUCKETS, CONTENT_TYPE as METRICS_CONTENT_TYPE
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this'  # Cambiar en producción
 
 # Configuración
-FTP_HOST = 'localhost'
-FTP_PORT = 60000
+# Mismo archivo de usuarios que el servidor FTP (--credentials-file)
+CREDENTIALS_FILE = os.environ.get('CREDENTIALS_FILE', DEFAULT_CREDENTIALS)
 VIDEO_DIR = Path('dahua_videos')
+# Tier frío del servidor (--cold-dir): los días viejos se sirven desde ahí
+COLD_VIDEO_DIR = Path(os.environ['COLD_VIDEO_DIR']) if os.environ.get('COLD_VIDEO_DIR') else None
 LOG_DIR = Path('logs')
+CATALOG_DB = Path(DEFAULT_DB)
+# Endpoint de salud del servidor FTP (--health-host/--health-port)
+HEALTH_URL = os.environ.get('HEALTH_URL', 'http://127.0.0.1:8021/health')
+HEALTH_TTL = 5  # segundos que se reutiliza el último sondeo
+
+# Verificación de actualizaciones git en segundo plano
+GIT_CHECK_INTERVAL = int(os.environ.get('GIT_CHECK_INTERVAL', 3600))  # segundos; 0 desactiva
+GIT_CHECK_TIMEOUT = int(os.environ.get('GIT_CHECK_TIMEOUT', 30))
+GIT_STATE_POLL = 60  # cada cuánto los workers releen el estado compartido
+REPO_DIR = Path(__file__).resolve().parent
+# Estado compartido entre procesos worker: un solo git fetch por intervalo.
+# Es estado de ejecución: va a un directorio temporal, no al árbol del repositorio
+UPDATE_STATE_DIR = Path(os.environ.get('UPDATE_STATE_DIR') or Path(tempfile.gettempdir()) / 'dahua_web_update')
+UPDATE_STATE_FILE = UPDATE_STATE_DIR / 'update_state.json'
+UPDATE_LOCK_FILE = UPDATE_STATE_DIR / 'update_state.lock'
+
+# Descargas: 'direct' (la app envía el archivo), 'x-sendfile' (Apache/lighttpd) o 'x-accel' (nginx)
+DOWNLOAD_MODE = os.environ.get('DOWNLOAD_MODE', 'direct')
+DOWNLOAD_ACCEL_PREFIX = os.environ.get('DOWNLOAD_ACCEL_PREFIX', '/protected-videos/')
+DOWNLOAD_ACCEL_COLD_PREFIX = os.environ.get('DOWNLOAD_ACCEL_COLD_PREFIX', '/protected-videos-cold/')
+DOWNLOAD_CHUNK = 1024 * 1024
+EXPORT_MAX_FILES = 100000  # archivos por exportación: la lista se arma antes de enviar
+
+# Métricas: cada proceso worker deja su snapshot en un archivo y /metrics los suma.
+# Es estado de ejecución: va a un directorio temporal, no al árbol del repositorio
+METRICS_DIR = Path(os.environ.get('METRICS_DIR') or Path(tempfile.gettempdir()) / 'dahua_web_metrics')
+METRICS_FLUSH = 1.0  # segundos mínimos entre escrituras del snapshot
+
+_health_cache = {'checked': 0, 'data': None}
+_health_lock = threading.Lock()
+
+catalog = VideoCatalog(CATALOG_DB, readonly=True)
+credentials = CredentialStore(CREDENTIALS_FILE)
+
+web_metrics = Metrics()
+web_metrics.describe('dahua_web_requests_total', 'counter', 'Peticiones HTTP por endpoint, método y estado')
+web_metrics.describe('dahua_web_request_duration_seconds', 'histogram', 'Tiempo hasta armar la respuesta, por endpoint', LATENCY_BUCKETS)
+web_metrics.describe('dahua_web_download_bytes_total', 'counter', 'Bytes de video enviados por /download')
+web_metrics.describe('dahua_web_videos', 'gauge', 'Videos en el catálogo')
+web_metrics.describe('dahua_web_videos_bytes', 'gauge', 'Bytes de video en el catálogo')
+web_metrics.describe('dahua_web_disk_free_bytes', 'gauge', 'Espacio libre en el disco de videos')
+web_metrics.describe('dahua_web_ftp_up', 'gauge', '1 si el endpoint de salud del servidor FTP responde ok')
+_metrics_flushed = {'at': 0}
 
 def login_required(f):
     """Decorador para requerir login"""
@@ -33,9 +89,81 @@ def login_required(f):
     def decorated_function(*args, **kwargs):
         if 'logged_in' not in session:
             return redirect(url_for('login'))
+        # Sesiones anteriores guardaban la contraseña FTP en la cookie
+        session.pop('ftp_pass', None)
         return f(*args, **kwargs)
     return decorated_function
 
+def get_server_health():
+    """Consulta el endpoint de salud del servidor FTP (cacheado HEALTH_TTL segundos)"""
+    with _health_lock:
+        if time.time() - _health_cache['checked'] < HEALTH_TTL:
+            return _health_cache['data']
+        try:
+            with urllib.request.urlopen(HEALTH_URL, timeout=2) as response:
+                data = json.loads(response.read().decode('utf-8'))
+        except Exception:
+            data = None
+        _health_cache['checked'] = time.time()
+        _health_cache['data'] = data
+        return data
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    endpoint = request.url_rule.rule if request.url_rule else 'other'
+    web_metrics.inc('dahua_web_requests_total', endpoint=endpoint, method=request.method, status=str(response.status_code))
+    web_metrics.observe('dahua_web_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+    if request.endpoint == 'download_video' and response.content_length and 'X-Accel-Redirect' not in response.headers \
+            and 'X-Sendfile' not in response.headers:
+        web_metrics.inc('dahua_web_download_bytes_total', response.content_length)
+    if time.monotonic() - _metrics_flushed['at'] >= METRICS_FLUSH:
+        flush_web_metrics()
+    return response
+
+def flush_web_metrics():
+    """Escribe el snapshot de este proceso para que cualquier worker pueda exponerlo"""
+    _metrics_flushed['at'] = time.monotonic()
+    try:
+        METRICS_DIR.mkdir(parents=True, exist_ok=True)
+        target = METRICS_DIR / f'web-{os.getpid()}.json'
+        tmp = target.with_suffix('.tmp')
+        tmp.write_text(json.dumps(web_metrics.snapshot()))
+        os.replace(tmp, target)
+    except OSError:
+        pass
+
+def collect_web_metrics():
+    """Suma los snapshots de los procesos vivos y borra los de procesos terminados"""
+    flush_web_metrics()
+    snapshots = []
+    for path in METRICS_DIR.glob('web-*.json'):
+        try:
+            pid = int(path.stem.split('-', 1)[1])
+        except ValueError:
+            continue
+        if pid != os.getpid() and not snapshot_alive(path, pid):
+            path.unlink(missing_ok=True)
+            continue
+        try:
+            snapshots.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue
+    return web_metrics.combine(snapshots)
+
+def snapshot_alive(path, pid):
+    """El proceso que escribió el snapshot sigue vivo (y no es otro con el mismo pid)"""
+    try:
+        return psutil.Process(pid).create_time() <= path.stat().st_mtime
+    except (psutil.Error, OSError):
+        return False
+
 def get_server_stats():
     """Obtiene estadísticas del servidor"""
     try:
@@ -46,33 +174,30 @@ def get_server_stats():
             'disk_usage': 0,
             'uptime': 0,
             'connections': 0,
-            'last_upload': 'N/A'
+            'last_upload': 'N/A',
+            'partial_uploads': 0
         }
         
-        # Verificar si el directorio de videos existe
-        if VIDEO_DIR.exists():
-            # Contar archivos de video
-            video_files = list(VIDEO_DIR.rglob("*.avi")) + list(VIDEO_DIR.rglob("*.mp4")) + list(VIDEO_DIR.rglob("*.dav"))
-            stats['video_count'] = len(video_files)
-            
-            # Calcular tamaño total
-            total_size = sum(f.stat().st_size for f in video_files if f.exists())
-            stats['total_size_gb'] = round(total_size / (1024**3), 2)
-            
-            # Último archivo subido
-            if video_files:
-                latest_file = max(video_files, key=lambda f: f.stat().st_mtime)
-                stats['last_upload'] = datetime.fromtimestamp(latest_file.stat().st_mtime).strftime('%Y-%m-%d %H:%M:%S')
+        # Totales mantenidos por el catálogo (sin recorrer el directorio)
+        if catalog.exists():
+            summary = catalog.stats_summary()
+            stats['video_count'] = summary['count']
+            stats['total_size_gb'] = round(summary['bytes'] / (1024**3), 2)
+            if summary['last_received']:
+                stats['last_upload'] = datetime.fromtimestamp(summary['last_received']).strftime('%Y-%m-%d %H:%M:%S')
+            stats['by_channel'] = summary['by_channel']
+            stats['by_day'] = summary['by_day']
+            stats['by_ext'] = summary['by_ext']
+            stats['by_camera'] = summary['by_camera']
+            stats['partial_uploads'] = summary['partials']['count']
         
-        # Verificar estado del servidor FTP
-        try:
-            ftp = ftplib.FTP()
-            ftp.connect(FTP_HOST, FTP_PORT, timeout=5)
-            ftp.login(session['ftp_user'], session['ftp_pass'])
+        # Estado del servidor FTP sin abrir sesiones FTP
+        health = get_server_health()
+        if health and health.get('status') in ('ok', 'degraded'):
             stats['status'] = 'online'
-            ftp.quit()
-        except:
-            stats['status'] = 'offline'
+            stats['uptime'] = health.get('uptime', 0)
+            stats['connections'] = health.get('connections', 0)
+            stats['loop_lag_ms'] = health.get('loop_lag_ms', 0)
         
         # Uso del disco
         if VIDEO_DIR.exists():
@@ -84,50 +209,138 @@ def get_server_stats():
         print(f"Error obteniendo estadísticas: {e}")
         return stats
 
+def decode_log_line(raw):
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw.decode('latin1')
+
+def tail_file(path, lines=100, block_size=64 * 1024):
+    """Lee las últimas líneas de un archivo buscando desde el final"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        # Una línea de más: la primera puede quedar cortada
+        while position > 0 and data.count(b'\n') <= lines:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+    raw_lines = data.splitlines(keepends=True)
+    if position > 0:
+        raw_lines = raw_lines[1:]
+    return [decode_log_line(line) for line in raw_lines[-lines:]]
+
 def get_recent_logs(lines=100):
     """Obtiene los logs recientes del servidor"""
     try:
         log_file = LOG_DIR / 'ftp_server.log'
         if log_file.exists():
-            try:
-                with open(log_file, 'r', encoding='utf-8') as f:
-                    all_lines = f.readlines()
-            except UnicodeDecodeError:
-                with open(log_file, 'r', encoding='latin1') as f:
-                    all_lines = f.readlines()
-            return all_lines[-lines:] if len(all_lines) > lines else all_lines
+            return tail_file(log_file, lines)
         return []
     except Exception as e:
         print(f"Error leyendo logs: {e}")
         return []
 
-def get_video_database():
-    """Lee la base de datos de videos o lista los archivos si no hay base"""
+def parse_log_line(line):
+    """Convierte una línea del log (JSON o texto) en un dict con sus campos"""
+    line = line.rstrip('\r\n')
+    if line.startswith('{'):
+        try:
+            entry = json.loads(line)
+            if isinstance(entry, dict):
+                return entry
+        except ValueError:
+            pass
+    entry = {'time': None, 'level': None, 'logger': None, 'event': None, 'ip': None, 'user': None, 'message': line}
+    # Formato texto: "fecha - logger - NIVEL - mensaje"
+    parts = line.split(' - ', 3)
+    if len(parts) == 4:
+        entry.update(time=parts[0], logger=parts[1], level=parts[2], message=parts[3])
+        # Mensajes de sesión de pyftpdlib: "ip:puerto-[usuario] ..."
+        head = parts[3].split(' ', 1)[0]
+        if '-[' in head:
+            entry['ip'] = head.split('-[', 1)[0].rsplit(':', 1)[0]
+    return entry
+
+def make_log_filter(level=None, ip=None, event=None):
+    """Devuelve una función que acepta o descarta líneas según nivel, IP y evento"""
+    if not (level or ip or event):
+        return None
+
+    def accept(line):
+        entry = parse_log_line(line)
+        if level and entry.get('level') != level:
+            return False
+        if ip and entry.get('ip') != ip:
+            return False
+        if event and entry.get('event') != event:
+            return False
+        return True
+    return accept
+
+def follow_log(log_file, poll_interval=1.0, keepalive=15.0, line_filter=None):
+    """Generador SSE que sigue el log (incluso tras rotación o truncado)"""
+    f = None
+    first_open = True
+    pending = b''
+    last_sent = time.time()
+    try:
+        while True:
+            if f is None:
+                try:
+                    f = open(log_file, 'rb')
+                    # Al conectarse solo interesan las líneas nuevas
+                    if first_open:
+                        f.seek(0, os.SEEK_END)
+                except FileNotFoundError:
+                    f = None
+                first_open = False
+            chunk = f.read() if f is not None else b''
+            if chunk:
+                pending += chunk
+                *complete, pending = pending.split(b'\n')
+                for raw in complete:
+                    line = decode_log_line(raw).rstrip()
+                    if line_filter is None or line_filter(line):
+                        yield f"data: {line}\n\n"
+                last_sent = time.time()
+                continue
+            # Sin datos nuevos: ¿el archivo fue rotado o truncado?
+            if f is not None:
+                try:
+                    st = os.stat(log_file)
+                    if st.st_ino != os.fstat(f.fileno()).st_ino or st.st_size < f.tell():
+                        f.close()
+                        f = open(log_file, 'rb')
+                        continue
+                except FileNotFoundError:
+                    pass
+            if time.time() - last_sent >= keepalive:
+                yield ": keepalive\n\n"
+                last_sent = time.time()
+            time.sleep(poll_interval)
+    finally:
+        if f is not None:
+            f.close()
+
+def get_video_database(limit=None):
+    """Consulta el catálogo de videos o lista los archivos si no hay catálogo"""
     try:
-        db_file = VIDEO_DIR / 'video_database.txt'
+        if catalog.exists():
+            return catalog.recent(limit) if limit else catalog.all_videos()
         videos = []
-        if db_file.exists() and db_file.stat().st_size > 0:
-            with open(db_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    parts = line.strip().split(',')
-                    if len(parts) >= 3:
-                        # Convertir a ruta relativa si es absoluta
-                        rel_path = PurePosixPath(f.relative_to(VIDEO_DIR))
-                        videos.append({
-                            'datetime': parts[0],
-                            'path': rel_path,
-                            'size': int(parts[2]) if parts[2].isdigit() else 0
-                        })
-        else:
-            for ext in ('*.avi', '*.mp4', '*.dav'):
-                for f in VIDEO_DIR.rglob(ext):
-                    rel_path = f.relative_to(VIDEO_DIR)
-                    videos.append({
-                        'datetime': datetime.fromtimestamp(f.stat().st_mtime).isoformat(),
-                        'path': str(rel_path),
-                        'size': f.stat().st_size
-                    })
-        return sorted(videos, key=lambda x: x['datetime'], reverse=True)
+        for ext in ('*.avi', '*.mp4', '*.dav'):
+            for f in VIDEO_DIR.rglob(ext):
+                rel_path = PurePosixPath(f.relative_to(VIDEO_DIR))
+                videos.append({
+                    'datetime': datetime.fromtimestamp(f.stat().st_mtime).isoformat(),
+                    'path': str(rel_path),
+                    'size': f.stat().st_size
+                })
+        videos = sorted(videos, key=lambda x: x['datetime'], reverse=True)
+        return videos[:limit] if limit else videos
     except Exception as e:
         print(f"Error leyendo base de datos: {e}")
         return []
@@ -135,9 +348,106 @@ def get_video_database():
 @app.route('/download/<path:filename>')
 @login_required
 def download_video(filename):
-    """Descargar un archivo de video"""
-    # Asegura que la ruta sea relativa al directorio de videos
-    return send_from_directory(VIDEO_DIR, filename, as_attachment=True)
+    """Descargar un archivo de video (con Range, ETag y envío por el proxy)"""
+    path, accel_prefix = find_video(filename)
+    if path is None:
+        return jsonify({'error': 'Archivo no encontrado'}), 404
+    return send_video(path, filename, accel_prefix)
+
+def find_video(rel_path):
+    """Ruta en disco y prefijo de x-accel del tier donde está el video, o (None, None)
+
+    Se prueba primero el directorio de videos: mientras el servidor mueve
+    un día al tier frío el archivo puede estar en ambos.
+    """
+    tiers = [(VIDEO_DIR, DOWNLOAD_ACCEL_PREFIX)]
+    if COLD_VIDEO_DIR is not None:
+        tiers.append((COLD_VIDEO_DIR, DOWNLOAD_ACCEL_COLD_PREFIX))
+    for root, accel_prefix in tiers:
+        # safe_join asegura que la ruta quede dentro del directorio del tier
+        path = safe_join(os.fspath(root), rel_path)
+        if path is not None and os.path.isfile(path):
+            return path, accel_prefix
+    return None, None
+
+def read_range(f, length):
+    """Lee exactamente length bytes del archivo ya posicionado"""
+    try:
+        while length > 0:
+            chunk = f.read(min(DOWNLOAD_CHUNK, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+def send_video(path, rel_path, accel_prefix=DOWNLOAD_ACCEL_PREFIX):
+    """Respuesta de descarga con caché condicional, rangos y sendfile"""
+    st = os.stat(path)
+    etag = f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+    name = PurePosixPath(rel_path).name
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': quote_etag(etag),
+        'Last-Modified': http_date(st.st_mtime),
+        'Cache-Control': 'private, max-age=0, must-revalidate',
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(name)}",
+    }
+
+    # El proxy se encarga de rangos y caché; la app solo autoriza
+    if DOWNLOAD_MODE == 'x-accel':
+        headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + quote(rel_path.lstrip('/'))
+        return Response(headers=headers)
+    if DOWNLOAD_MODE == 'x-sendfile':
+        headers['X-Sendfile'] = os.path.abspath(path)
+        return Response(headers=headers)
+
+    if request.if_none_match.contains(etag) or (
+            not request.if_none_match and request.if_modified_since
+            and int(st.st_mtime) <= request.if_modified_since.timestamp()):
+        return Response(status=304, headers=headers)
+
+    start, stop, status = 0, st.st_size, 200
+    byte_range = request.range
+    if_range = request.if_range
+    range_valid = (not if_range.etag and not if_range.date) or if_range.etag == etag or (
+        if_range.date is not None and int(st.st_mtime) <= if_range.date.timestamp())
+    if byte_range and range_valid:
+        bounds = byte_range.range_for_length(st.st_size)
+        if bounds is None:
+            headers['Content-Range'] = f"bytes */{st.st_size}"
+            return Response(status=416, headers=headers)
+        start, stop = bounds
+        status = 206
+        headers['Content-Range'] = f"bytes {start}-{stop - 1}/{st.st_size}"
+
+    f = open(path, 'rb')
+    f.seek(start)
+    length = stop - start
+    headers['Content-Length'] = str(length)
+    # Con gunicorn/waitress/uwsgi el file_wrapper hace sendfile desde la posición actual y
+    # se corta en Content-Length (PEP 3333); sin él se lee el tramo por bloques
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    body = file_wrapper(f, DOWNLOAD_CHUNK) if file_wrapper else read_range(f, length)
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    return Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+@app.route('/metrics')
+def metrics():
+    """Métricas para Prometheus (sin login, como /health del servidor FTP)"""
+    combined = collect_web_metrics()
+    if catalog.exists():
+        summary = catalog.stats_summary()
+        combined.set('dahua_web_videos', summary['count'])
+        combined.set('dahua_web_videos_bytes', summary['bytes'])
+    try:
+        combined.set('dahua_web_disk_free_bytes', psutil.disk_usage(os.fspath(VIDEO_DIR)).free)
+    except OSError:
+        pass
+    health = get_server_health()
+    combined.set('dahua_web_ftp_up', 1 if health and health.get('status') == 'ok' else 0)
+    return Response(combined.render(), mimetype=None, content_type=METRICS_CONTENT_TYPE)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -146,21 +456,18 @@ def login():
         username = request.form['username']
         password = request.form['password']
 
-        # Intentar login FTP con las credenciales ingresadas
-        try:
-            ftp = ftplib.FTP()
-            ftp.connect(FTP_HOST, FTP_PORT, timeout=5)
-            ftp.login(username, password)
-            ftp.quit()
-            # Si el login es exitoso, guardar en sesión
+        # Verificación local contra los hashes del servidor FTP (sin abrir sesión FTP)
+        if credentials.verify(username, password):
+            # En la sesión solo queda el usuario, nunca la contraseña
+            session.clear()
             session['logged_in'] = True
             session['username'] = username
-            session['ftp_user'] = username
-            session['ftp_pass'] = password
             flash('Login exitoso', 'success')
             return redirect(url_for('dashboard'))
-        except Exception as e:
-            flash('Credenciales incorrectas o servidor FTP no disponible', 'error')
+        if not credentials.exists():
+            flash(f'No existe el archivo de usuarios {CREDENTIALS_FILE}: iniciar el servidor FTP primero', 'error')
+        else:
+            flash('Credenciales incorrectas', 'error')
     
     return render_template('login.html')
 
@@ -176,7 +483,7 @@ def logout():
 def dashboard():
     """Dashboard principal"""
     stats = get_server_stats()
-    recent_videos = get_video_database()[:10]  # Últimos 10 videos
+    recent_videos = get_video_database(10)  # Últimos 10 videos
     return render_template('dashboard.html', stats=stats, recent_videos=recent_videos)
 
 @app.route('/logs')
@@ -189,9 +496,10 @@ def logs():
 @app.route('/videos')
 @login_required
 def videos():
-    """Página de videos"""
-    all_videos = get_video_database()
-    return render_template('videos.html', videos=all_videos)
+    """Página de videos (las filas se cargan desde /api/videos)"""
+    channels = catalog.channels() if catalog.exists() else []
+    cameras = catalog.cameras() if catalog.exists() else []
+    return render_template('videos.html', channels=channels, cameras=cameras)
 
 @app.route('/api/stats')
 @login_required
@@ -204,50 +512,295 @@ def api_stats():
 def api_logs():
     """API para obtener logs recientes"""
     lines = request.args.get('lines', 50, type=int)
-    return jsonify({'logs': get_recent_logs(lines)})
+    logs = get_recent_logs(lines)
+    line_filter = make_log_filter(request.args.get('level'), request.args.get('ip'), request.args.get('event'))
+    if line_filter is not None:
+        logs = [line for line in logs if line_filter(line)]
+    return jsonify({'logs': logs})
+
+@app.route('/api/videos')
+@login_required
+def api_videos():
+    """API paginada de videos: filtros por cámara, canal, fechas y extensión"""
+    limit = max(1, min(request.args.get('limit', 100, type=int), 500))
+    cursor = request.args.get('cursor') or None
+    try:
+        filters = video_filters_from_request()
+        if not catalog.exists():
+            return jsonify({'videos': [], 'next_cursor': None, 'total': 0})
+        page = catalog.query_videos(limit=limit, cursor=cursor, with_total=cursor is None, **filters)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(page)
+
+def video_filters_from_request():
+    """Cámara, canal, fechas (YYYY-MM-DD) y extensión de la query string"""
+    date_from = request.args.get('from') or None
+    date_to = request.args.get('to') or None
+    try:
+        if date_from:
+            date_from = datetime.strptime(date_from, '%Y-%m-%d').isoformat()
+        if date_to:
+            # Fecha final inclusiva
+            date_to = (datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)).isoformat()
+    except ValueError:
+        # El mensaje de strptime no sirve para el usuario
+        raise ValueError('Fecha inválida (YYYY-MM-DD)')
+    return {
+        'channel': request.args.get('channel', type=int),
+        'camera': request.args.get('camera') or None,
+        'date_from': date_from,
+        'date_to': date_to,
+        'ext': request.args.get('ext') or None,
+    }
+
+@app.route('/export')
+@login_required
+def export_videos():
+    """Un .tar con los videos de un rango de fechas y/o canal, armado al vuelo
+
+    Las entradas van sin comprimir y sin archivos temporales; el tamaño
+    total se calcula antes del primer byte para enviar Content-Length.
+    """
+    try:
+        filters = video_filters_from_request()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if all(filters[key] is None for key in ('channel', 'camera', 'date_from', 'date_to')):
+        return jsonify({'error': 'Indicar un rango de fechas, un canal o una cámara'}), 400
+    if not catalog.exists():
+        return jsonify({'error': 'No hay catálogo de videos'}), 404
+    members = []
+    length = 2 * tarfile.BLOCKSIZE  # bloques vacíos del final
+    for row in catalog.iter_videos(**filters):
+        path, _accel_prefix = find_video(row['path'])
+        if path is None:
+            continue
+        st = os.stat(path)
+        members.append((row['path'], st.st_size, int(st.st_mtime)))
+        length += len(tar_header(*members[-1])) + st.st_size + (-st.st_size % tarfile.BLOCKSIZE)
+        if len(members) > EXPORT_MAX_FILES:
+            return jsonify({'error': f'Más de {EXPORT_MAX_FILES} archivos: acotar el rango'}), 413
+    if not members:
+        return jsonify({'error': 'No hay videos con esos filtros'}), 404
+    name = "videos"
+    if filters['camera']:
+        name += f"_{filters['camera']}"
+    if filters['channel'] is not None:
+        name += f"_ch{filters['channel']}"
+    for key in ('from', 'to'):
+        if request.args.get(key):
+            name += f"_{request.args[key]}"
+    headers = {
+        'Content-Length': str(length),
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(name)}.tar",
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+    }
+    return Response(stream_tar(members), mimetype='application/x-tar', headers=headers, direct_passthrough=True)
+
+def tar_header(rel_path, size, mtime):
+    """Cabecera tar de una entrada; GNU admite rutas largas y archivos de más de 8 GB"""
+    info = tarfile.TarInfo(rel_path)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    return info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+
+def open_member(rel_path):
+    # El tiering puede mover el archivo entre el listado y la lectura
+    for _ in range(2):
+        path, _accel_prefix = find_video(rel_path)
+        if path is None:
+            return None
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            continue
+    return None
+
+def stream_tar(members):
+    """Genera el tar con exactamente los tamaños anunciados"""
+    for rel_path, size, mtime in members:
+        yield tar_header(rel_path, size, mtime)
+        remaining = size
+        f = open_member(rel_path)
+        if f is not None:
+            with f:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                while remaining > 0:
+                    chunk = f.read(min(DOWNLOAD_CHUNK, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+        # Borrado o truncado por la retención durante la descarga: se completa con ceros
+        while remaining > 0:
+            chunk = min(DOWNLOAD_CHUNK, remaining)
+            remaining -= chunk
+            yield bytes(chunk)
+        if size % tarfile.BLOCKSIZE:
+            yield bytes(-size % tarfile.BLOCKSIZE)
+    yield bytes(2 * tarfile.BLOCKSIZE)
+
+_update_state = {'available': False, 'checked': None, 'thread': None}
+_update_lock = threading.Lock()
+
+@app.route('/api/logs/stream')
+@login_required
+def api_logs_stream():
+    """Server-Sent Events con las líneas nuevas del log"""
+    line_filter = make_log_filter(request.args.get('level'), request.args.get('ip'), request.args.get('event'))
+    response = Response(stream_with_context(follow_log(LOG_DIR / 'ftp_server.log', line_filter=line_filter)),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 def check_git_update():
     """Verifica si hay actualizaciones en el repositorio git"""
     try:
-        # Buscar cambios remotos
-        subprocess.run(['git', 'fetch'], check=True)
-        local = subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
-        remote = subprocess.check_output(['git', 'rev-parse', '@{u}']).strip()
+        # Buscar cambios remotos sin pedir credenciales ni colgarse sin red
+        env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+        run = dict(cwd=REPO_DIR, env=env, timeout=GIT_CHECK_TIMEOUT, capture_output=True, check=True)
+        subprocess.run(['git', 'fetch'], **run)
+        local = subprocess.run(['git', 'rev-parse', 'HEAD'], **run).stdout.strip()
+        remote = subprocess.run(['git', 'rev-parse', '@{u}'], **run).stdout.strip()
         return local != remote
     except Exception as e:
         print(f"Error comprobando actualizaciones git: {e}")
         return False
 
-def do_git_pull_and_restart():
+def read_update_state():
+    """Lee el último resultado de la verificación escrito por cualquier worker"""
+    try:
+        return json.loads(UPDATE_STATE_FILE.read_text())
+    except (OSError, ValueError):
+        return {'available': False, 'checked': 0}
+
+def write_update_state(state):
+    """Escribe el estado de forma atómica para que los demás workers lo lean"""
+    UPDATE_STATE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = UPDATE_STATE_FILE.with_suffix(f'.{os.getpid()}.tmp')
+    tmp.write_text(json.dumps(state))
+    os.replace(tmp, UPDATE_STATE_FILE)
+
+def acquire_update_lock():
+    """Candado entre procesos: solo quien lo obtiene ejecuta git fetch"""
+    UPDATE_STATE_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        os.close(os.open(UPDATE_LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        # Candado abandonado por un worker que murió a mitad de la verificación
+        try:
+            if time.time() - UPDATE_LOCK_FILE.stat().st_mtime > GIT_CHECK_TIMEOUT * 4:
+                UPDATE_LOCK_FILE.unlink()
+        except OSError:
+            pass
+        return False
+
+def git_update_checker():
+    """Refresca el indicador de actualización cada GIT_CHECK_INTERVAL segundos"""
+    while True:
+        state = read_update_state()
+        if time.time() - state.get('checked', 0) >= GIT_CHECK_INTERVAL and acquire_update_lock():
+            try:
+                state = {'available': check_git_update(), 'checked': time.time()}
+                write_update_state(state)
+            finally:
+                UPDATE_LOCK_FILE.unlink(missing_ok=True)
+        _update_state['available'] = state.get('available', False)
+        _update_state['checked'] = state.get('checked')
+        time.sleep(min(GIT_CHECK_INTERVAL, GIT_STATE_POLL))
+
+def start_git_update_checker():
+    """Inicia (una sola vez) el hilo de verificación de actualizaciones"""
+    if GIT_CHECK_INTERVAL <= 0:
+        return
+    with _update_lock:
+        if _update_state['thread'] is None:
+            _update_state['thread'] = threading.Thread(target=git_update_checker, name="git-check", daemon=True)
+            _update_state['thread'].start()
+
+def do_git_pull_and_restart(reload_master=False):
     """Ejecuta git pull y reinicia el servidor Flask"""
     try:
-        subprocess.run(['git', 'pull'], check=True)
-        # Reiniciar el servidor Flask (solo funciona si se ejecuta con flask run o similar)
-        os._exit(3)  # Código especial para reinicio supervisado (gunicorn, systemd, etc)
+        subprocess.run(['git', 'pull'], check=True, cwd=REPO_DIR)
+        write_update_state({'available': False, 'checked': time.time()})
+        if reload_master:
+            # gunicorn: HUP al maestro recarga todos los workers con el código nuevo
+            os.kill(os.getppid(), signal.SIGHUP)
+        else:
+            # Reiniciar el servidor Flask (solo funciona si se ejecuta con flask run o similar)
+            os._exit(3)  # Código especial para reinicio supervisado (gunicorn, systemd, etc)
     except Exception as e:
         print(f"Error actualizando el proyecto: {e}")
 
 @app.context_processor
 def inject_update_flag():
     """Inyecta la variable update_available en todas las plantillas"""
-    update_available = check_git_update()
-    return dict(update_available=update_available)
+    start_git_update_checker()
+    return dict(update_available=_update_state['available'])
 
 @app.route('/update', methods=['POST'])
 @login_required
 def update():
     """Endpoint para actualizar el proyecto"""
-    threading.Thread(target=do_git_pull_and_restart).start()
+    reload_master = request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn')
+    threading.Thread(target=do_git_pull_and_restart, args=(reload_master,)).start()
     flash('Actualizando proyecto... El servidor se reiniciará.', 'info')
     return redirect(url_for('dashboard'))
 
-if __name__ == '__main__':
+def run_gunicorn(host, port, workers, threads):
+    """Servidor de producción multiproceso (Linux)"""
+    from gunicorn.app.base import BaseApplication
+
+    class DashboardApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            # gthread: el latido del worker no depende de lo que tarde cada request (descargas, SSE)
+            self.cfg.set('worker_class', 'gthread')
+
+        def load(self):
+            return app
+
+    DashboardApplication().run()
+
+def run_waitress(host, port, threads):
+    """Servidor de producción multihilo (también en Windows)"""
+    from waitress import serve
+    serve(app, host=host, port=port, threads=threads)
+
+def main():
+    parser = argparse.ArgumentParser(description='Cliente web FTP Dahua')
+    parser.add_argument('--host', default='0.0.0.0', help='IP donde escuchar (default: 0.0.0.0)')
+    parser.add_argument('--port', type=int, default=5000, help='Puerto HTTP (default: 5000)')
+    parser.add_argument('--server', choices=['dev', 'gunicorn', 'waitress'], default='dev',
+                        help='dev: servidor de Flask con recarga; gunicorn/waitress: producción (default: dev)')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Procesos worker con gunicorn (default: 2)')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Hilos por worker; cada stream SSE ocupa uno (default: 8)')
+    args = parser.parse_args()
+
     # Crear directorios necesarios
     VIDEO_DIR.mkdir(exist_ok=True)
     LOG_DIR.mkdir(exist_ok=True)
     
     print("=== Cliente Web FTP Dahua ===")
-    print("Accede a: http://localhost:5000")
+    print(f"Accede a: http://localhost:{args.port} ({args.server})")
     print("=============================")
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    if args.server == 'gunicorn':
+        run_gunicorn(args.host, args.port, args.workers, args.threads)
+    elif args.server == 'waitress':
+        run_waitress(args.host, args.port, args.threads)
+    else:
+        app.run(debug=True, host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
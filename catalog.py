@@ -0,0 +1,685 @@
+#!/usr/bin/env python3
+"""
+Catálogo SQLite de videos recibidos del DVR Dahua
+Lo escribe el servidor FTP (en lotes) y lo consulta el cliente web
+"""
+
+import sys
+import json
+import base64
+import time
+import queue
+import sqlite3
+import logging
+import threading
+import argparse
+from datetime import datetime
+from pathlib import Path, PurePosixPath
+from filenames import parse_video_name, PART_SUFFIX
+
+DEFAULT_DB = "video_catalog.db"
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mkv', '.mov', '.wmv', '.flv', '.dav')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    camera TEXT,
+    channel INTEGER,
+    stream TEXT,
+    start_time TEXT NOT NULL,
+    end_time TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    ext TEXT,
+    received_at REAL,
+    checksum TEXT,
+    tier TEXT  -- NULL: directorio de videos; 'cold': directorio del tier frío
+);
+CREATE INDEX IF NOT EXISTS idx_videos_start ON videos(start_time, path);
+CREATE INDEX IF NOT EXISTS idx_videos_channel_start ON videos(channel, start_time);
+CREATE INDEX IF NOT EXISTS idx_videos_ext_start ON videos(ext, start_time);
+CREATE INDEX IF NOT EXISTS idx_videos_dedup ON videos(channel, start_time, checksum);
+-- Partición por cámara: navegar, filtrar y contar una cámara solo recorre su rango
+CREATE INDEX IF NOT EXISTS idx_videos_camera_start ON videos(camera, channel, start_time, path);
+CREATE INDEX IF NOT EXISTS idx_videos_tier_start ON videos(tier, start_time, path);
+
+-- Uploads cortados a la espera de un REST (path es el .part)
+CREATE TABLE IF NOT EXISTS partials (
+    path TEXT PRIMARY KEY,
+    channel INTEGER,
+    start_time TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_partials_updated ON partials(updated_at);
+
+-- Estadísticas agregadas mantenidas por triggers: leerlas es O(1)
+CREATE TABLE IF NOT EXISTS stats (
+    dimension TEXT NOT NULL,
+    key TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    last_received REAL,
+    PRIMARY KEY (dimension, key)
+);
+
+CREATE TRIGGER IF NOT EXISTS videos_stats_insert AFTER INSERT ON videos BEGIN
+    INSERT INTO stats (dimension, key, count, bytes, last_received)
+    VALUES ('total', '', 1, NEW.size, NEW.received_at),
+           ('channel', COALESCE(NEW.channel, ''), 1, NEW.size, NEW.received_at),
+           ('day', substr(NEW.start_time, 1, 10), 1, NEW.size, NEW.received_at),
+           ('ext', COALESCE(NEW.ext, ''), 1, NEW.size, NEW.received_at),
+           ('camera', COALESCE(NEW.camera, ''), 1, NEW.size, NEW.received_at)
+    ON CONFLICT (dimension, key) DO UPDATE SET
+        count = count + 1,
+        bytes = bytes + excluded.bytes,
+        last_received = max(COALESCE(last_received, 0), COALESCE(excluded.last_received, 0));
+END;
+
+CREATE TRIGGER IF NOT EXISTS videos_stats_delete AFTER DELETE ON videos BEGIN
+    UPDATE stats SET count = count - 1, bytes = bytes - OLD.size
+    WHERE (dimension = 'total' AND key = '')
+       OR (dimension = 'channel' AND key = COALESCE(OLD.channel, ''))
+       OR (dimension = 'day' AND key = substr(OLD.start_time, 1, 10))
+       OR (dimension = 'ext' AND key = COALESCE(OLD.ext, ''))
+       OR (dimension = 'camera' AND key = COALESCE(OLD.camera, ''));
+END;
+
+CREATE TRIGGER IF NOT EXISTS videos_stats_update AFTER UPDATE OF size, camera, channel, start_time, ext ON videos BEGIN
+    UPDATE stats SET count = count - 1, bytes = bytes - OLD.size
+    WHERE (dimension = 'total' AND key = '')
+       OR (dimension = 'channel' AND key = COALESCE(OLD.channel, ''))
+       OR (dimension = 'day' AND key = substr(OLD.start_time, 1, 10))
+       OR (dimension = 'ext' AND key = COALESCE(OLD.ext, ''))
+       OR (dimension = 'camera' AND key = COALESCE(OLD.camera, ''));
+    INSERT INTO stats (dimension, key, count, bytes, last_received)
+    VALUES ('total', '', 1, NEW.size, NEW.received_at),
+           ('channel', COALESCE(NEW.channel, ''), 1, NEW.size, NEW.received_at),
+           ('day', substr(NEW.start_time, 1, 10), 1, NEW.size, NEW.received_at),
+           ('ext', COALESCE(NEW.ext, ''), 1, NEW.size, NEW.received_at),
+           ('camera', COALESCE(NEW.camera, ''), 1, NEW.size, NEW.received_at)
+    ON CONFLICT (dimension, key) DO UPDATE SET
+        count = count + 1,
+        bytes = bytes + excluded.bytes,
+        last_received = max(COALESCE(last_received, 0), COALESCE(excluded.last_received, 0));
+END;
+"""
+
+# Sube cuando cambian los triggers: los existentes se recrean y stats se recalcula
+SCHEMA_VERSION = 2
+TRIGGERS = ('videos_stats_insert', 'videos_stats_delete', 'videos_stats_update')
+
+# Columnas agregadas después de la primera versión del esquema
+MIGRATIONS = (
+    ('videos', 'checksum', 'ALTER TABLE videos ADD COLUMN checksum TEXT'),
+    ('videos', 'tier', 'ALTER TABLE videos ADD COLUMN tier TEXT'),
+)
+COLD_TIER = 'cold'
+
+
+INSERT_SQL = """
+INSERT INTO videos (path, camera, channel, stream, start_time, end_time, size, ext, received_at, checksum, tier)
+VALUES (:path, :camera, :channel, :stream, :start_time, :end_time, :size, :ext, :received_at, :checksum, :tier)
+ON CONFLICT (path) DO UPDATE SET
+    camera = excluded.camera, channel = excluded.channel, stream = excluded.stream,
+    start_time = excluded.start_time, end_time = excluded.end_time, size = excluded.size,
+    ext = excluded.ext, received_at = excluded.received_at, checksum = excluded.checksum,
+    tier = excluded.tier
+"""
+
+PARTIAL_SQL = """
+INSERT INTO partials (path, channel, start_time, size, attempts, updated_at)
+VALUES (:path, :channel, :start_time, :size, 1, :updated_at)
+ON CONFLICT (path) DO UPDATE SET
+    size = excluded.size, attempts = attempts + :attempt, updated_at = excluded.updated_at
+"""
+
+RECONCILE_SQL = """
+DELETE FROM stats;
+INSERT INTO stats (dimension, key, count, bytes, last_received)
+    SELECT 'total', '', COUNT(*), COALESCE(SUM(size), 0), MAX(received_at) FROM videos;
+INSERT INTO stats (dimension, key, count, bytes, last_received)
+    SELECT 'channel', COALESCE(channel, ''), COUNT(*), SUM(size), MAX(received_at) FROM videos GROUP BY 1, 2;
+INSERT INTO stats (dimension, key, count, bytes, last_received)
+    SELECT 'day', substr(start_time, 1, 10), COUNT(*), SUM(size), MAX(received_at) FROM videos GROUP BY 1, 2;
+INSERT INTO stats (dimension, key, count, bytes, last_received)
+    SELECT 'ext', COALESCE(ext, ''), COUNT(*), SUM(size), MAX(received_at) FROM videos GROUP BY 1, 2;
+INSERT INTO stats (dimension, key, count, bytes, last_received)
+    SELECT 'camera', COALESCE(camera, ''), COUNT(*), SUM(size), MAX(received_at) FROM videos GROUP BY 1, 2;
+"""
+
+def make_record(rel_path, size, info=None, received_at=None, checksum=None, tier=None):
+    """Arma una fila del catálogo a partir de la ruta relativa al directorio de videos"""
+    rel_path = PurePosixPath(rel_path)
+    if info is None:
+        info = parse_video_name(rel_path.name)
+    return {
+        'path': str(rel_path),
+        'camera': info.camera if info else None,
+        'channel': info.channel if info else None,
+        'stream': info.stream if info else None,
+        'start_time': info.start.isoformat() if info else datetime.fromtimestamp(received_at or time.time()).isoformat(),
+        'end_time': info.end.isoformat() if info and info.end else None,
+        'size': size,
+        'ext': rel_path.suffix.lower(),
+        'received_at': received_at or time.time(),
+        'checksum': checksum,
+        'tier': tier,
+    }
+
+
+class VideoCatalog:
+    """Acceso al catálogo: una conexión por hilo y escritura en lotes"""
+
+    def __init__(self, db_path=DEFAULT_DB, readonly=False, batch_size=200, flush_interval=1.0):
+        self.db_path = Path(db_path)
+        self.readonly = readonly
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.local = threading.local()
+        self.pending = queue.Queue()
+        self.writer = None
+        # Filas encoladas que el escritor todavía no insertó, por ruta
+        self.unflushed = {}
+        self.unflushed_lock = threading.Lock()
+        self.logger = logging.getLogger("DahuaFTPServer")
+        if not readonly:
+            self.init_schema()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            if self.readonly:
+                conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=10)
+            else:
+                conn = sqlite3.connect(str(self.db_path), timeout=30)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            conn.row_factory = sqlite3.Row
+            self.local.conn = conn
+        return conn
+
+    def exists(self):
+        return self.db_path.exists()
+
+    def init_schema(self):
+        # Conexión propia: el servidor puede hacer fork después de esto
+        conn = sqlite3.connect(str(self.db_path), timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Migrar antes del esquema: sus índices pueden usar columnas nuevas
+            for table, column, ddl in MIGRATIONS:
+                columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+                if columns and column not in columns:
+                    conn.execute(ddl)
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < SCHEMA_VERSION:
+                for trigger in TRIGGERS:
+                    conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            conn.executescript(SCHEMA)
+            conn.commit()
+            # Catálogos creados antes de existir la tabla stats o con triggers viejos
+            if version < SCHEMA_VERSION or conn.execute("SELECT 1 FROM stats LIMIT 1").fetchone() is None:
+                conn.executescript("BEGIN IMMEDIATE;" + RECONCILE_SQL +
+                                   f"PRAGMA user_version = {SCHEMA_VERSION};" + "COMMIT;")
+        finally:
+            conn.close()
+
+    # --- escritura
+
+    def start_writer(self):
+        """Inicia el hilo que agrupa inserciones en transacciones"""
+        if self.writer is None:
+            self.writer = threading.Thread(target=self._writer_loop, name="catalog-writer", daemon=True)
+            self.writer.start()
+
+    def add(self, record):
+        """Encola una fila; sin hilo escritor se inserta de inmediato"""
+        if self.writer is None:
+            self.insert_many([record])
+        else:
+            with self.unflushed_lock:
+                self.unflushed[record['path']] = record
+            self.pending.put(record)
+
+    def close(self):
+        if self.writer is not None:
+            self.pending.put(None)
+            self.writer.join(30)
+            self.writer = None
+
+    def insert_many(self, records):
+        conn = self.connect()
+        with conn:
+            conn.executemany(INSERT_SQL, records)
+
+    def _writer_loop(self):
+        while True:
+            record = self.pending.get()
+            if record is None:
+                return
+            batch = [record]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self.pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+            # Con el lock tomado un delete_paths concurrente ve la fila en memoria o ya en la tabla
+            with self.unflushed_lock:
+                batch = [r for r in batch if self.unflushed.get(r['path']) is r]
+                try:
+                    self.insert_many(batch)
+                except sqlite3.Error as e:
+                    self.logger.error(f"Error escribiendo {len(batch)} filas en el catálogo: {e}")
+                for r in batch:
+                    del self.unflushed[r['path']]
+            if stop:
+                return
+
+    # --- lectura
+
+    def recent(self, limit=10):
+        rows = self.connect().execute(
+            "SELECT * FROM videos ORDER BY start_time DESC, path DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [self.row_to_video(r) for r in rows]
+
+    def all_videos(self):
+        rows = self.connect().execute("SELECT * FROM videos ORDER BY start_time DESC, path DESC").fetchall()
+        return [self.row_to_video(r) for r in rows]
+
+    def query_videos(self, limit=100, cursor=None, channel=None, date_from=None, date_to=None, ext=None, with_total=True, camera=None):
+        """Página de videos ordenada por fecha descendente (paginación por cursor)
+
+        El cursor codifica (start_time, path) de la última fila entregada,
+        así cada página es un rango del índice sin OFFSET. El total sale
+        de la tabla stats (ver count_from_stats); solo las combinaciones de
+        filtros que stats no puede responder cuentan sobre videos.
+        """
+        where, params = self.video_filters(channel, date_from, date_to, ext, camera)
+        conn = self.connect()
+        total = None
+        if with_total:
+            total = self.count_from_stats(channel, date_from, date_to, ext, camera)
+            if total is None:
+                sql = "SELECT COUNT(*) FROM videos"
+                if where:
+                    sql += " WHERE " + " AND ".join(where)
+                total = conn.execute(sql, params).fetchone()[0]
+        if cursor:
+            where.append("(start_time, path) < (?, ?)")
+            params.extend(self.decode_cursor(cursor))
+        sql = "SELECT * FROM videos"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY start_time DESC, path DESC LIMIT ?"
+        rows = conn.execute(sql, params + [limit + 1]).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self.encode_cursor(rows[-1]['start_time'], rows[-1]['path'])
+        return {
+            'videos': [self.row_to_video(r) for r in rows],
+            'next_cursor': next_cursor,
+            'total': total,
+        }
+
+    def count_from_stats(self, channel=None, date_from=None, date_to=None, ext=None, camera=None):
+        """Total de un filtro leído de stats, o None si stats no lo puede responder
+
+        Responde sin filtros, con un solo filtro de cámara, canal o
+        extensión, o con un rango de fechas en días completos (suma de los
+        buckets por día). Las combinaciones necesitan COUNT sobre videos.
+        """
+        dates = [d for d in (date_from, date_to) if d]
+        if dates:
+            if channel is not None or camera is not None or ext or any(d[10:] not in ('', 'T00:00:00') for d in dates):
+                return None
+            where = ["dimension = 'day'"]
+            params = []
+            if date_from:
+                where.append("key >= ?")
+                params.append(date_from[:10])
+            if date_to:
+                where.append("key < ?")
+                params.append(date_to[:10])
+            sql = f"SELECT COALESCE(SUM(count), 0) FROM stats WHERE {' AND '.join(where)}"
+            return self.connect().execute(sql, params).fetchone()[0]
+        filters = [(dimension, value) for dimension, value in (('camera', camera), ('channel', channel), ('ext', ext))
+                   if value is not None and value != '']
+        if len(filters) > 1:
+            return None
+        dimension, key = filters[0] if filters else ('total', '')
+        if dimension == 'ext':
+            key = key.lower() if key.startswith('.') else '.' + key.lower()
+        row = self.connect().execute(
+            "SELECT count FROM stats WHERE dimension = ? AND key = ?", (dimension, str(key))).fetchone()
+        return row[0] if row else 0
+
+    def iter_videos(self, channel=None, date_from=None, date_to=None, ext=None, camera=None):
+        """Filas (path, size) de los filtros en orden cronológico, sin cargarlas todas"""
+        where, params = self.video_filters(channel, date_from, date_to, ext, camera)
+        sql = "SELECT path, size FROM videos"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        yield from self.connect().execute(sql + " ORDER BY start_time, path", params)
+
+    @staticmethod
+    def video_filters(channel=None, date_from=None, date_to=None, ext=None, camera=None):
+        where = []
+        params = []
+        if camera is not None:
+            where.append("camera = ?")
+            params.append(camera)
+        if channel is not None:
+            where.append("channel = ?")
+            params.append(channel)
+        if date_from:
+            where.append("start_time >= ?")
+            params.append(date_from)
+        if date_to:
+            where.append("start_time < ?")
+            params.append(date_to)
+        if ext:
+            where.append("ext = ?")
+            params.append(ext.lower() if ext.startswith('.') else '.' + ext.lower())
+        return where, params
+
+    def channels(self):
+        return [r[0] for r in self.connect().execute(
+            "SELECT DISTINCT channel FROM videos WHERE channel IS NOT NULL ORDER BY channel"
+        )]
+
+    def cameras(self):
+        # Las cámaras salen de stats: no hace falta recorrer videos
+        return [r[0] for r in self.connect().execute(
+            "SELECT key FROM stats WHERE dimension = 'camera' AND key != '' AND count > 0 ORDER BY key"
+        )]
+
+    @staticmethod
+    def encode_cursor(start_time, path):
+        return base64.urlsafe_b64encode(json.dumps([start_time, path]).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            start_time, path = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return str(start_time), str(path)
+        except Exception:
+            raise ValueError("Cursor inválido")
+
+    @staticmethod
+    def row_to_video(row):
+        return {
+            'datetime': row['start_time'],
+            'end': row['end_time'],
+            'path': row['path'],
+            'size': row['size'],
+            'camera': row['camera'],
+            'channel': row['channel'],
+        }
+
+    # --- retención
+
+    def delete_prefix(self, prefix):
+        """Borra las filas bajo un directorio (rango sobre el índice de path)"""
+        prefix = prefix.rstrip('/') + '/'
+        # '0' es el carácter siguiente a '/': [prefix, prefix0) cubre todo el directorio
+        bounds = (prefix, prefix[:-1] + '0')
+        conn = self.connect()
+        with conn:
+            count, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM videos WHERE path >= ? AND path < ?", bounds
+            ).fetchone()
+            conn.execute("DELETE FROM videos WHERE path >= ? AND path < ?", bounds)
+        return count, size
+
+    def rename_paths(self, updates):
+        """Cambia rutas (nueva, vieja) después de mover archivos en disco
+
+        Una fila que ya ocupaba la ruta nueva se borra antes con un DELETE
+        normal: el REPLACE de SQLite no dispara el trigger de stats.
+        """
+        conn = self.connect()
+        with conn:
+            conn.executemany("DELETE FROM videos WHERE path = ?1 AND ?1 != ?2 "
+                             "AND EXISTS (SELECT 1 FROM videos WHERE path = ?2)", updates)
+            conn.executemany("UPDATE videos SET path = ? WHERE path = ?", updates)
+
+    def find_duplicate(self, channel, start_time, checksum, exclude_path=None):
+        """Otra fila con el mismo canal, inicio y checksum (un segmento re-subido)
+
+        Primero se miran las filas que siguen en el lote del escritor: un
+        DVR que re-sube apenas reconecta llega antes del próximo flush.
+        """
+        with self.unflushed_lock:
+            for record in self.unflushed.values():
+                if (record['channel'] == channel and record['start_time'] == start_time
+                        and record['checksum'] == checksum and record['path'] != exclude_path):
+                    return {'path': record['path'], 'size': record['size']}
+        return self.connect().execute(
+            "SELECT path, size FROM videos WHERE channel IS ? AND start_time = ? AND checksum = ? AND path != ? LIMIT 1",
+            (channel, start_time, checksum, exclude_path or '')
+        ).fetchone()
+
+    # --- uploads incompletos
+
+    def mark_partial(self, rel_path, size, updated_at=None, attempt=1):
+        """Registra un upload cortado; attempt=0 solo actualiza tamaño y fecha"""
+        info = parse_video_name(PurePosixPath(rel_path).name)
+        conn = self.connect()
+        with conn:
+            conn.execute(PARTIAL_SQL, {
+                'path': rel_path,
+                'channel': info.channel if info else None,
+                'start_time': info.start.isoformat() if info else None,
+                'size': size,
+                'updated_at': updated_at or time.time(),
+                'attempt': attempt,
+            })
+
+    def clear_partials(self, paths):
+        """El upload terminó o el .part se borró"""
+        conn = self.connect()
+        with conn:
+            conn.executemany("DELETE FROM partials WHERE path = ?", [(p,) for p in paths])
+
+    def stale_partials(self, before, limit=1000):
+        """Uploads cortados sin novedades desde before (timestamp)"""
+        return self.connect().execute(
+            "SELECT path, size, updated_at FROM partials WHERE updated_at < ? ORDER BY updated_at LIMIT ?",
+            (before, limit)
+        ).fetchall()
+
+    def partials_summary(self):
+        count, size = self.connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM partials").fetchone()
+        return {'count': count, 'bytes': size}
+
+    def delete_paths(self, paths):
+        with self.unflushed_lock:
+            # Las que todavía no se insertaron ya no se insertan
+            for path in paths:
+                self.unflushed.pop(path, None)
+        conn = self.connect()
+        with conn:
+            conn.executemany("DELETE FROM videos WHERE path = ?", [(p,) for p in paths])
+
+    def expired(self, before, channel=None, exclude_channels=(), limit=1000):
+        """Filas con start_time < before, las más antiguas primero"""
+        where = ["start_time < ?"]
+        params = [before]
+        if channel is not None:
+            where.append("channel = ?")
+            params.append(channel)
+        if exclude_channels:
+            where.append(f"COALESCE(channel, -1) NOT IN ({','.join('?' * len(exclude_channels))})")
+            params.extend(exclude_channels)
+        sql = f"SELECT path, size FROM videos WHERE {' AND '.join(where)} ORDER BY start_time LIMIT ?"
+        return self.connect().execute(sql, params + [limit]).fetchall()
+
+    def oldest(self, limit=100, hot_only=False):
+        if hot_only:
+            return self.connect().execute(
+                "SELECT path, size FROM videos WHERE tier IS NULL ORDER BY start_time, path LIMIT ?", (limit,)
+            ).fetchall()
+        return self.connect().execute(
+            "SELECT path, size FROM videos ORDER BY start_time, path LIMIT ?", (limit,)
+        ).fetchall()
+
+    # --- tiers
+
+    def set_tier(self, paths, tier):
+        """Cambia de tier un lote de rutas en una sola transacción"""
+        conn = self.connect()
+        with conn:
+            conn.executemany("UPDATE videos SET tier = ? WHERE path = ?", [(tier, p) for p in paths])
+
+    # --- estadísticas
+
+    def stats_summary(self):
+        """Totales, desglose por canal/día/extensión/cámara y última subida"""
+        summary = {'count': 0, 'bytes': 0, 'last_received': None,
+                   'by_channel': {}, 'by_day': {}, 'by_ext': {}, 'by_camera': {},
+                   'partials': {'count': 0, 'bytes': 0}}
+        rows = self.connect().execute(
+            "SELECT dimension, key, count, bytes, last_received FROM stats WHERE count > 0"
+        ).fetchall()
+        for row in rows:
+            if row['dimension'] == 'total':
+                summary['count'] = row['count']
+                summary['bytes'] = row['bytes']
+                summary['last_received'] = row['last_received']
+            else:
+                summary['by_' + row['dimension']][row['key']] = {'count': row['count'], 'bytes': row['bytes']}
+        try:
+            summary['partials'] = self.partials_summary()
+        except sqlite3.OperationalError:
+            # Catálogo de solo lectura todavía sin migrar por el servidor
+            pass
+        return summary
+
+    def reconcile_stats(self):
+        """Recalcula la tabla stats desde cero a partir de videos"""
+        conn = self.connect()
+        conn.commit()
+        conn.executescript("BEGIN IMMEDIATE;" + RECONCILE_SQL + "COMMIT;")
+
+    def sync_tree(self, video_dir, cold_dir=None):
+        """Compara catálogo y disco: agrega archivos faltantes y borra filas huérfanas
+
+        Con cold_dir se recorren ambos tiers; si un archivo está en los
+        dos (movimiento interrumpido) cuenta el del directorio de videos.
+        """
+        video_root = Path(video_dir)
+        on_disk = {}
+        parts_on_disk = {}
+        roots = [(Path(cold_dir), COLD_TIER)] if cold_dir else []
+        for root, tier in roots + [(video_root, None)]:
+            for f in root.rglob("*"):
+                if f.suffix.lower() in VIDEO_EXTENSIONS and f.is_file():
+                    on_disk[f.relative_to(root).as_posix()] = (f, tier)
+                elif f.suffix == PART_SUFFIX and f.is_file() and tier is None:
+                    parts_on_disk[f.relative_to(root).as_posix()] = f
+        conn = self.connect()
+        known = {row[0]: row[1] for row in conn.execute("SELECT path, tier FROM videos")}
+        missing = known.keys() - on_disk.keys()
+        added = []
+        for rel_path in on_disk.keys() - known.keys():
+            f, tier = on_disk[rel_path]
+            st = f.stat()
+            added.append(make_record(rel_path, st.st_size, received_at=st.st_mtime, tier=tier))
+        moved = [(on_disk[p][1], p) for p in known.keys() & on_disk.keys() if known[p] != on_disk[p][1]]
+        with conn:
+            conn.executemany("DELETE FROM videos WHERE path = ?", [(p,) for p in missing])
+            conn.executemany(INSERT_SQL, added)
+            conn.executemany("UPDATE videos SET tier = ? WHERE path = ?", moved)
+        # .part de uploads cortados por una caída del servidor: que también venzan
+        known_parts = {row[0] for row in conn.execute("SELECT path FROM partials")}
+        self.clear_partials(known_parts - parts_on_disk.keys())
+        for rel_path in parts_on_disk.keys() - known_parts:
+            st = parts_on_disk[rel_path].stat()
+            self.mark_partial(rel_path, st.st_size, updated_at=st.st_mtime)
+        self.reconcile_stats()
+        return len(added), len(missing)
+
+    # --- importación
+
+    def import_csv(self, csv_file, video_dir):
+        """Importa un video_database.txt (fecha,ruta,tamaño) existente"""
+        video_root = Path(video_dir).resolve()
+        records = []
+        count = 0
+        with open(csv_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.strip().split(',')
+                if len(parts) < 3:
+                    continue
+                path = Path(parts[1])
+                try:
+                    rel_path = path.resolve().relative_to(video_root) if path.is_absolute() else path
+                except ValueError:
+                    continue
+                info = parse_video_name(path.name)
+                record = make_record(rel_path.as_posix(), int(parts[2]) if parts[2].isdigit() else 0, info)
+                if info is None:
+                    record['start_time'] = parts[0]
+                records.append(record)
+                if len(records) >= 1000:
+                    self.insert_many(records)
+                    count += len(records)
+                    records = []
+        self.insert_many(records)
+        return count + len(records)
+
+    def import_tree(self, video_dir):
+        """Recorre el directorio de videos e inserta todo lo que encuentre"""
+        video_root = Path(video_dir)
+        records = []
+        count = 0
+        for f in video_root.rglob("*"):
+            if f.suffix.lower() not in VIDEO_EXTENSIONS or not f.is_file():
+                continue
+            st = f.stat()
+            records.append(make_record(f.relative_to(video_root).as_posix(), st.st_size, received_at=st.st_mtime))
+            if len(records) >= 1000:
+                self.insert_many(records)
+                count += len(records)
+                records = []
+        self.insert_many(records)
+        return count + len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importa videos existentes al catálogo SQLite")
+    parser.add_argument('--db', default=DEFAULT_DB, help=f"Archivo del catálogo (default: {DEFAULT_DB})")
+    parser.add_argument('--video-dir', default="dahua_videos", help="Directorio de videos (default: dahua_videos)")
+    parser.add_argument('--csv', action='append', default=[], help="video_database.txt a importar (se puede repetir)")
+    parser.add_argument('--scan', action='store_true', help="Recorrer el directorio de videos e importar los archivos")
+    args = parser.parse_args()
+
+    if not args.csv and not args.scan:
+        parser.error("indicar --csv y/o --scan")
+
+    catalog = VideoCatalog(args.db)
+    for csv_file in args.csv:
+        print(f"Importando {csv_file}...")
+        print(f"- {catalog.import_csv(csv_file, args.video_dir)} filas")
+    if args.scan:
+        print(f"Recorriendo {args.video_dir}...")
+        print(f"- {catalog.import_tree(args.video_dir)} archivos")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
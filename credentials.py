@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Usuarios del servidor FTP Dahua con contraseñas hasheadas
+Un archivo JSON compartido por el servidor FTP y el cliente web, cada
+usuario con su directorio (relativo al de videos) y sus permisos
+"""
+
+import os
+import sys
+import hmac
+import json
+import time
+import base64
+import getpass
+import hashlib
+import logging
+import secrets
+import argparse
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import PurePosixPath
+
+DEFAULT_FILE = "ftp_users.json"
+DEFAULT_PERM = "elradfmwMT"
+VALID_PERMS = set("elradfmwMT")
+HASH_ALGORITHM = "pbkdf2_sha256"
+HASH_ITERATIONS = 100_000  # ~60 ms por verificación: el cache evita pagarlo en cada login
+RELOAD_CHECK = 2  # segundos mínimos entre revisiones del archivo
+CACHE_SIZE = 1024
+CACHE_TTL = 300  # segundos que vale una verificación cacheada
+
+
+def hash_password(password, iterations=HASH_ITERATIONS):
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return "$".join((HASH_ALGORITHM, str(iterations),
+                     base64.b64encode(salt).decode(), base64.b64encode(digest).decode()))
+
+
+def check_password(password, encoded):
+    """Compara en tiempo constante contra un hash de hash_password"""
+    try:
+        algorithm, iterations, salt, digest = encoded.split("$")
+        if algorithm != HASH_ALGORITHM:
+            return False
+        expected = base64.b64decode(digest)
+        actual = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), base64.b64decode(salt), int(iterations))
+    except (ValueError, AttributeError):
+        return False
+    return hmac.compare_digest(actual, expected)
+
+
+@lru_cache(maxsize=1)
+def dummy_hash():
+    """Hash de una contraseña al azar: un usuario inexistente paga el mismo PBKDF2 que uno real"""
+    return hash_password(secrets.token_urlsafe(16))
+
+
+def validate_home(home):
+    """El directorio del usuario es relativo al de videos y no puede salir de él"""
+    path = PurePosixPath(home or "")
+    if path.is_absolute() or '..' in path.parts:
+        raise ValueError(f"El directorio {home!r} debe ser relativo al directorio de videos")
+    return "" if str(path) == "." else str(path)
+
+
+class CredentialStore:
+    """Usuarios del archivo JSON con verificación cacheada
+
+    El archivo se relee cuando cambia, así las altas y bajas llegan al
+    servidor y a todos los workers web sin reiniciar. El cache guarda el
+    resultado de cada (usuario, contraseña) reciente indexado por un HMAC
+    con una clave del proceso: la contraseña nunca queda en memoria.
+    """
+
+    def __init__(self, path=DEFAULT_FILE, cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL):
+        self.path = path
+        self.users = {}
+        self.mtime = None
+        self.checked = 0
+        self.cache = OrderedDict()  # HMAC -> (resultado, vencimiento)
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache_key = secrets.token_bytes(32)
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("DahuaFTPServer")
+        dummy_hash()  # al crear el store, no en el primer login de un usuario inexistente
+        if os.path.exists(path):
+            self.reload()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    # --- archivo
+
+    def reload(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        with self.lock:
+            self.users = data.get('users', {})
+            self.mtime = os.stat(self.path).st_mtime_ns
+            self.cache.clear()
+
+    def maybe_reload(self):
+        """Relee el archivo si cambió; devuelve True si lo hizo"""
+        if time.monotonic() - self.checked < RELOAD_CHECK:
+            return False
+        self.checked = time.monotonic()
+        try:
+            if os.stat(self.path).st_mtime_ns == self.mtime:
+                return False
+            self.reload()
+            return True
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Error leyendo {self.path}: {e}")
+            return False
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        # Solo el dueño puede leer los hashes
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'users': self.users}, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+        self.mtime = os.stat(self.path).st_mtime_ns
+
+    # --- usuarios
+
+    def add_user(self, username, password, home="", perm=DEFAULT_PERM):
+        if username in self.users:
+            raise ValueError(f"El usuario {username} ya existe")
+        if not username or username == "anonymous":
+            raise ValueError(f"Nombre de usuario inválido: {username!r}")
+        invalid = set(perm) - VALID_PERMS
+        if invalid:
+            raise ValueError(f"Permisos desconocidos: {''.join(sorted(invalid))}")
+        self.users[username] = {'hash': hash_password(password), 'home': validate_home(home), 'perm': perm}
+        self.save()
+
+    def set_password(self, username, password):
+        self.users[username]['hash'] = hash_password(password)
+        self.save()
+
+    def remove_user(self, username):
+        del self.users[username]
+        self.save()
+
+    # --- verificación
+
+    def verify(self, username, password):
+        """Verifica contra el hash; aciertos y fallos quedan en el cache
+
+        Un usuario inexistente se verifica contra dummy_hash() y se cachea
+        igual: el tiempo de respuesta no revela qué usuarios existen.
+        """
+        self.maybe_reload()
+        user = self.users.get(username)
+        encoded = user['hash'] if user is not None else dummy_hash()
+        key = self.cache_key_for(username, encoded, password)
+        cached = self.lookup(key)
+        if cached is not None:
+            return cached
+        result = check_password(password, encoded) and user is not None
+        with self.lock:
+            self.cache[key] = (result, time.monotonic() + self.cache_ttl)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    def cached(self, username, password):
+        """Resultado cacheado de verify, o None si habría que calcular el hash"""
+        user = self.users.get(username)
+        encoded = user['hash'] if user is not None else dummy_hash()
+        return self.lookup(self.cache_key_for(username, encoded, password))
+
+    def cache_key_for(self, username, encoded, password):
+        return hmac.new(self.cache_key, f"{username}\0{encoded}\0{password}".encode('utf-8'), hashlib.sha256).digest()
+
+    def lookup(self, key):
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is None or cached[1] <= time.monotonic():
+                return None
+            self.cache.move_to_end(key)
+            return cached[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Administra los usuarios del servidor FTP y del cliente web")
+    parser.add_argument('--file', default=DEFAULT_FILE, help=f"Archivo de usuarios (default: {DEFAULT_FILE})")
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('add', help="Agregar un usuario")
+    add.add_argument('username')
+    add.add_argument('--home', default="", help="Directorio relativo al de videos (default: el de videos)")
+    add.add_argument('--perm', default=DEFAULT_PERM, help=f"Permisos de pyftpdlib (default: {DEFAULT_PERM})")
+    passwd = commands.add_parser('passwd', help="Cambiar la contraseña de un usuario")
+    passwd.add_argument('username')
+    remove = commands.add_parser('remove', help="Borrar un usuario")
+    remove.add_argument('username')
+    commands.add_parser('list', help="Listar los usuarios")
+    args = parser.parse_args()
+
+    store = CredentialStore(args.file)
+    try:
+        if args.command == 'list':
+            for name, user in sorted(store.users.items()):
+                print(f"{name}\thome={user['home'] or '.'}\tperm={user['perm']}")
+        elif args.command == 'remove':
+            store.remove_user(args.username)
+        else:
+            if args.command == 'passwd' and args.username not in store.users:
+                raise KeyError(args.username)
+            password = getpass.getpass("Contraseña: ")
+            if password != getpass.getpass("Repetir contraseña: "):
+                print("Las contraseñas no coinciden")
+                return 1
+            if args.command == 'add':
+                store.add_user(args.username, password, args.home, args.perm)
+            else:
+                store.set_password(args.username, password)
+    except KeyError as e:
+        print(f"No existe el usuario {e}")
+        return 1
+    except ValueError as e:
+        print(e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
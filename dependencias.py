@@ -11,9 +11,14 @@ import subprocess
 requirements = [
     "pyftpdlib",
     "flask",
-    "psutil"
+    "psutil",
+    "waitress",
 ]
 
+# Servidor de producción multiproceso (no disponible en Windows)
+if sys.platform != "win32":
+    requirements.append("gunicorn")
+
 def install(package):
     """Instala un paquete usando pip"""
     print(f"Instalando {package}...")
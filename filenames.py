@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Parser de nombres de archivo de DVR
+Patrones precompilados, fechas armadas sin strptime y caché LRU por nombre
+"""
+
+import re
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+CACHE_SIZE = 8192
+PART_SUFFIX = ".part"  # upload en curso o cortado, a la espera de un REST
+
+# Ejemplo: Casa_ch1_main_20250624000000_20250624010000.dav
+DAHUA_PATTERN = r'^(?P<camera>.*?)_ch(?P<channel>\d+)_(?P<stream>[A-Za-z]+)_(?P<start>\d{14})_(?P<end>\d{14})'
+# Cualquier nombre con una fecha AAAAMMDDhhmmss
+GENERIC_PATTERN = r'(?P<start>\d{14})'
+DEFAULT_PATTERNS = (DAHUA_PATTERN, GENERIC_PATTERN)
+
+_patterns = ()
+
+
+class VideoName(NamedTuple):
+    camera: Optional[str]
+    channel: Optional[int]
+    stream: Optional[str]
+    start: datetime
+    end: Optional[datetime]
+
+
+def fast_datetime(digits):
+    """AAAAMMDDhhmmss -> datetime sin pasar por strptime"""
+    return datetime(int(digits[0:4]), int(digits[4:6]), int(digits[6:8]),
+                    int(digits[8:10]), int(digits[10:12]), int(digits[12:14]))
+
+
+def set_patterns(patterns):
+    """Reemplaza los patrones (en orden de prioridad); cada uno debe tener el grupo 'start'"""
+    global _patterns
+    compiled = []
+    for pattern in patterns:
+        regex = re.compile(pattern)
+        if 'start' not in regex.groupindex:
+            raise ValueError(f"El patrón {pattern!r} no tiene el grupo (?P<start>...)")
+        compiled.append(regex)
+    _patterns = tuple(compiled)
+    parse_video_name.cache_clear()
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_video_name(filename):
+    """Cámara, canal, stream e inicio/fin del nombre, o None si ningún patrón aplica"""
+    for regex in _patterns:
+        match = regex.search(filename)
+        if match is None:
+            continue
+        groups = match.groupdict()
+        try:
+            start = fast_datetime(groups['start'])
+            end = fast_datetime(groups['end']) if groups.get('end') else None
+        except ValueError:
+            continue
+        channel = groups.get('channel')
+        return VideoName(groups.get('camera'), int(channel) if channel else None,
+                         groups.get('stream'), start, end)
+    return None
+
+
+set_patterns(DEFAULT_PATTERNS)
+
+
+def legacy_parse(filename):
+    """El parser anterior (re.search + strptime), solo para comparar"""
+    match = re.search(r'(\d{8})(\d{6})', filename)
+    if match:
+        try:
+            return datetime.strptime(match.group(1) + match.group(2), "%Y%m%d%H%M%S")
+        except Exception:
+            return None
+    return None
+
+
+def benchmark(count=1_000_000, repeats=4):
+    """Compara el parser anterior con el nuevo, con y sin caché
+
+    Cada upload consulta su nombre varias veces seguidas (destino,
+    deduplicación, catálogo), así que cada nombre se repite 'repeats' veces.
+    """
+    base = datetime(2025, 1, 1)
+    workload = []
+    for i in range(count // repeats):
+        start = base + timedelta(minutes=i)
+        end = start + timedelta(seconds=59)
+        name = f"Casa_ch{i % 16 + 1}_main_{start:%Y%m%d%H%M%S}_{end:%Y%m%d%H%M%S}.dav"
+        workload.extend([name] * repeats)
+    count = len(workload)
+    print(f"=== {count} nombres ({count // repeats} distintos, {repeats} consultas por nombre) ===")
+
+    def run(label, func):
+        started = time.perf_counter()
+        for name in workload:
+            func(name)
+        elapsed = time.perf_counter() - started
+        print(f"{label:<28} {elapsed:7.2f} s  {count / elapsed / 1000:8.0f} k nombres/s")
+
+    run("anterior (strptime)", legacy_parse)
+    run("nuevo sin caché", parse_video_name.__wrapped__)
+    parse_video_name.cache_clear()
+    run("nuevo con caché", parse_video_name)
+    info = parse_video_name.cache_info()
+    print(f"Caché: {info.hits} aciertos, {info.misses} fallos")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parser de nombres de video DVR")
+    parser.add_argument('names', nargs='*', help="Nombres a interpretar")
+    parser.add_argument('--pattern', action='append', help="Patrón regex adicional con grupos nombrados (start obligatorio)")
+    parser.add_argument('--bench', type=int, metavar='N', help="Microbenchmark sobre N nombres")
+    args = parser.parse_args()
+    if args.pattern:
+        set_patterns(args.pattern + list(DEFAULT_PATTERNS))
+    if args.bench:
+        benchmark(args.bench)
+    for name in args.names:
+        print(f"{name}: {parse_video_name(name)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
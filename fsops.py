@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Operaciones de archivos del pipeline de ingesta
+Caché de directorios creados, movimientos con rename y fsync en lotes
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+
+
+class FileOps:
+    """Capa mínima de sistema de archivos compartida por todos los uploads"""
+
+    def __init__(self, fsync_interval=0, max_dirs=4096):
+        self.fsync_interval = fsync_interval
+        self.max_dirs = max_dirs
+        self.known_dirs = {}  # directorio -> st_dev
+        self.pending_sync = []
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.running = False
+        self.logger = logging.getLogger("DahuaFTPServer")
+
+    def ensure_dir(self, directory):
+        """Crea el directorio la primera vez; después es una búsqueda en memoria"""
+        directory = os.fspath(directory)
+        dev = self.known_dirs.get(directory)
+        if dev is None:
+            os.makedirs(directory, exist_ok=True)
+            dev = os.stat(directory).st_dev
+            if len(self.known_dirs) >= self.max_dirs:
+                self.known_dirs.clear()
+            self.known_dirs[directory] = dev
+        return dev
+
+    def forget(self, directory):
+        """La retención borró el directorio: la próxima vez se vuelve a crear"""
+        self.known_dirs.pop(os.fspath(directory), None)
+
+    def move(self, source, target, source_stat=None):
+        """rename si origen y destino están en el mismo disco; si no, copia y borra"""
+        target_dev = self.ensure_dir(os.path.dirname(target))
+        source_dev = (source_stat or os.stat(source)).st_dev
+        if source_dev == target_dev:
+            try:
+                os.replace(source, target)
+                return
+            except FileNotFoundError:
+                # Directorio borrado por la retención desde que se cacheó
+                self.forget(os.path.dirname(target))
+                self.ensure_dir(os.path.dirname(target))
+                os.replace(source, target)
+                return
+        shutil.move(os.fspath(source), os.fspath(target))
+
+    # --- fsync en lotes
+
+    def sync(self, path):
+        """Pide durabilidad para un archivo terminado (se aplica en el próximo lote)"""
+        if self.fsync_interval > 0:
+            with self.lock:
+                self.pending_sync.append(os.fspath(path))
+
+    def start(self):
+        if self.fsync_interval > 0 and self.flusher is None:
+            self.running = True
+            self.flusher = threading.Thread(target=self._flush_loop, name="fsync", daemon=True)
+            self.flusher.start()
+
+    def stop(self):
+        self.running = False
+        if self.flusher is not None:
+            self.flusher.join(self.fsync_interval + 5)
+            self.flusher = None
+        self.flush()
+
+    def flush(self):
+        """fsync de los archivos pendientes y una sola vez de cada directorio"""
+        with self.lock:
+            paths, self.pending_sync = self.pending_sync, []
+        if not paths:
+            return 0
+        directories = set()
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                directories.add(os.path.dirname(path))
+            except OSError:
+                continue
+        # En Windows no se pueden abrir directorios: el rename ya quedó en el journal del FS
+        if os.name == "posix":
+            for directory in directories:
+                try:
+                    fd = os.open(directory, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError:
+                    continue
+        return len(paths)
+
+    def _flush_loop(self):
+        while self.running:
+            time.sleep(self.fsync_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error(f"Error en fsync por lotes: {e}")
+
+
+def benchmark(count=2000, directory=None):
+    """Costo por archivo de organizar un upload: pipeline anterior vs FileOps"""
+    root = Path(tempfile.mkdtemp(dir=directory))
+    payload = b'\0' * 4096
+
+    def prepare(tag):
+        files = []
+        for i in range(count):
+            path = root / f"{tag}_{i}.dav"
+            path.write_bytes(payload)
+            files.append(path)
+        return files
+
+    def run(label, organize, files):
+        # 100 archivos por directorio de día, rutas armadas fuera de la medición
+        jobs = [(path, root / "organized" / "2025" / "06" / f"{i // 100:02d}") for i, path in enumerate(files)]
+        started = time.perf_counter()
+        for path, day_dir in jobs:
+            organize(path, day_dir)
+        elapsed = time.perf_counter() - started
+        print(f"  {label:<10} {elapsed / count * 1e6:8.1f} µs/archivo")
+
+    def before(path, day_dir):
+        # Pipeline anterior: stat, mkdir(parents), shutil.move y otro stat
+        size = path.stat().st_size
+        day_dir.mkdir(parents=True, exist_ok=True)
+        new_path = day_dir / path.name
+        shutil.move(str(path), str(new_path))
+        return size, new_path.stat().st_size
+
+    ops = FileOps()
+
+    def after(path, day_dir):
+        # Un solo stat, directorio cacheado y rename
+        st = os.stat(path)
+        ops.move(path, os.path.join(day_dir, path.name), st)
+        return st.st_size
+
+    def mkdir_before(path, day_dir):
+        # STOR en streaming: directorio destino antes de abrir el .part
+        day_dir.mkdir(parents=True, exist_ok=True)
+
+    def mkdir_after(path, day_dir):
+        ops.ensure_dir(day_dir)
+
+    print(f"=== {count} archivos en {root} ===")
+    print("Organizar un archivo recibido:")
+    run("anterior", before, prepare("a"))
+    run("fsops", after, prepare("b"))
+    print("Preparar el directorio de un STOR:")
+    files = prepare("c")
+    run("anterior", mkdir_before, files)
+    run("fsops", mkdir_after, files)
+    shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Medición del costo de organizar uploads")
+    parser.add_argument('--count', type=int, default=2000, help="Archivos a mover (default: 2000)")
+    parser.add_argument('--dir', default=None, help="Directorio donde medir, idealmente el disco de videos")
+    args = parser.parse_args()
+    benchmark(args.count, args.dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
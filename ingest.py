@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Ingesta en streaming para el servidor FTP Dahua
+Calcula checksum, tamaño y tipo de contenedor mientras llegan los bytes,
+de modo que al terminar el upload solo queda renombrar y registrar
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from pyftpdlib.filesystems import AbstractedFS
+
+HEADER_BYTES = 16
+HASH_CHUNK = 1024 * 1024
+MAX_SUSPENDED = 256  # uploads cortados cuyo hash parcial se guarda para el REST
+
+# Firmas de los primeros bytes de cada contenedor
+CONTAINER_SIGNATURES = (
+    ('dav', 0, b'DHAV'),
+    ('mp4', 4, b'ftyp'),
+    ('avi', 8, b'AVI '),
+    ('mkv', 0, b'\x1a\x45\xdf\xa3'),
+    ('flv', 0, b'FLV'),
+    ('wmv', 0, b'\x30\x26\xb2\x75'),
+)
+
+
+def detect_container(header):
+    """Tipo de contenedor según la cabecera, o None si no se reconoce"""
+    for name, offset, magic in CONTAINER_SIGNATURES:
+        if header[offset:offset + len(magic)] == magic:
+            return name
+    return None
+
+
+def new_hasher():
+    return hashlib.blake2b(digest_size=16)
+
+
+def hash_prefix(f, limit=None):
+    """Hash, tamaño y cabecera de los primeros limit bytes (None: todo) de un archivo abierto"""
+    hasher = new_hasher()
+    header = b''
+    size = 0
+    while limit is None or size < limit:
+        chunk = f.read(HASH_CHUNK if limit is None else min(HASH_CHUNK, limit - size))
+        if not chunk:
+            break
+        hasher.update(chunk)
+        if len(header) < HEADER_BYTES:
+            header += chunk[:HEADER_BYTES - len(header)]
+        size += len(chunk)
+    return hasher, size, header
+
+
+class IngestFile:
+    """Envuelve el archivo destino y procesa cada bloque al escribirlo"""
+
+    def __init__(self, file, hasher=None, size=0, header=b'', suspended=None, deferred=False):
+        self.file = file
+        self.hasher = hasher or new_hasher()
+        self.size = size
+        self.header = header
+        self.suspended = suspended
+        self.resumed = size > 0
+        # El tramo previo no se hasheó: el archivo completo se lee al cerrar, fuera del loop
+        self.deferred = deferred
+
+    def write(self, data):
+        if not self.deferred:
+            self.hasher.update(data)
+            if len(self.header) < HEADER_BYTES:
+                self.header += data[:HEADER_BYTES - len(self.header)]
+        self.size += len(data)
+        return self.file.write(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """REST: el hash sigue desde el tramo ya recibido
+
+        El servidor lo calcula antes en un hilo (IngestFS.prehash); si el
+        archivo cambió desde entonces el checksum queda para el cierre.
+        """
+        if whence == os.SEEK_SET and self.size == 0 and offset:
+            self.resumed = True
+            state = self.suspended
+            if state is not None and state.matches(self.file, offset):
+                # Mismo archivo y mismo punto del corte: el hash sigue desde ahí
+                self.hasher, self.size, self.header = state.hasher, state.size, state.header
+            else:
+                self.size, self.deferred = offset, True
+        return self.file.seek(offset, whence)
+
+    @property
+    def checksum(self):
+        return self.hasher.hexdigest()
+
+    @property
+    def container(self):
+        return detect_container(self.header)
+
+    def __getattr__(self, name):
+        # name, closed, close, fileno... los resuelve el archivo real
+        return getattr(self.file, name)
+
+
+class SuspendedIngest:
+    """Hash de los primeros size bytes de un upload, válido mientras el archivo no cambie"""
+
+    def __init__(self, hasher, size, header, mtime_ns):
+        self.hasher = hasher
+        self.size = size
+        self.header = header
+        self.mtime_ns = mtime_ns
+
+    def valid(self, st, offset):
+        return offset == self.size <= st.st_size and st.st_mtime_ns == self.mtime_ns
+
+    def matches(self, file, offset):
+        return self.valid(os.fstat(file.fileno()), offset)
+
+
+class IngestFS(AbstractedFS):
+    """Sistema de archivos que entrega un IngestFile en cada escritura"""
+
+    # Compartido entre conexiones: el DVR reanuda en una sesión nueva
+    suspended = OrderedDict()
+    suspended_lock = threading.Lock()
+
+    def __init__(self, root, cmd_channel):
+        super().__init__(root, cmd_channel)
+        self.ingests = {}
+
+    def open(self, filename, mode):
+        if 'r' in mode and '+' not in mode:
+            return super().open(filename, mode)
+        try:
+            file = super().open(filename, mode)
+        except FileNotFoundError:
+            # La retención pudo borrar un directorio que el servidor tenía cacheado
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            file = super().open(filename, mode)
+        suspended = self.take_suspended(file.name) if ('a' in mode or '+' in mode) else None
+        if 'a' in mode:
+            # APPE: el servidor hashea antes lo existente en un hilo (prehash); si
+            # el archivo cambió desde entonces el checksum queda para el cierre
+            existing = os.fstat(file.fileno()).st_size
+            if suspended is not None and suspended.matches(file, existing):
+                ingest = IngestFile(file, suspended.hasher, suspended.size, suspended.header)
+            else:
+                ingest = IngestFile(file, size=existing, deferred=existing > 0)
+        else:
+            ingest = IngestFile(file, suspended=suspended)
+        self.ingests[file.name] = ingest
+        return ingest
+
+    def pop_ingest(self, filename):
+        return self.ingests.pop(filename, None)
+
+    @classmethod
+    def suspend(cls, filename, ingest):
+        """Guarda el hash de un upload cortado para no releerlo en el REST"""
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return
+        if ingest.deferred or st.st_size != ingest.size:
+            return
+        cls.store_suspended(filename, SuspendedIngest(ingest.hasher, ingest.size, ingest.header, st.st_mtime_ns))
+
+    @classmethod
+    def store_suspended(cls, filename, state):
+        with cls.suspended_lock:
+            cls.suspended[filename] = state
+            cls.suspended.move_to_end(filename)
+            while len(cls.suspended) > MAX_SUSPENDED:
+                cls.suspended.popitem(last=False)
+
+    @classmethod
+    def take_suspended(cls, filename):
+        with cls.suspended_lock:
+            return cls.suspended.pop(filename, None)
+
+    @classmethod
+    def resume_ready(cls, filename, offset=None):
+        """True si reanudar desde offset (None: el final) no necesita releer el archivo"""
+        with cls.suspended_lock:
+            state = cls.suspended.get(filename)
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            return True
+        if st.st_size == 0:
+            return True
+        return state is not None and state.valid(st, st.st_size if offset is None else offset)
+
+    @classmethod
+    def prehash(cls, filename, offset=None):
+        """Hashea lo ya recibido (fuera del loop) y lo deja listo para el open del REST/APPE
+
+        Cubre los uploads cortados en otro worker o antes de un reinicio,
+        de los que este proceso no guardó el hash.
+        """
+        st = os.stat(filename)
+        with open(filename, 'rb') as f:
+            hasher, size, header = hash_prefix(f, offset)
+        if os.stat(filename).st_mtime_ns == st.st_mtime_ns:
+            cls.store_suspended(filename, SuspendedIngest(hasher, size, header, st.st_mtime_ns))
+
+    @staticmethod
+    def hash_existing(filename):
+        with open(filename, 'rb') as f:
+            return hash_prefix(f)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Estructura de directorios de los videos organizados
+Plantillas como organized/{camera}/{channel}/{Y}/{m}/{d} y migración de un árbol existente
+"""
+
+import os
+import re
+import sys
+import argparse
+from datetime import date
+from pathlib import Path, PurePosixPath
+from filenames import parse_video_name, PART_SUFFIX
+from catalog import VIDEO_EXTENSIONS, COLD_TIER, make_record
+
+LAYOUTS = {
+    'date': "organized/{Y}/{m}/{d}",
+    'channel': "organized/{camera}/{channel}/{Y}/{m}/{d}",
+}
+DEFAULT_LAYOUT = LAYOUTS['date']
+DAY_SUFFIX = ("{Y}", "{m}", "{d}")
+FIELDS = ('camera', 'channel', 'stream')
+UNSAFE_CHARS = re.compile(r'[^\w.-]')
+
+
+def resolve_layout(layout):
+    """Nombre de layout o plantilla -> plantilla validada"""
+    template = LAYOUTS.get(layout, layout)
+    parts = PurePosixPath(template).parts
+    if parts[-3:] != DAY_SUFFIX or '..' in parts or PurePosixPath(template).is_absolute():
+        raise ValueError(f"El layout {layout!r} debe ser relativo y terminar en {{Y}}/{{m}}/{{d}}")
+    for part in parts[:-3]:
+        if part.startswith('{') and part.strip('{}') not in FIELDS:
+            raise ValueError(f"Campo desconocido en el layout: {part}")
+    return template
+
+
+def prefix_parts(template):
+    """Componentes antes de {Y}/{m}/{d}: texto fijo o nombre de campo"""
+    return [(part.strip('{}'), True) if part.startswith('{') else (part, False)
+            for part in PurePosixPath(template).parts[:-3]]
+
+
+def safe_component(value):
+    """Un valor del nombre convertido en un nombre de directorio válido"""
+    if value is None:
+        return "_"
+    value = UNSAFE_CHARS.sub('_', str(value))
+    return value if value.strip('.') else "_"
+
+
+def layout_dir(template, info):
+    """Directorio relativo (al lugar de subida) para un VideoName"""
+    start = info.start
+    return template.format(
+        camera=safe_component(info.camera), channel=safe_component(info.channel),
+        stream=safe_component(info.stream),
+        Y=f"{start.year:04d}", m=f"{start.month:02d}", d=f"{start.day:02d}")
+
+
+def prefix_dirs(parent, parts, values=None):
+    """Directorios que preceden a YYYY/MM/DD según el layout, con los valores de sus campos"""
+    values = values or {}
+    if not parts:
+        yield parent, values
+        return
+    (name, is_field), rest = parts[0], parts[1:]
+    if not is_field:
+        if (parent / name).is_dir():
+            yield from prefix_dirs(parent / name, rest, values)
+        return
+    with os.scandir(parent) as entries:
+        children = [Path(e.path) for e in entries if e.is_dir(follow_symlinks=False)]
+    for child in children:
+        yield from prefix_dirs(child, rest, dict(values, **{name: child.name}))
+
+
+def numeric_dirs(parent, width):
+    try:
+        with os.scandir(parent) as entries:
+            return sorted(Path(e.path) for e in entries
+                          if e.is_dir(follow_symlinks=False) and len(e.name) == width and e.name.isdigit())
+    except FileNotFoundError:
+        return []
+
+
+def iter_day_dirs(root, template):
+    """(directorio del día, fecha, valores de los campos) de cada YYYY/MM/DD del layout, del más viejo al más nuevo"""
+    if not Path(root).is_dir():
+        return
+    for base_dir, values in prefix_dirs(Path(root), prefix_parts(template)):
+        for year_dir in numeric_dirs(base_dir, 4):
+            for month_dir in numeric_dirs(year_dir, 2):
+                for day_dir in numeric_dirs(month_dir, 2):
+                    try:
+                        day = date(int(year_dir.name), int(month_dir.name), int(day_dir.name))
+                    except ValueError:
+                        continue
+                    yield day_dir, day, values
+
+
+def layout_base(rel_dir, templates):
+    """Lugar de subida (relativo) de un directorio de día de alguna de las plantillas, o None si no es uno"""
+    for template in templates:
+        parts = PurePosixPath(template).parts
+        if len(rel_dir.parts) < len(parts):
+            continue
+        for pattern, actual in zip(parts, rel_dir.parts[-len(parts):]):
+            if pattern in DAY_SUFFIX:
+                if not (actual.isdigit() and len(actual) == (4 if pattern == "{Y}" else 2)):
+                    break
+            elif not pattern.startswith('{') and pattern != actual:
+                break
+        else:
+            return Path(*rel_dir.parts[:-len(parts)])
+    return None
+
+
+def relayout(video_dir, template, catalog=None, dry_run=False, batch_size=500, current=DEFAULT_LAYOUT, cold_dir=None):
+    """Mueve en el lugar los videos del directorio a la plantilla indicada
+
+    Se recorre todo el directorio de videos (y el del tier frío, con la
+    misma ruta relativa por archivo): lo organizado con el layout current
+    (o alguno de LAYOUTS) se mueve respecto de su lugar de subida, y los
+    videos sueltos respecto de su directorio, como los organizaría el
+    servidor. Cada archivo se renombra dentro del mismo disco y su fila
+    del catálogo cambia de ruta (los sueltos se agregan); se puede
+    interrumpir y volver a ejecutar.
+    """
+    templates = [current] + [t for t in (*LAYOUTS.values(), template) if t != current]
+    result = {'moved': 0, 'loose': 0, 'skipped': 0, 'conflicts': 0}
+    for video_root, tier in ((Path(video_dir), None), (Path(cold_dir) if cold_dir else None, COLD_TIER)):
+        if video_root is not None and video_root.is_dir():
+            relayout_root(video_root, tier, template, templates, result, catalog, dry_run, batch_size)
+    return result
+
+
+def relayout_root(video_root, tier, template, templates, result, catalog, dry_run, batch_size):
+    """relayout de un tier; tier es el valor de la columna para las filas nuevas"""
+    updates = []
+    records = []
+    emptied = set()
+    for root, _dirs, files in os.walk(video_root):
+        directory = Path(root)
+        base = layout_base(directory.relative_to(video_root), templates)
+        base = video_root / base if base is not None else None
+        for name in files:
+            if name.endswith(PART_SUFFIX) or os.path.splitext(name)[1].lower() not in VIDEO_EXTENSIONS:
+                continue
+            source = directory / name
+            info = parse_video_name(name)
+            if info is None:
+                print(f"Sin fecha en el nombre, se deja en su lugar: {source}")
+                result['skipped'] += 1
+                continue
+            target = (base or directory) / layout_dir(template, info) / name
+            if target == source:
+                continue
+            if target.exists():
+                print(f"Ya existe, se deja en su lugar: {source}")
+                result['conflicts'] += 1
+                continue
+            if not dry_run:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                size = source.stat().st_size
+                os.rename(source, target)
+                rel_path = target.relative_to(video_root).as_posix()
+                updates.append((rel_path, source.relative_to(video_root).as_posix()))
+                if base is None:
+                    # Nunca se organizó: puede no tener fila en el catálogo
+                    records.append(make_record(rel_path, size, received_at=target.stat().st_mtime, tier=tier))
+                else:
+                    emptied.add((directory, base))
+                if catalog is not None and len(updates) >= batch_size:
+                    catalog.rename_paths(updates)
+                    catalog.insert_many(records)
+                    updates, records = [], []
+            result['moved'] += 1
+            result['loose'] += base is None
+    if catalog is not None and updates:
+        catalog.rename_paths(updates)
+        catalog.insert_many(records)
+    for directory, base in sorted(emptied, key=lambda item: len(item[0].parts), reverse=True):
+        remove_empty_parents(directory, base)
+
+
+def remove_empty_parents(directory, base):
+    """Sube desde directory hasta base (sin incluirlo) borrando los directorios vacíos"""
+    while directory != base and base in directory.parents:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = directory.parent
+
+
+def main():
+    from catalog import VideoCatalog, DEFAULT_DB
+    parser = argparse.ArgumentParser(description="Reorganiza los videos a otro layout de directorios")
+    parser.add_argument('layout', help=f"Nombre ({', '.join(LAYOUTS)}) o plantilla, ej. {LAYOUTS['channel']}")
+    parser.add_argument('--video-dir', default="dahua_videos", help="Directorio de videos (default: dahua_videos)")
+    parser.add_argument('--from-layout', default='date', help="Layout actual de los videos, el del servidor hasta ahora (default: date)")
+    parser.add_argument('--cold-dir', help="Directorio del tier frío, el mismo del servidor (default: ninguno)")
+    parser.add_argument('--db', default=DEFAULT_DB, help=f"Catálogo a actualizar (default: {DEFAULT_DB})")
+    parser.add_argument('--dry-run', action='store_true', help="Solo contar lo que se movería")
+    args = parser.parse_args()
+
+    template = resolve_layout(args.layout)
+    current = resolve_layout(args.from_layout)
+    catalog = VideoCatalog(args.db) if not args.dry_run else None
+    print(f"Reorganizando {args.video_dir}{' y ' + args.cold_dir if args.cold_dir else ''} con {template}...")
+    result = relayout(args.video_dir, template, catalog, dry_run=args.dry_run, current=current,
+                      cold_dir=args.cold_dir)
+    print(f"- {result['moved']} movidos ({result['loose']} sin organizar), {result['conflicts']} en conflicto, "
+          f"{result['skipped']} sin fecha en el nombre")
+    print("Iniciar el servidor con el mismo --layout para que los nuevos uploads lo sigan")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Métricas en formato de texto de Prometheus para el servidor FTP y el cliente web
+Sin dependencias: contadores, gauges e histogramas en memoria que se
+pueden sumar entre procesos a partir de snapshots
+"""
+
+import math
+import threading
+
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    """Registro de métricas de un proceso"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.descriptions = {}  # nombre -> (tipo, ayuda, buckets)
+        self.values = {}  # (nombre, etiquetas) -> valor o [buckets..., suma, cantidad]
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self.descriptions[name] = (kind, help_text, tuple(buckets) if buckets else None)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self.descriptions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def snapshot(self):
+        """Copia serializable (pickle/JSON) de todos los valores"""
+        with self.lock:
+            return [[name, [list(item) for item in labels], list(value) if isinstance(value, list) else value]
+                    for (name, labels), value in self.values.items()]
+
+    def merge(self, snapshot):
+        """Suma un snapshot de otro proceso (contadores, gauges e histogramas)"""
+        with self.lock:
+            for name, labels, value in snapshot:
+                key = (name, tuple(tuple(item) for item in labels))
+                current = self.values.get(key)
+                if isinstance(value, list):
+                    self.values[key] = [a + b for a, b in zip(current, value)] if current else list(value)
+                else:
+                    self.values[key] = (current or 0) + value
+
+    def combine(self, snapshots):
+        """Registro nuevo con las mismas descripciones y la suma de los snapshots"""
+        combined = Metrics()
+        combined.descriptions = dict(self.descriptions)
+        for snapshot in snapshots:
+            combined.merge(snapshot)
+        return combined
+
+    def render(self):
+        """Texto de exposición de Prometheus (versión 0.0.4)"""
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = []
+        described = set()
+        for (name, labels), value in values:
+            kind, help_text, buckets = self.descriptions.get(name, ('untyped', '', None))
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+            if kind == 'histogram':
+                for bound, count in zip(buckets + (math.inf,), value[:-2] + [value[-1]]):
+                    le = '+Inf' if bound == math.inf else format_value(bound)
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(value[-2])}")
+                lines.append(f"{name}_count{format_labels(labels)} {value[-1]}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
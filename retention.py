@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Motor de retención de videos del servidor FTP Dahua
+Borra días completos de organized/YYYY/MM/DD (en el tier caliente y en el
+frío) y usa el catálogo para la retención por canal y para liberar disco
+por marca de agua
+"""
+
+import os
+import time
+import shutil
+import logging
+from datetime import datetime, timedelta
+from pathlib import Path, PurePosixPath
+from layout import DEFAULT_LAYOUT, prefix_parts, iter_day_dirs
+
+
+class RetentionEngine:
+    """Retención con costo proporcional a lo que se borra, no al archivo completo"""
+
+    def __init__(self, video_dir, catalog, keep_days=3, channel_keep_days=None, max_disk_percent=0, disk_margin=5, layout=DEFAULT_LAYOUT, cold_dir=None):
+        self.video_dir = Path(video_dir)
+        self.cold_dir = Path(cold_dir) if cold_dir else None
+        self.roots = [self.video_dir] + ([self.cold_dir] if self.cold_dir else [])
+        self.layout = layout
+        self.layout_prefix = prefix_parts(layout)
+        self.catalog = catalog
+        self.keep_days = keep_days
+        self.channel_keep_days = channel_keep_days or {}
+        self.max_disk_percent = max_disk_percent
+        self.disk_margin = disk_margin
+        self.logger = logging.getLogger("DahuaFTPServer")
+
+    def run(self, now=None):
+        """Ejecuta todas las reglas y devuelve lo liberado"""
+        now = now or datetime.now()
+        result = {'files': 0, 'bytes': 0, 'days': 0}
+        cutoff = now - timedelta(days=self.keep_days)
+        # Canales que conservan más que el global: sus días no se pueden borrar enteros
+        longer = [ch for ch, days in self.channel_keep_days.items() if days > self.keep_days]
+        self.expire_day_dirs(now, result, longer)
+        self.expire_catalog(cutoff.isoformat(), result, exclude_channels=longer)
+        for channel, days in self.channel_keep_days.items():
+            self.expire_catalog((now - timedelta(days=days)).isoformat(), result, channel=channel)
+        self.expire_loose_files(cutoff.timestamp(), result)
+        if self.max_disk_percent:
+            self.enforce_disk_limit(result)
+        return result
+
+    def expire_day_dirs(self, now, result, longer=()):
+        """Borra de una vez los directorios YYYY/MM/DD del layout anteriores al corte
+
+        Con {channel} en el layout cada canal tiene sus propios días y usa
+        su propio corte; si no, solo se borran días enteros cuando ningún
+        canal conserva más que el global. Se recorren los dos tiers.
+        """
+        per_channel = ('channel', True) in self.layout_prefix
+        if longer and not per_channel:
+            return
+        for root in self.roots:
+            for day_dir, day, values in iter_day_dirs(root, self.layout):
+                days = self.keep_days
+                if per_channel and values['channel'].isdigit():
+                    days = self.channel_keep_days.get(int(values['channel']), self.keep_days)
+                if day >= (now - timedelta(days=days)).date():
+                    continue
+                # La ruta relativa es la misma en ambos tiers: una sola fila por archivo
+                count, size = self.catalog.delete_prefix(day_dir.relative_to(root).as_posix())
+                shutil.rmtree(day_dir, ignore_errors=True)
+                result['files'] += count
+                result['bytes'] += size
+                result['days'] += 1
+                self._remove_empty_parents(day_dir.parent, root)
+
+    def expire_catalog(self, before, result, channel=None, exclude_channels=()):
+        """Borra archivo por archivo las filas vencidas que quedan en el catálogo"""
+        while True:
+            rows = self.catalog.expired(before, channel=channel, exclude_channels=exclude_channels)
+            # Filas que quedaron (archivo en movimiento entre tiers) vuelven en la próxima pasada
+            if not rows or not self._delete_rows(rows, result):
+                return
+
+    def expire_loose_files(self, cutoff_ts, result):
+        """Archivos sueltos en la raíz (sin organizar) más viejos que el corte"""
+        with os.scandir(self.video_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        st = entry.stat()
+                        if st.st_mtime < cutoff_ts:
+                            os.unlink(entry.path)
+                            result['files'] += 1
+                            result['bytes'] += st.st_size
+                except FileNotFoundError:
+                    continue
+
+    def expire_partials(self, max_age, now=None):
+        """Borra los .part de uploads cortados que nadie reanudó en max_age segundos"""
+        now = now or time.time()
+        cutoff = now - max_age
+        result = {'files': 0, 'bytes': 0}
+        rows = self.catalog.stale_partials(cutoff)
+        cleared = []
+        for row in rows:
+            path = self.video_dir / PurePosixPath(row['path'])
+            try:
+                st = path.stat()
+                if st.st_mtime >= cutoff:
+                    # Se reanudó en otro worker o sigue escribiéndose: se revisa más tarde
+                    self.catalog.mark_partial(row['path'], st.st_size, updated_at=st.st_mtime, attempt=0)
+                    continue
+                path.unlink()
+                result['files'] += 1
+                result['bytes'] += st.st_size
+            except FileNotFoundError:
+                pass
+            cleared.append(row['path'])
+            self._remove_if_empty(path.parent)
+        self.catalog.clear_partials(cleared)
+        return result
+
+    def disk_percent(self):
+        usage = shutil.disk_usage(self.video_dir)
+        return usage.used / usage.total * 100
+
+    def enforce_disk_limit(self, result):
+        """Si el disco pasa la marca de agua, borra lo más viejo hasta bajar disk_margin puntos"""
+        if self.disk_percent() <= self.max_disk_percent:
+            return
+        target = self.max_disk_percent - self.disk_margin
+        # Con el tier frío en otro disco borrarlo no libera el de videos; en el mismo, sí
+        hot_only = self.cold_dir is not None and not self.same_device()
+        files = result['files']
+        while self.disk_percent() > target:
+            rows = self.catalog.oldest(100, hot_only=hot_only)
+            if not rows or not self._delete_rows(rows, result):
+                break
+        if result['files'] > files:
+            self.logger.warning(f"Marca de agua de disco superada ({self.max_disk_percent}%): se borraron "
+                                f"{result['files'] - files} videos, los más antiguos", extra={'event': 'cleanup'})
+        else:
+            self.logger.warning(f"Marca de agua de disco superada ({self.max_disk_percent}%) sin videos para borrar",
+                                extra={'event': 'cleanup'})
+
+    def same_device(self):
+        try:
+            return os.stat(self.video_dir).st_dev == os.stat(self.cold_dir).st_dev
+        except FileNotFoundError:
+            # Sin directorio frío todavía no hay filas frías que elegir
+            return True
+
+    def _delete_rows(self, rows, result):
+        """Borra el archivo de cada fila en todos los tiers y solo entonces la fila
+
+        Si ningún unlink tuvo éxito se vuelve a mirar cada tier: un
+        movimiento de tier concurrente puede haber corrido el archivo, y
+        esa fila se deja para la próxima pasada.
+        """
+        dirs = set()
+        deleted = []
+        for row in rows:
+            paths = [root / PurePosixPath(row['path']) for root in self.roots]
+            removed = False
+            for path in paths:
+                try:
+                    path.unlink()
+                    removed = True
+                    dirs.add(path.parent)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    self.logger.error(f"No se pudo borrar {path}: {e}")
+            if removed:
+                result['bytes'] += row['size']
+                result['files'] += 1
+            elif any(path.exists() for path in paths):
+                continue
+            deleted.append(row['path'])
+        self.catalog.delete_paths(deleted)
+        for directory in dirs:
+            self._remove_if_empty(directory)
+        return len(deleted)
+
+    def _remove_if_empty(self, directory):
+        try:
+            if Path(directory) not in self.roots:
+                os.rmdir(directory)
+        except OSError:
+            pass
+
+    def _remove_empty_parents(self, directory, root):
+        """Sube desde directory borrando mes, año y carpetas del layout que quedaron vacíos"""
+        directory = Path(directory)
+        while directory != root and root in directory.parents:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                return
+            directory = directory.parent
+
+
+def parse_channel_keep_days(value):
+    """Convierte '1=7,2=30' en {1: 7, 2: 30}"""
+    result = {}
+    for item in filter(None, (value or '').split(',')):
+        channel, days = item.split('=', 1)
+        result[int(channel)] = int(days)
+    return result
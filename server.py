@@ -6,76 +6,735 @@ Incluye funcionalidades de administración y organización automática
 
 import os
 import sys
+import copy
 import time
+import queue
+import json
+import socket
 import threading
 import logging
-from datetime import datetime
-from pathlib import Path
-from pyftpdlib.authorizers import DummyAuthorizer
-from pyftpdlib.handlers import FTPHandler
-from pyftpdlib.servers import FTPServer
+import logging.handlers
+import multiprocessing
 import shutil
-import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+from pathlib import Path, PurePosixPath
+from pyftpdlib.authorizers import DummyAuthorizer, AuthenticationFailed
+from pyftpdlib.handlers import FTPHandler, DTPHandler, ThrottledDTPHandler
+try:
+    from pyftpdlib.handlers import PassiveDTP
+except ImportError:
+    # pyftpdlib >= 2.0 movió las clases de conexión de datos
+    from pyftpdlib.handlers.ftp.dispatchers import PassiveDTP
+from pyftpdlib.servers import FTPServer, ThreadedFTPServer
+from pyftpdlib.ioloop import IOLoop
+from pyftpdlib.prefork import fork_processes, cpu_count
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from pyftpdlib.log import logger as ftp_logger
+from catalog import VideoCatalog, DEFAULT_DB, make_record
+from retention import RetentionEngine, parse_channel_keep_days
+from tiering import TieringEngine
+from ingest import IngestFS
+from filenames import parse_video_name, set_patterns, DEFAULT_PATTERNS, PART_SUFFIX
+from layout import DEFAULT_LAYOUT, resolve_layout, layout_dir
+from fsops import FileOps
+from shaping import UploadShaper, DEFAULT_LIVE_WINDOW
+from metrics import Metrics, DURATION_BUCKETS, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from credentials import CredentialStore, DEFAULT_FILE as DEFAULT_CREDENTIALS, DEFAULT_PERM
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro, con ip/usuario/evento si vienen en extra"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'event': getattr(record, 'event', None),
+            'ip': getattr(record, 'ip', None),
+            'user': getattr(record, 'user', None),
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que no pre-formatea: el traceback viaja aparte en exc_text
+
+    El prepare() de la librería mete el traceback dentro de msg y borra
+    exc_info, y JsonFormatter ya no puede separarlo en 'exception'.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # El traceback no se puede picklear (cola de multiprocessing): va como texto
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class PostProcessor:
+    """Cola acotada de post-procesamiento atendida por un pool de hilos
+
+    El loop de pyftpdlib solo encola; el trabajo de disco (stat, mover,
+    base de datos) corre en los hilos del pool. submit() nunca bloquea
+    ni ejecuta en el hilo llamador: max_queue es un límite blando que
+    full() usa para rechazar uploads nuevos con 451, y las tareas de los
+    uploads que ya estaban en curso se encolan igual por encima de él.
+    """
+
+    def __init__(self, workers=4, max_queue=1024, latency_window=1024):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.overflow = 0
+        self.max_depth = 0
+        self.wait_times = deque(maxlen=latency_window)
+        self.process_times = deque(maxlen=latency_window)
+        self.logger = logging.getLogger("DahuaFTPServer")
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"postproc-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.logger.info(f"Post-procesamiento: {self.workers} hilos, cola máxima {self.max_queue}")
+
+    def stop(self, timeout=30):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def submit(self, func, *args):
+        """Encola sin esperar; devuelve False si quedó por encima de max_queue"""
+        self.queue.put_nowait((time.monotonic(), func, args))
+        depth = self.queue.qsize()
+        with self.lock:
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, depth)
+            if depth > self.max_queue:
+                self.overflow += 1
+        return depth <= self.max_queue
+
+    def full(self):
+        return self.queue.qsize() >= self.max_queue
+
+    def _worker(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                self._run(task)
+            finally:
+                self.queue.task_done()
+
+    def _run(self, task):
+        enqueued, func, args = task
+        started = time.monotonic()
+        try:
+            func(*args)
+            ok = True
+        except Exception as e:
+            self.logger.error(f"Error en post-procesamiento: {e}")
+            ok = False
+        finished = time.monotonic()
+        with self.lock:
+            if ok:
+                self.processed += 1
+            else:
+                self.failed += 1
+            self.wait_times.append(started - enqueued)
+            self.process_times.append(finished - started)
+
+    @staticmethod
+    def _percentile(values, pct):
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def metrics(self):
+        """Devuelve profundidad de cola y latencias (ms) de las últimas tareas"""
+        with self.lock:
+            wait_times = list(self.wait_times)
+            process_times = list(self.process_times)
+            metrics = {
+                'workers': self.workers,
+                'queue_depth': self.queue.qsize(),
+                'queue_max': self.max_queue,
+                'queue_peak': self.max_depth,
+                'submitted': self.submitted,
+                'processed': self.processed,
+                'failed': self.failed,
+                'overflow': self.overflow,
+            }
+        for name, values in (('wait', wait_times), ('process', process_times)):
+            metrics[f'{name}_p50_ms'] = round(self._percentile(values, 50) * 1000, 2)
+            metrics[f'{name}_p95_ms'] = round(self._percentile(values, 95) * 1000, 2)
+            metrics[f'{name}_max_ms'] = round(max(values, default=0.0) * 1000, 2)
+        return metrics
+
+class LoopMonitor:
+    """Mide el retraso del IOLoop con un latido periódico
+
+    Si el loop está bloqueado (disco lento, trabajo en línea) el latido
+    llega tarde; la diferencia con la hora esperada es el lag.
+    """
+
+    # Sin timeout el primer poll del IOLoop espera actividad de red y el
+    # latido no corre; con este tope el error de medición es <= 100 ms
+    poll_timeout = 0.1
+
+    def __init__(self, ioloop, server, interval=1.0, on_beat=None):
+        self.ioloop = ioloop
+        self.server = server
+        self.interval = interval
+        self.on_beat = on_beat
+        self.lag = 0.0
+        self.lag_max = 0.0
+        self.last_beat = time.time()
+        self.expected = None
+
+    def start(self):
+        self._schedule()
+
+    def _schedule(self):
+        self.expected = time.monotonic() + self.interval
+        self.ioloop.call_later(self.interval, self._beat)
+
+    def _beat(self):
+        self.lag = max(0.0, time.monotonic() - self.expected)
+        self.lag_max = max(self.lag_max, self.lag)
+        self.last_beat = time.time()
+        if self.on_beat is not None:
+            self.on_beat(self)
+        self._schedule()
+
+    def connections(self):
+        return len(self.server.ip_map)
+
+METRICS_PUBLISH_INTERVAL = 5  # segundos entre snapshots de cada worker
+AUTH_POLL = 0.01  # segundos entre revisiones de una verificación de contraseña en curso
+RESUME_POLL = 0.05  # segundos entre revisiones del hash de un upload a reanudar
+PARTIAL_SWEEP_INTERVAL = 300  # segundos entre revisiones de uploads incompletos
+TIERING_INTERVAL = 3600  # segundos entre pasadas del tier frío
+TIERING_BUSY_QUEUE = 4  # con más tareas de post-procesamiento en cola la copia se pausa
+
+def ftp_metrics():
+    """Registro con las métricas del servidor FTP (rate() da bytes/s y archivos/s)"""
+    metrics = Metrics()
+    metrics.describe('dahua_ftp_upload_bytes_total', 'counter', 'Bytes recibidos por STOR, por canal')
+    metrics.describe('dahua_ftp_files_received_total', 'counter', 'Uploads completos, por canal')
+    metrics.describe('dahua_ftp_files_incomplete_total', 'counter', 'Uploads interrumpidos, por canal')
+    metrics.describe('dahua_ftp_uploads_resumed_total', 'counter', 'STOR/APPE que continúan un upload cortado')
+    metrics.describe('dahua_ftp_partials_expired_total', 'counter', 'Uploads cortados borrados sin haberse reanudado')
+    metrics.describe('dahua_ftp_throttled_seconds_total', 'counter', 'Tiempo que los uploads esperaron por los límites de subida, por prioridad')
+    metrics.describe('dahua_ftp_stor_duration_seconds', 'histogram', 'Duración de cada STOR', DURATION_BUCKETS)
+    metrics.describe('dahua_ftp_logins_total', 'counter', 'Intentos de login por resultado')
+    metrics.describe('dahua_ftp_sessions', 'gauge', 'Sesiones FTP abiertas')
+    metrics.describe('dahua_ftp_passive_ports_in_use', 'gauge', 'Puertos pasivos escuchando o con una transferencia')
+    metrics.describe('dahua_ftp_post_queue_depth', 'gauge', 'Tareas en la cola de post-procesamiento')
+    metrics.describe('dahua_ftp_loop_lag_seconds', 'gauge', 'Retraso del IOLoop en el último latido')
+    metrics.describe('dahua_ftp_cleanup_duration_seconds', 'gauge', 'Duración de la última limpieza')
+    metrics.describe('dahua_ftp_cleanup_files_total', 'counter', 'Archivos borrados por la retención')
+    metrics.describe('dahua_ftp_cleanup_bytes_total', 'counter', 'Bytes liberados por la retención')
+    metrics.describe('dahua_ftp_disk_free_bytes', 'gauge', 'Espacio libre en el disco de videos')
+    metrics.describe('dahua_ftp_disk_used_ratio', 'gauge', 'Fracción usada del disco de videos')
+    metrics.describe('dahua_ftp_tiering_files_total', 'counter', 'Archivos movidos al tier frío')
+    metrics.describe('dahua_ftp_tiering_bytes_total', 'counter', 'Bytes movidos al tier frío')
+    return metrics
+
+class MeteredPassiveDTP(PassiveDTP):
+    """PassiveDTP que cuenta los puertos pasivos en escucha"""
+
+    counted = False
+
+    def __init__(self, cmd_channel, extmode=False):
+        super().__init__(cmd_channel, extmode)
+        if cmd_channel.metrics is not None and not getattr(self, '_closed', False):
+            self.counted = True
+            cmd_channel.metrics.inc('dahua_ftp_passive_ports_in_use')
+
+    def close(self):
+        if self.counted:
+            self.counted = False
+            self.cmd_channel.metrics.inc('dahua_ftp_passive_ports_in_use', -1)
+        super().close()
+
+class MeteredDTPHandler(ThrottledDTPHandler):
+    """DTPHandler que cuenta las transferencias abiertas sobre un puerto pasivo
+
+    Además trata un RST durante un upload como transferencia incompleta:
+    pyftpdlib lo toma como fin normal y el segmento truncado se publicaría.
+    Los uploads pasan por los token buckets del UploadShaper (por IP, por
+    usuario y de backfill) y se pausan con el mismo mecanismo que
+    ThrottledDTPHandler.
+    """
+
+    counted = False
+    buckets = None
+    priority = None
+    # Solo se limitan los uploads: los RETR conservan sendfile
+    use_sendfile = DTPHandler.use_sendfile
+
+    def __init__(self, sock, cmd_channel):
+        super().__init__(sock, cmd_channel)
+        try:
+            passive = sock.getsockname()[1] in (cmd_channel.passive_ports or ())
+        except OSError:
+            passive = False
+        if passive and cmd_channel.metrics is not None:
+            self.counted = True
+            cmd_channel.metrics.inc('dahua_ftp_passive_ports_in_use')
+
+    def enable_receiving(self, type, cmd):
+        super().enable_receiving(type, cmd)
+        shaper = self.cmd_channel.shaper
+        if shaper is None or self.file_obj is None:
+            return
+        shaper.maybe_reload()
+        self.priority = shaper.classify(self.file_obj.name)
+        self.buckets = shaper.buckets_for(self.cmd_channel.remote_ip, self.cmd_channel.username, self.priority)
+        rates = [bucket.rate for bucket in self.buckets if bucket.rate]
+        if rates:
+            # Lecturas no más grandes que la tasa: flujo parejo en vez de ráfagas
+            while self.ac_in_buffer_size > max(min(rates), 4096):
+                self.ac_in_buffer_size //= 2
+
+    def recv(self, buffer_size):
+        chunk = super().recv(buffer_size)
+        if self.buckets and chunk and not self._closed:
+            delay = self.cmd_channel.shaper.consume(self.buckets, len(chunk))
+            if delay > 0:
+                self.pause(delay)
+        return chunk
+
+    def pause(self, delay):
+        """Saca el canal del IOLoop hasta que los buckets recuperen la deuda"""
+        def unsleep():
+            self.add_channel(events=self.ioloop.READ)
+
+        self.del_channel()
+        self._cancel_throttler()
+        self._throttler = self.ioloop.call_later(delay, unsleep, _errback=self.handle_error)
+        if self.cmd_channel.metrics is not None:
+            self.cmd_channel.metrics.inc('dahua_ftp_throttled_seconds_total', delay, priority=self.priority)
+
+    def handle_close(self):
+        # recv() llama a handle_close dentro de su except: si hay un error es un RST
+        if self.receive and not self._closed and isinstance(sys.exc_info()[1], OSError):
+            self._resp = (f"426 Transfer aborted; {int(self.get_transmitted_bytes())} bytes transmitted.", ftp_logger.debug)
+            self.close()
+            return
+        super().handle_close()
+
+    def close(self):
+        if self.counted:
+            self.counted = False
+            self.cmd_channel.metrics.inc('dahua_ftp_passive_ports_in_use', -1)
+        super().close()
+
+class HealthRequestHandler(BaseHTTPRequestHandler):
+    """GET /health (JSON), /metrics (Prometheus) y /shaping; POST /shaping cambia los límites"""
+
+    ftp_server = None
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/health':
+            body = json.dumps(self.ftp_server.health_snapshot()).encode()
+            content_type = 'application/json'
+        elif path == '/metrics':
+            body = self.ftp_server.render_metrics().encode()
+            content_type = METRICS_CONTENT_TYPE
+        elif path == '/shaping':
+            body = json.dumps(self.ftp_server.shaper.snapshot()).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_body(200, body, content_type)
+
+    def do_POST(self):
+        if self.path.split('?')[0] != '/shaping':
+            self.send_error(404)
+            return
+        # El endpoint puede escuchar en 0.0.0.0 para Prometheus: los cambios solo desde la máquina
+        if self.client_address[0] not in ('127.0.0.1', '::1'):
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            changes = json.loads(self.rfile.read(length) or b'{}')
+            status, result = self.ftp_server.update_shaping(changes)
+        except (ValueError, TypeError, AttributeError) as e:
+            status, result = 400, {'error': str(e)}
+        self.send_body(status, json.dumps(result).encode(), 'application/json')
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Los sondeos de salud no van al log del servidor
+        pass
+
+class StoreAuthorizer(DummyAuthorizer):
+    """Usuarios del CredentialStore, con su directorio dentro del de videos
+
+    La tabla de pyftpdlib (directorio y permisos) se rehace cuando el
+    archivo cambia; la contraseña se verifica siempre contra el hash.
+    """
+
+    def __init__(self, store, video_dir):
+        super().__init__()
+        self.store = store
+        self.video_dir = Path(video_dir)
+        self.refresh()
+
+    def refresh(self):
+        self.user_table = {name: user for name, user in self.user_table.items() if name == "anonymous"}
+        for name, user in self.store.users.items():
+            home = self.video_dir / user.get('home', '')
+            try:
+                home.mkdir(parents=True, exist_ok=True)
+                self.add_user(name, '', str(home), perm=user.get('perm', DEFAULT_PERM))
+            except (OSError, ValueError) as e:
+                logging.getLogger("DahuaFTPServer").error(f"Usuario {name} ignorado: {e}")
+
+    def validate_authentication(self, username, password, handler):
+        if self.store.maybe_reload():
+            self.refresh()
+        if username == "anonymous":
+            return super().validate_authentication(username, password, handler)
+        # verify primero: un usuario inexistente también paga el hash
+        if not self.store.verify(username, password) or not self.has_user(username):
+            raise AuthenticationFailed("Authentication failed.")
+
 
 class DahuaFTPHandler(FTPHandler):
     """Handler personalizado para manejar uploads de DVR Dahua"""
 
+    # --- logging estructurado: ip, usuario y tipo de evento como campos
+
+    def log_extra(self, msg):
+        word = msg.split(' ', 1)[0]
+        if msg.startswith('FTP session'):
+            event = 'connect' if 'opened' in msg else 'disconnect'
+        else:
+            event = word if word.isalpha() and word.isupper() else 'session'
+        return {'ip': self.remote_ip, 'user': self.username or None, 'event': event}
+
+    def log(self, msg, logfun=None):
+        prefix = self.log_prefix % self.__dict__
+        (logfun or ftp_logger.info)(f"{prefix} {msg}", extra=self.log_extra(msg))
+
+    def logline(self, msg, logfun=None):
+        if self._log_debug:
+            prefix = self.log_prefix % self.__dict__
+            (logfun or ftp_logger.debug)(f"{prefix} {msg}", extra=self.log_extra(msg))
+
+    def logerror(self, msg):
+        prefix = self.log_prefix % self.__dict__
+        ftp_logger.error(f"{prefix} {msg}", extra=self.log_extra(msg))
+
+    post_processor = None
+    catalog = None
+    video_root = None
+    cold_root = None
+    dedup_policy = "skip"
+    layout = DEFAULT_LAYOUT
+    fsops = FileOps()
+    metrics = None
+    shaper = None
+    abstracted_fs = IngestFS
+    passive_dtp = MeteredPassiveDTP
+    dtp_handler = MeteredDTPHandler
+    stor_started = None
+    auth_executor = None  # hilos donde se calcula el hash de las contraseñas
+    resume_executor = None  # hilos donde se hashea lo ya recibido de un upload a reanudar
+
+    # --- métricas: sesiones, logins y transferencias
+
+    def on_connect(self):
+        if self.metrics is not None:
+            self.metrics.inc('dahua_ftp_sessions')
+
+    def on_disconnect(self):
+        if self.metrics is not None:
+            self.metrics.inc('dahua_ftp_sessions', -1)
+
+    def on_login(self, username):
+        if self.metrics is not None:
+            self.metrics.inc('dahua_ftp_logins_total', result='ok')
+
+    def on_login_failed(self, username, password):
+        if self.metrics is not None:
+            self.metrics.inc('dahua_ftp_logins_total', result='failed')
+
+    def record_transfer(self, file, completed):
+        if self.metrics is None:
+            return
+        name = os.path.basename(file)
+        if name.endswith(PART_SUFFIX):
+            name = name[:-len(PART_SUFFIX)]
+        info = parse_video_name(name)
+        channel = str(info.channel) if info and info.channel is not None else ''
+        transferred = self.data_channel.get_transmitted_bytes() if self.data_channel is not None else 0
+        self.metrics.inc('dahua_ftp_upload_bytes_total', transferred, channel=channel)
+        if completed:
+            self.metrics.inc('dahua_ftp_files_received_total', channel=channel)
+        else:
+            self.metrics.inc('dahua_ftp_files_incomplete_total', channel=channel)
+        if self.stor_started is not None:
+            self.metrics.observe('dahua_ftp_stor_duration_seconds', time.monotonic() - self.stor_started,
+                                 result='complete' if completed else 'incomplete')
+            self.stor_started = None
+
+    def ingest_path(self, file):
+        """Destino final de un video según el layout (organized/...) junto a donde se subió"""
+        path = Path(file)
+        if not self.is_video_file(path):
+            return None
+        info = parse_video_name(path.name)
+        if info is None:
+            return None
+        return path.parent / layout_dir(self.layout, info) / path.name
+
+    def ftp_STOR(self, file, mode="w"):
+        # Los videos se escriben directo en su carpeta final con sufijo .part;
+        # al terminar solo hay que renombrar dentro del mismo directorio
+        final_path = self.ingest_path(file)
+        if final_path is not None:
+            try:
+                self.fsops.ensure_dir(final_path.parent)
+            except OSError as e:
+                self.respond(f"550 {e.strerror}.")
+                return
+            file = str(final_path) + PART_SUFFIX
+            if self._restart_position or mode == "a":
+                self.log(f"Reanudando upload {final_path.name} desde {self._restart_position or 'el final'}")
+                if self.metrics is not None:
+                    self.metrics.inc('dahua_ftp_uploads_resumed_total')
+        if self.post_processor is not None and self.post_processor.full():
+            # Backpressure: el DVR reintenta más tarde en vez de frenar el loop
+            self.respond("451 Post-procesamiento saturado, reintentar más tarde.")
+            return
+        offset = self._restart_position or None
+        if ((offset or mode == "a") and self.resume_executor is not None
+                and not IngestFS.resume_ready(file, offset)):
+            # Upload cortado en otro worker o antes de un reinicio: el tramo ya
+            # recibido se hashea en un hilo con el canal de control pausado
+            self.del_channel()
+            future = self.resume_executor.submit(IngestFS.prehash, file, offset)
+            self.ioloop.call_later(RESUME_POLL, self.resume_stor, future, file, mode, _errback=self.handle_error)
+            return
+        self.stor_started = time.monotonic()
+        return super().ftp_STOR(file, mode)
+
+    def resume_stor(self, future, file, mode):
+        if not future.done():
+            self.ioloop.call_later(RESUME_POLL, self.resume_stor, future, file, mode, _errback=self.handle_error)
+            return
+        if getattr(self, '_closed', False):
+            return
+        self.add_channel()
+        if future.exception() is not None:
+            self.log(f"No se pudo hashear {file} antes de reanudar: {future.exception()}")
+        self.stor_started = time.monotonic()
+        super().ftp_STOR(file, mode)
+
+    def ftp_PASS(self, line):
+        # El PBKDF2 no corre en el loop: sin resultado en el cache se calcula en
+        # un hilo y el canal de control se pausa hasta tenerlo
+        store = getattr(self.authorizer, 'store', None)
+        if (self.auth_executor is None or store is None or self.authenticated or not self.username
+                or self.username == "anonymous" or store.cached(self.username, line) is not None):
+            return super().ftp_PASS(line)
+        self.del_channel()
+        future = self.auth_executor.submit(store.verify, self.username, line)
+        self.ioloop.call_later(AUTH_POLL, self.resume_auth, future, line, _errback=self.handle_error)
+
+    def resume_auth(self, future, line):
+        if not future.done():
+            self.ioloop.call_later(AUTH_POLL, self.resume_auth, future, line, _errback=self.handle_error)
+            return
+        if getattr(self, '_closed', False):
+            return
+        self.add_channel()
+        # El resultado ya está en el cache: validate_authentication no vuelve a hashear
+        super().ftp_PASS(line)
+
+    def ftp_SIZE(self, path):
+        # El DVR pregunta el tamaño del nombre original antes del REST: responder con el .part
+        if not os.path.isfile(path):
+            final_path = self.ingest_path(path)
+            if final_path is not None and os.path.isfile(str(final_path) + PART_SUFFIX):
+                path = str(final_path) + PART_SUFFIX
+        return super().ftp_SIZE(path)
+
     def on_file_received(self, file):
+        # Se ejecuta en el loop de pyftpdlib: solo encolar
+        self.record_transfer(file, completed=True)
+        ingest = self.fs.pop_ingest(file)
+        if self.post_processor is not None:
+            self.post_processor.submit(self.process_received_file, file, ingest)
+        else:
+            self.process_received_file(file, ingest)
+
+    def on_incomplete_file_received(self, file):
+        # El .part queda en su carpeta final para que el DVR lo reanude con REST
+        self.record_transfer(file, completed=False)
+        ingest = self.fs.pop_ingest(file)
+        if not file.endswith(PART_SUFFIX):
+            return
+        if ingest is not None:
+            IngestFS.suspend(file, ingest)
+        if self.post_processor is not None:
+            self.post_processor.submit(self.record_partial, file)
+        else:
+            self.record_partial(file)
+
+    def record_partial(self, part_file):
         logger = logging.getLogger("DahuaFTPServer")
         try:
-            file_path = Path(file)
-            file_size = file_path.stat().st_size
-            logger.info(f"Archivo recibido: {file} ({file_size} bytes)")
+            size = os.path.getsize(part_file)
+            logger.warning(f"Upload incompleto: {Path(part_file).name} ({size} bytes), a la espera de REST",
+                           extra={'event': 'incomplete'})
+            if self.catalog is not None:
+                self.catalog.mark_partial(Path(os.path.relpath(part_file, self.video_root)).as_posix(), size)
+        except Exception as e:
+            logger.error(f"Error registrando upload incompleto {part_file}: {e}")
+
+    def process_received_file(self, file, ingest=None):
+        logger = logging.getLogger("DahuaFTPServer")
+        try:
+            if file.endswith(PART_SUFFIX):
+                self.commit_ingest(file, ingest)
+                return
+            # Un solo stat para todo el pipeline
+            st = os.stat(file)
+            logger.info(f"Archivo recibido: {file} ({st.st_size} bytes)", extra={'event': 'received'})
             if self.is_video_file(file):
-                self.organize_video_file(file)
+                self.organize_video_file(file, st)
         except Exception as e:
             logger.error(f"Error procesando archivo {file}: {e}")
-    
+
+    def commit_ingest(self, part_file, ingest=None):
+        """Cierre de un upload en streaming: rename y fila en el catálogo, sin releer datos"""
+        logger = logging.getLogger("DahuaFTPServer")
+        final_path = Path(part_file[:-len(PART_SUFFIX)])
+        if ingest is not None and ingest.deferred:
+            # El tramo previo cambió después del prehash: se hashea acá, en el post-procesamiento
+            ingest.hasher, ingest.size, ingest.header = IngestFS.hash_existing(part_file)
+            ingest.deferred = False
+        size = ingest.size if ingest is not None else os.path.getsize(part_file)
+        checksum = ingest.checksum if ingest is not None else None
+        if ingest is not None and ingest.resumed and self.catalog is not None:
+            self.catalog.clear_partials([Path(os.path.relpath(part_file, self.video_root)).as_posix()])
+        duplicate = self.find_duplicate(final_path, checksum)
+        if duplicate is not None and self.dedup_policy == "skip":
+            os.unlink(part_file)
+            logger.info(f"Duplicado descartado: {final_path.name} ya está en {duplicate['path']}",
+                        extra={'event': 'duplicate'})
+            return
+        os.replace(part_file, final_path)
+        self.fsops.sync(final_path)
+        logger.info(f"Archivo recibido: {final_path} ({size} bytes)", extra={'event': 'received'})
+        if ingest is not None and ingest.container != final_path.suffix.lower().lstrip('.'):
+            logger.warning(f"La cabecera de {final_path.name} no corresponde a {final_path.suffix} "
+                           f"(detectado: {ingest.container or 'desconocido'})", extra={'event': 'received'})
+        if duplicate is not None:
+            self.resolve_duplicate(final_path, duplicate)
+        self.update_video_database(final_path, size, checksum)
+
+    def find_duplicate(self, file_path, checksum):
+        """Busca el mismo segmento (canal, inicio, checksum) ya catalogado con otro nombre"""
+        if self.dedup_policy == "off" or self.catalog is None or checksum is None:
+            return None
+        rel_path = Path(os.path.relpath(file_path, self.video_root)).as_posix()
+        record = make_record(rel_path, 0)
+        return self.catalog.find_duplicate(record['channel'], record['start_time'], checksum, rel_path)
+
+    def resolve_duplicate(self, file_path, duplicate):
+        """replace: borra la copia anterior; hardlink: deja un solo inodo para ambas rutas"""
+        logger = logging.getLogger("DahuaFTPServer")
+        copies = [Path(root) / PurePosixPath(duplicate['path']) for root in (self.video_root, self.cold_root) if root]
+        existing = next((path for path in copies if path.exists()), copies[0])
+        try:
+            if self.dedup_policy == "replace":
+                for path in copies:
+                    path.unlink(missing_ok=True)
+                self.catalog.delete_paths([duplicate['path']])
+                logger.info(f"Duplicado reemplazado: {duplicate['path']} -> {file_path.name}", extra={'event': 'duplicate'})
+            elif self.dedup_policy == "hardlink":
+                link_path = file_path.with_name(file_path.name + ".link")
+                os.link(existing, link_path)
+                os.replace(link_path, file_path)
+                logger.info(f"Duplicado enlazado: {file_path.name} -> {duplicate['path']}", extra={'event': 'duplicate'})
+        except OSError as e:
+            # Otro disco o sistema sin hardlinks: se conservan ambas copias
+            logger.warning(f"No se pudo resolver el duplicado {file_path.name}: {e}", extra={'event': 'duplicate'})
+
     def is_video_file(self, file_path):
         video_extensions = ['.avi', '.mp4', '.mkv', '.mov', '.wmv', '.flv', '.dav']
         return Path(file_path).suffix.lower() in video_extensions
     
-    def organize_video_file(self, file_path):
+    def organize_video_file(self, file_path, st=None):
         logger = logging.getLogger("DahuaFTPServer")
         try:
             file_path = Path(file_path)
-            date_match = self.extract_date_from_filename(file_path.name)
-            if date_match:
-                date_folder = date_match.strftime("%Y/%m/%d")
-                organized_path = file_path.parent / "organized" / date_folder
-                organized_path.mkdir(parents=True, exist_ok=True)
-                new_path = organized_path / file_path.name
-                shutil.move(str(file_path), str(new_path))
-                logger.info(f"Video organizado: {new_path}")
-                self.update_video_database(new_path, date_match)
+            info = parse_video_name(file_path.name)
+            if info:
+                st = st or os.stat(file_path)
+                new_path = file_path.parent / layout_dir(self.layout, info) / file_path.name
+                self.fsops.move(file_path, new_path, st)
+                self.fsops.sync(new_path)
+                logger.info(f"Video organizado: {new_path}", extra={'event': 'organized'})
+                self.update_video_database(new_path, st.st_size)
         except Exception as e:
             logger.error(f"Error organizando video {file_path}: {e}")
 
-    def update_video_database(self, file_path, date_time):
+    def update_video_database(self, file_path, size=None, checksum=None):
         logger = logging.getLogger("DahuaFTPServer")
         try:
-            db_file = Path(file_path).parents[3] / "video_database.txt"
-            with open(db_file, "a", encoding="utf-8") as f:
-                f.write(f"{date_time.isoformat()},{file_path},{file_path.stat().st_size}\n")
+            if self.catalog is None:
+                return
+            rel_path = Path(os.path.relpath(file_path, self.video_root)).as_posix()
+            if size is None:
+                size = file_path.stat().st_size
+            self.catalog.add(make_record(rel_path, size, checksum=checksum))
         except Exception as e:
             logger.error(f"Error actualizando base de datos: {e}")
 
     def extract_date_from_filename(self, filename):
         # Ejemplo: Casa_ch1_main_20250624000000_20250624010000.dav
-        match = re.search(r'(\d{8})(\d{6})', filename)
-        if match:
-            date_str = match.group(1) + match.group(2)
-            try:
-                return datetime.strptime(date_str, "%Y%m%d%H%M%S")
-            except Exception:
-                return None
-        return None
+        info = parse_video_name(filename)
+        return info.start if info else None
 
 class DahuaFTPServer:
     """Servidor FTP especializado para DVR Dahua"""
     
-    def __init__(self, host="0.0.0.0", port=21, max_cons=256, max_cons_per_ip=5, video_dir="dahua_videos", log_dir="logs", keep_days=3, user="dahua", password="dahua123"):
+    def __init__(self, host="0.0.0.0", port=21, max_cons=256, max_cons_per_ip=5, video_dir="dahua_videos", log_dir="logs", keep_days=3, user="dahua", password="dahua123", post_workers=4, post_queue=1024, concurrency="async", workers=0, catalog_db=DEFAULT_DB, reconcile_hours=24, health_port=8021, health_host="127.0.0.1", log_format="text", log_rotation="size", log_max_mb=50, log_when="midnight", log_backups=10, channel_keep_days=None, max_disk_percent=0, dedup="skip", name_patterns=None, layout=DEFAULT_LAYOUT, fsync_interval=0, partial_hours=2, ip_kbps=0, user_kbps=0, backfill_kbps=0, live_window=DEFAULT_LIVE_WINDOW, shaping_file=None, cold_dir=None, hot_days=7, tier_mbps=20, credentials_file=DEFAULT_CREDENTIALS):
         self.host = host
         self.port = port
         self.max_cons = max_cons
@@ -83,76 +742,387 @@ class DahuaFTPServer:
         self.keep_days = keep_days
         self.user = user
         self.password = password
+        self.credentials = CredentialStore(credentials_file)
         self.video_dir = Path(video_dir)
         self.log_dir = Path(log_dir)
+        self.concurrency = concurrency
+        if concurrency == "multiproc" and os.name != "posix":
+            raise ValueError("El modo multiproc solo está disponible en POSIX")
+        self.workers = workers if workers and workers > 0 else cpu_count()
+        self.worker_id = None
+        self.log_format = log_format
+        self.log_rotation = log_rotation
+        self.log_max_mb = log_max_mb
+        self.log_when = log_when
+        self.log_backups = log_backups
+        self.log_listener = None
+        self.log_queue = None
+        self.catalog_db = catalog_db
+        self.dedup = dedup
+        self.layout = resolve_layout(layout)
+        self.fsops = FileOps(fsync_interval)
+        # multiproc: cada worker tiene sus propios buckets y aplica su parte de cada tasa
+        share = 1.0 / self.workers if concurrency == "multiproc" else 1.0
+        self.shaper = UploadShaper(ip_kbps, user_kbps, backfill_kbps, live_window, shaping_file, share=share)
+        if name_patterns:
+            # Patrones propios primero; los de Dahua quedan como respaldo
+            set_patterns(list(name_patterns) + list(DEFAULT_PATTERNS))
+        self.reconcile_hours = reconcile_hours
+        self.partial_hours = partial_hours
+        self.cold_dir = Path(cold_dir) if cold_dir else None
+        self.health_port = health_port
+        self.health_host = health_host
+        self.started_at = time.time()
+        self.loop_monitor = None
+        self.health_httpd = None
+        # Por worker: último latido, lag, lag máximo, conexiones, cola de post-procesamiento
+        self.worker_health = None
+        if concurrency == "multiproc":
+            self.worker_health = multiprocessing.Array('d', self.workers * 5, lock=False)
+        self.metrics = ftp_metrics()
+        # multiproc: cada worker manda su snapshot de métricas y el padre los suma
+        self.metrics_queue = multiprocessing.Queue() if concurrency == "multiproc" else None
+        self.worker_metrics = {}
+        self.metrics_published = 0
+        self.post_processor = PostProcessor(workers=post_workers, max_queue=post_queue)
         self.setup_logging()
         self.video_dir.mkdir(exist_ok=True)
+        if not self.credentials.exists():
+            # Primer arranque: --user/--password pasan al archivo, ya hasheados
+            self.credentials.add_user(user, password)
+            self.logger.info(f"Usuario {user} guardado en {credentials_file}")
+        self.catalog = VideoCatalog(self.catalog_db)
+        self.retention = RetentionEngine(self.video_dir, self.catalog, keep_days=keep_days,
+                                         channel_keep_days=channel_keep_days,
+                                         max_disk_percent=max_disk_percent,
+                                         layout=self.layout, cold_dir=self.cold_dir)
+        self.tiering = None
+        if self.cold_dir is not None:
+            self.tiering = TieringEngine(self.video_dir, self.cold_dir, self.catalog, layout=self.layout,
+                                         hot_days=hot_days, mbps=tier_mbps, busy=self.ingest_busy)
         self.setup_server()
     
     def setup_logging(self):
+        """Logging con rotación detrás de una cola: el IOLoop nunca espera al disco
+
+        Los registros van a una cola (QueueHandler) y un hilo
+        QueueListener los escribe. En multiproc la cola es de
+        multiprocessing y solo el proceso principal escribe y rota.
+        """
         self.log_dir.mkdir(exist_ok=True)
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(self.log_dir / "ftp_server.log"),
-                logging.StreamHandler(sys.stdout)
-            ]
-        )
+        log_file = self.log_dir / "ftp_server.log"
+        if self.log_rotation == "time":
+            file_handler = logging.handlers.TimedRotatingFileHandler(
+                log_file, when=self.log_when, backupCount=self.log_backups, encoding="utf-8")
+        else:
+            file_handler = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=self.log_max_mb * 1024 * 1024, backupCount=self.log_backups, encoding="utf-8")
+        if self.log_format == "json":
+            formatter = JsonFormatter()
+        elif self.concurrency == "multiproc":
+            formatter = logging.Formatter('%(asctime)s - %(name)s[%(process)d] - %(levelname)s - %(message)s')
+        else:
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        file_handler.setFormatter(formatter)
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(formatter)
+        log_queue = multiprocessing.Queue(-1) if self.concurrency == "multiproc" else queue.SimpleQueue()
+        self.log_queue = log_queue
+        self.log_listener = logging.handlers.QueueListener(
+            log_queue, file_handler, console_handler, respect_handler_level=True)
+        self.log_listener.start()
+        queue_handler = RecordQueueHandler(log_queue)
+        logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
         self.logger = logging.getLogger("DahuaFTPServer")
+
+    def stop_logging(self):
+        # Vacía la cola antes de salir
+        if self.log_listener is not None and self.worker_id is None:
+            self.log_listener.stop()
     
     def setup_server(self):
-        authorizer = DummyAuthorizer()
-        authorizer.add_user(self.user, self.password, str(self.video_dir), perm="elradfmwMT")
+        authorizer = StoreAuthorizer(self.credentials, self.video_dir)
         authorizer.add_anonymous(str(self.video_dir), perm="elr")
         handler = DahuaFTPHandler
         handler.authorizer = authorizer
+        handler.post_processor = self.post_processor
+        handler.catalog = self.catalog
+        handler.video_root = str(self.video_dir.resolve())
+        handler.cold_root = str(self.cold_dir.resolve()) if self.cold_dir else None
+        handler.dedup_policy = self.dedup
+        handler.layout = self.layout
+        handler.fsops = self.fsops
+        handler.metrics = self.metrics
+        handler.shaper = self.shaper
+        # Los hilos se crean en el primer uso, ya dentro de cada worker
+        handler.auth_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="auth")
+        handler.resume_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="resume")
         handler.passive_ports = range(60000, 65535)
-        self.server = FTPServer((self.host, self.port), handler)
-        self.server.max_cons = self.max_cons
-        self.server.max_cons_per_ip = self.max_cons_per_ip
-        self.logger.info(f"Servidor FTP configurado en {self.host}:{self.port}")
+        self.handler = handler
+        if self.concurrency == "multiproc":
+            # El socket se crea antes del fork y lo comparten todos los workers;
+            # cada worker arma su propio FTPServer/IOLoop después del fork
+            family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+            self.listen_socket = socket.create_server((self.host, self.port), family=family, backlog=100)
+            self.server = None
+        else:
+            server_class = ThreadedFTPServer if self.concurrency == "threaded" else FTPServer
+            self.server = self.build_server((self.host, self.port), server_class)
+        self.logger.info(f"Servidor FTP configurado en {self.host}:{self.port} (modo {self.concurrency})")
+
+    def build_server(self, address_or_socket, server_class=FTPServer, ioloop=None):
+        server = server_class(address_or_socket, self.handler, ioloop=ioloop)
+        server.max_cons = self.max_cons
+        server.max_cons_per_ip = self.max_cons_per_ip
+        return server
     
     def start(self):
         try:
             self.logger.info("Iniciando servidor FTP para DVR Dahua...")
             self.logger.info(f"Directorio de videos: {self.video_dir.absolute()}")
-            self.logger.info(f"Usuario: {self.user}, Contraseña: {self.password}")
+            self.logger.info(f"Usuarios FTP: {', '.join(sorted(self.credentials.users))} ({self.credentials.path})")
             self.logger.info(f"Días de retención de archivos: {self.keep_days}")
+            # El monitor y el endpoint de salud corren solo en el proceso principal
             monitor_thread = threading.Thread(target=self.monitor_system, daemon=True)
             monitor_thread.start()
-            self.server.serve_forever()
+            if self.partial_hours > 0:
+                threading.Thread(target=self.monitor_partials, name="partials", daemon=True).start()
+            if self.tiering is not None:
+                threading.Thread(target=self.monitor_tiering, name="tiering", daemon=True).start()
+            self.start_health_server()
+            if self.concurrency == "multiproc":
+                threading.Thread(target=self.collect_worker_metrics, name="metrics", daemon=True).start()
+                self.start_workers()
+            else:
+                self.catalog.start_writer()
+                self.post_processor.start()
+                self.fsops.start()
+                self.loop_monitor = LoopMonitor(self.server.ioloop, self.server)
+                self.loop_monitor.start()
+                self.server.serve_forever(timeout=LoopMonitor.poll_timeout)
+            self.post_processor.stop()
+            self.fsops.stop()
+            self.catalog.close()
         except KeyboardInterrupt:
             self.logger.info("Deteniendo servidor...")
-            self.server.close_all()
+            if self.server is not None:
+                self.server.close_all()
+            self.post_processor.stop()
+            self.fsops.stop()
+            self.catalog.close()
         except Exception as e:
             self.logger.error(f"Error en servidor: {e}")
+        finally:
+            self.stop_logging()
+
+    def start_workers(self):
+        """Pre-fork de loops async que comparten el socket de escucha"""
+        self.logger.info(f"Iniciando {self.workers} workers FTP")
+        # fork_processes solo retorna en los hijos; el padre queda supervisando
+        self.worker_id = fork_processes(self.workers)
+        # fork_processes usa os.fork: la cola de logs debe descartar el hilo
+        # alimentador heredado del padre o los registros nunca salen
+        self.log_queue._after_fork()
+        self.metrics_queue._after_fork()
+        # Lo medido por el padre antes del fork no es de este worker
+        self.metrics = ftp_metrics()
+        self.handler.metrics = self.metrics
+        self.logger.info(f"Worker {self.worker_id} iniciado (pid {os.getpid()})")
+        if self.health_httpd is not None:
+            self.health_httpd.socket.close()
+        self.server = self.build_server(self.listen_socket, ioloop=IOLoop())
+        self.catalog.start_writer()
+        self.post_processor.start()
+        self.fsops.start()
+        self.loop_monitor = LoopMonitor(self.server.ioloop, self.server, on_beat=self.publish_worker_health)
+        self.loop_monitor.start()
+        threading.Thread(target=self.monitor_post_processing, daemon=True).start()
+        self.server.serve_forever(timeout=LoopMonitor.poll_timeout)
     
+    def start_health_server(self):
+        """Endpoint HTTP local de salud (loop lag, conexiones activas)"""
+        if not self.health_port:
+            return
+        handler = type('DahuaHealthHandler', (HealthRequestHandler,), {'ftp_server': self})
+        self.health_httpd = ThreadingHTTPServer((self.health_host, self.health_port), handler)
+        self.health_httpd.daemon_threads = True
+        threading.Thread(target=self.health_httpd.serve_forever, name="health", daemon=True).start()
+        self.logger.info(f"Endpoint de salud en http://{self.health_host}:{self.health_port}/health (métricas en /metrics)")
+
+    def publish_worker_health(self, monitor):
+        base = self.worker_id * 5
+        self.worker_health[base:base + 5] = [
+            monitor.last_beat, monitor.lag, monitor.lag_max,
+            monitor.connections(), self.post_processor.queue.qsize()
+        ]
+        if monitor.last_beat - self.metrics_published >= METRICS_PUBLISH_INTERVAL:
+            self.metrics_published = monitor.last_beat
+            self.metrics.set('dahua_ftp_post_queue_depth', self.post_processor.queue.qsize(), worker=str(self.worker_id))
+            self.metrics.set('dahua_ftp_loop_lag_seconds', monitor.lag, worker=str(self.worker_id))
+            self.metrics_queue.put((self.worker_id, self.metrics.snapshot()))
+
+    def collect_worker_metrics(self):
+        """Hilo del padre: guarda el último snapshot de cada worker"""
+        while True:
+            try:
+                worker_id, snapshot = self.metrics_queue.get()
+                self.worker_metrics[worker_id] = snapshot
+            except Exception as e:
+                self.logger.error(f"Error recibiendo métricas de workers: {e}")
+                time.sleep(1)
+
+    def render_metrics(self):
+        """Texto para Prometheus: métricas propias más las de cada worker"""
+        if self.worker_health is None:
+            self.metrics.set('dahua_ftp_post_queue_depth', self.post_processor.queue.qsize())
+            if self.loop_monitor is not None:
+                self.metrics.set('dahua_ftp_loop_lag_seconds', self.loop_monitor.lag)
+        try:
+            usage = shutil.disk_usage(self.video_dir)
+            self.metrics.set('dahua_ftp_disk_free_bytes', usage.free)
+            self.metrics.set('dahua_ftp_disk_used_ratio', round(usage.used / usage.total, 4) if usage.total else 0)
+        except OSError:
+            pass
+        snapshots = [self.metrics.snapshot()] + list(self.worker_metrics.values())
+        return self.metrics.combine(snapshots).render()
+
+    def update_shaping(self, changes):
+        """Cambio de límites en caliente; en multiproc llega a los workers por el archivo"""
+        if self.concurrency == "multiproc" and not self.shaper.config_file:
+            return 409, {'error': 'En modo multiproc los límites se cambian con --shaping-file'}
+        self.shaper.configure(changes)
+        if self.shaper.config_file:
+            self.shaper.save()
+        self.logger.info(f"Límites de subida actualizados: {json.dumps(changes)}", extra={'event': 'shaping'})
+        return 200, self.shaper.snapshot()
+
+    def health_snapshot(self):
+        workers = []
+        if self.worker_health is not None:
+            for i in range(self.workers):
+                beat, lag, lag_max, conns, depth = self.worker_health[i * 5:i * 5 + 5]
+                workers.append({
+                    'worker': i,
+                    'alive': beat > 0 and time.time() - beat < 10,
+                    'loop_lag_ms': round(lag * 1000, 2),
+                    'loop_lag_max_ms': round(lag_max * 1000, 2),
+                    'connections': int(conns),
+                    'post_queue_depth': int(depth),
+                })
+        elif self.loop_monitor is not None:
+            monitor = self.loop_monitor
+            workers.append({
+                'worker': 0,
+                'alive': time.time() - monitor.last_beat < 10,
+                'loop_lag_ms': round(monitor.lag * 1000, 2),
+                'loop_lag_max_ms': round(monitor.lag_max * 1000, 2),
+                'connections': monitor.connections(),
+                'post_queue_depth': self.post_processor.queue.qsize(),
+            })
+        alive = [w for w in workers if w['alive']]
+        if not workers or not alive:
+            status = 'down'
+        elif len(alive) < len(workers):
+            status = 'degraded'
+        else:
+            status = 'ok'
+        return {
+            'status': status,
+            'pid': os.getpid(),
+            'concurrency': self.concurrency,
+            'uptime': round(time.time() - self.started_at),
+            'connections': sum(w['connections'] for w in workers),
+            'loop_lag_ms': max((w['loop_lag_ms'] for w in workers), default=0),
+            'loop_lag_max_ms': max((w['loop_lag_max_ms'] for w in workers), default=0),
+            'workers': workers,
+        }
+
     def monitor_system(self):
+        last_reconcile = time.monotonic()
         while True:
             try:
-                video_count = sum(1 for f in self.video_dir.rglob("*") if f.is_file())
-                total_size = sum(f.stat().st_size for f in self.video_dir.rglob("*") if f.is_file())
-                self.logger.info(f"Estadísticas: {video_count} archivos, {total_size / (1024**3):.2f} GB")
+                if self.reconcile_hours > 0 and time.monotonic() - last_reconcile >= self.reconcile_hours * 3600:
+                    added, removed = self.catalog.sync_tree(self.video_dir, self.cold_dir)
+                    last_reconcile = time.monotonic()
+                    self.logger.info(f"Catálogo reconciliado: {added} archivos agregados, {removed} filas huérfanas eliminadas")
+                summary = self.catalog.stats_summary()
+                self.logger.info(f"Estadísticas: {summary['count']} archivos, {summary['bytes'] / (1024**3):.2f} GB", extra={'event': 'stats'})
+                if self.concurrency != "multiproc":
+                    self.log_post_processing_metrics()
                 self.cleanup_old_files(self.keep_days)
                 time.sleep(300)
             except Exception as e:
                 self.logger.error(f"Error en monitoreo: {e}")
                 time.sleep(60)
     
+    def monitor_partials(self):
+        """Timer propio y corto para los uploads cortados (la retención general es de días)"""
+        max_age = self.partial_hours * 3600
+        while True:
+            time.sleep(min(PARTIAL_SWEEP_INTERVAL, max_age / 4))
+            try:
+                result = self.retention.expire_partials(max_age)
+                if result['files']:
+                    self.metrics.inc('dahua_ftp_partials_expired_total', result['files'])
+                    self.logger.info(
+                        f"Uploads incompletos vencidos: {result['files']} archivos, "
+                        f"{result['bytes'] / (1024**2):.2f} MB liberados", extra={'event': 'cleanup'})
+            except Exception as e:
+                self.logger.error(f"Error venciendo uploads incompletos: {e}")
+
+    def monitor_tiering(self):
+        """Pasa al tier frío los días más viejos que hot_days, una vez por hora"""
+        while True:
+            try:
+                started = time.monotonic()
+                result = self.tiering.run()
+                self.metrics.inc('dahua_ftp_tiering_files_total', result['files'])
+                self.metrics.inc('dahua_ftp_tiering_bytes_total', result['bytes'])
+                if result['files']:
+                    self.logger.info(
+                        f"Tier frío: {result['files']} archivos de {result['days']} días movidos a {self.cold_dir}, "
+                        f"{result['bytes'] / (1024**2):.2f} MB en {time.monotonic() - started:.2f} s",
+                        extra={'event': 'tiering'})
+            except Exception as e:
+                self.logger.error(f"Error moviendo videos al tier frío: {e}")
+            time.sleep(TIERING_INTERVAL)
+
+    def ingest_busy(self):
+        """True si la ingesta tiene trabajo acumulado (en multiproc, el de cualquier worker)"""
+        if self.worker_health is not None:
+            depths = [self.worker_health[i * 5 + 4] for i in range(self.workers)]
+        else:
+            depths = [self.post_processor.queue.qsize()]
+        return max(depths, default=0) > TIERING_BUSY_QUEUE
+
+    def monitor_post_processing(self):
+        while True:
+            time.sleep(300)
+            self.log_post_processing_metrics()
+
+    def log_post_processing_metrics(self):
+        pp = self.post_processor.metrics()
+        self.logger.info(
+            f"Post-procesamiento: cola {pp['queue_depth']}/{pp['queue_max']} (pico {pp['queue_peak']}), "
+            f"procesados {pp['processed']}, fallidos {pp['failed']}, sobre el límite {pp['overflow']}, "
+            f"espera p95 {pp['wait_p95_ms']} ms, proceso p95 {pp['process_p95_ms']} ms",
+            extra={'event': 'stats'}
+        )
+
     def cleanup_old_files(self, days_to_keep=3):
         try:
-            cutoff_time = time.time() - (days_to_keep * 24 * 3600)
-            removed_count = 0
-            removed_size = 0
-            for file_path in self.video_dir.rglob("*"):
-                if file_path.is_file() and file_path.stat().st_mtime < cutoff_time:
-                    file_size = file_path.stat().st_size
-                    file_path.unlink()
-                    removed_count += 1
-                    removed_size += file_size
-            if removed_count > 0:
-                self.logger.info(f"Limpieza: {removed_count} archivos eliminados, {removed_size / (1024**2):.2f} MB liberados")
+            started = time.monotonic()
+            self.retention.keep_days = days_to_keep
+            result = self.retention.run()
+            self.metrics.set('dahua_ftp_cleanup_duration_seconds', round(time.monotonic() - started, 3))
+            self.metrics.inc('dahua_ftp_cleanup_files_total', result['files'])
+            self.metrics.inc('dahua_ftp_cleanup_bytes_total', result['bytes'])
+            if result['files'] > 0:
+                self.logger.info(
+                    f"Limpieza: {result['files']} archivos eliminados ({result['days']} días completos), "
+                    f"{result['bytes'] / (1024**2):.2f} MB liberados en {time.monotonic() - started:.2f} s",
+                    extra={'event': 'cleanup'}
+                )
         except Exception as e:
             self.logger.error(f"Error en limpieza: {e}")
 
@@ -163,21 +1133,53 @@ def main():
     parser.add_argument('--video-dir', default="dahua_videos", help="Directorio de videos (default: dahua_videos)")
     parser.add_argument('--log-dir', default="logs", help="Directorio de logs (default: logs)")
     parser.add_argument('--keep-days', type=int, default=3, help="Días para mantener archivos de video (default: 3)")
+    parser.add_argument('--channel-keep-days', default="", help="Retención por canal, ej. 1=7,2=30 (default: la global)")
+    parser.add_argument('--max-disk-percent', type=float, default=0, help="Marca de agua de uso de disco: al superarla se borran los videos más antiguos; 0 desactiva (default: 0)")
+    parser.add_argument('--dedup', choices=['skip', 'replace', 'hardlink', 'off'], default='skip', help="Segmentos re-subidos (mismo canal, inicio y checksum): descartar, reemplazar el anterior o enlazar ambos al mismo archivo (default: skip)")
+    parser.add_argument('--name-pattern', action='append', default=[], help="Regex adicional para nombres de otros DVR, con grupos start (obligatorio), end, camera, channel y stream; repetible (default: solo Dahua)")
+    parser.add_argument('--layout', default='date', help="Estructura de organized/: 'date' (organized/{Y}/{m}/{d}), 'channel' (organized/{camera}/{channel}/{Y}/{m}/{d}) o una plantilla; para mover lo existente usar layout.py (default: date)")
+    parser.add_argument('--fsync-interval', type=float, default=0, help="Segundos entre fsync por lotes de los videos terminados; 0 deja la escritura al sistema operativo (default: 0)")
+    parser.add_argument('--partial-hours', type=float, default=2, help="Horas que se conserva un upload cortado (.part) esperando que el DVR lo reanude con REST; 0 lo deja a la retención general (default: 2)")
+    parser.add_argument('--ip-kbps', type=float, default=0, help="Límite de subida por IP en KB/s, sumando sus conexiones; en multiproc cada worker aplica 1/N, así una IP con todas sus conexiones en un worker recibe menos; 0 sin límite (default: 0)")
+    parser.add_argument('--user-kbps', type=float, default=0, help="Límite de subida por usuario FTP en KB/s; en multiproc cada worker aplica 1/N; 0 sin límite (default: 0)")
+    parser.add_argument('--backfill-kbps', type=float, default=0, help="Techo conjunto en KB/s para los uploads de grabaciones viejas; los segmentos en vivo no lo usan; en multiproc cada worker aplica 1/N y la prioridad vale dentro de cada worker (default: 0, sin límite)")
+    parser.add_argument('--live-window', type=float, default=DEFAULT_LIVE_WINDOW / 60, help=f"Minutos desde el fin del segmento en que un upload cuenta como en vivo (default: {DEFAULT_LIVE_WINDOW // 60})")
+    parser.add_argument('--shaping-file', default=None, help="JSON con los límites (ip_kbps, user_kbps, backfill_kbps, live_window) que se relee al cambiar y guarda los POST a /shaping (default: ninguno)")
+    parser.add_argument('--cold-dir', default=None, help="Directorio del tier frío (disco más lento y grande) al que se mueven los días viejos; vacío desactiva (default: ninguno)")
+    parser.add_argument('--hot-days', type=int, default=7, help="Días que quedan en el directorio de videos antes de pasar al tier frío; la retención usa --keep-days sobre ambos (default: 7)")
+    parser.add_argument('--tier-mbps', type=float, default=20, help="Tasa máxima en MB/s al copiar al tier frío en otro disco; 0 sin límite (default: 20)")
     parser.add_argument('--max-cons', type=int, default=256, help="Conexiones máximas (default: 256)")
     parser.add_argument('--max-cons-per-ip', type=int, default=5, help="Conexiones máximas por IP (default: 5)")
-    parser.add_argument('--user', default="dahua", help="Usuario FTP (default: dahua)")
-    parser.add_argument('--password', default="dahua123", help="Contraseña FTP (default: dahua123)")
+    parser.add_argument('--user', default="dahua", help="Usuario FTP inicial si todavía no existe el archivo de usuarios (default: dahua)")
+    parser.add_argument('--password', default="dahua123", help="Contraseña del usuario inicial (default: dahua123)")
+    parser.add_argument('--credentials-file', default=DEFAULT_CREDENTIALS, help=f"Usuarios con contraseña hasheada, directorio y permisos; se administra con credentials.py y lo comparte el cliente web (default: {DEFAULT_CREDENTIALS})")
+    parser.add_argument('--post-workers', type=int, default=4, help="Hilos de post-procesamiento de uploads (default: 4)")
+    parser.add_argument('--post-queue', type=int, default=1024, help="Tareas de post-procesamiento en cola a partir de las cuales los STOR nuevos reciben 451 para que el DVR reintente (default: 1024)")
+    parser.add_argument('--catalog-db', default=DEFAULT_DB, help=f"Catálogo SQLite de videos (default: {DEFAULT_DB})")
+    parser.add_argument('--reconcile-hours', type=float, default=24, help="Cada cuántas horas comparar catálogo y disco; 0 desactiva (default: 24)")
+    parser.add_argument('--health-port', type=int, default=8021, help="Puerto de los endpoints /health y /metrics; 0 desactiva (default: 8021)")
+    parser.add_argument('--health-host', default="127.0.0.1", help="IP donde escuchan /health y /metrics; 0.0.0.0 para que Prometheus los lea desde otra máquina (default: 127.0.0.1)")
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text', help="Formato del log: texto o JSON por línea (default: text)")
+    parser.add_argument('--log-rotation', choices=['size', 'time'], default='size', help="Rotar el log por tamaño o por tiempo (default: size)")
+    parser.add_argument('--log-max-mb', type=int, default=50, help="Tamaño máximo del log antes de rotar, en MB (default: 50)")
+    parser.add_argument('--log-when', default='midnight', help="Intervalo de rotación por tiempo, ver TimedRotatingFileHandler (default: midnight)")
+    parser.add_argument('--log-backups', type=int, default=10, help="Archivos de log rotados a conservar (default: 10)")
+    parser.add_argument('--concurrency', choices=['async', 'threaded', 'multiproc'], default='async', help="Modelo de concurrencia: async (un loop), threaded (un hilo por conexión) o multiproc (loops async pre-fork, solo POSIX) (default: async)")
+    parser.add_argument('--workers', type=int, default=0, help="Procesos worker en modo multiproc; max-cons-per-ip aplica por worker (default: núcleos disponibles)")
     args = parser.parse_args()
 
     print("=== Servidor FTP para DVR Dahua ===")
     print("Configuración:")
     print(f"- Host: {args.host}")
     print(f"- Puerto: {args.port}")
-    print(f"- Usuario: {args.user}")
-    print(f"- Contraseña: {args.password}")
+    print(f"- Usuarios: {args.credentials_file}")
     print(f"- Directorio de videos: {args.video_dir}")
     print(f"- Directorio de logs: {args.log_dir}")
     print(f"- Días de retención: {args.keep_days}")
+    if args.cold_dir:
+        print(f"- Tier frío: {args.cold_dir} (después de {args.hot_days} días)")
+    print(f"- Hilos de post-procesamiento: {args.post_workers}")
+    print(f"- Concurrencia: {args.concurrency}" + (f" ({args.workers or cpu_count()} workers)" if args.concurrency == 'multiproc' else ""))
     print("=====================================")
     
     try:
@@ -190,7 +1192,36 @@ def main():
             log_dir=args.log_dir,
             keep_days=args.keep_days,
             user=args.user,
-            password=args.password
+            password=args.password,
+            post_workers=args.post_workers,
+            post_queue=args.post_queue,
+            concurrency=args.concurrency,
+            workers=args.workers,
+            catalog_db=args.catalog_db,
+            reconcile_hours=args.reconcile_hours,
+            health_port=args.health_port,
+            health_host=args.health_host,
+            log_format=args.log_format,
+            log_rotation=args.log_rotation,
+            log_max_mb=args.log_max_mb,
+            log_when=args.log_when,
+            log_backups=args.log_backups,
+            channel_keep_days=parse_channel_keep_days(args.channel_keep_days),
+            max_disk_percent=args.max_disk_percent,
+            dedup=args.dedup,
+            name_patterns=args.name_pattern,
+            layout=args.layout,
+            fsync_interval=args.fsync_interval,
+            partial_hours=args.partial_hours,
+            ip_kbps=args.ip_kbps,
+            user_kbps=args.user_kbps,
+            backfill_kbps=args.backfill_kbps,
+            live_window=args.live_window * 60,
+            shaping_file=args.shaping_file,
+            cold_dir=args.cold_dir,
+            hot_days=args.hot_days,
+            tier_mbps=args.tier_mbps,
+            credentials_file=args.credentials_file
         )
         server.start()
     except Exception as e:
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Control del ancho de banda de los uploads
+Token buckets compartidos por IP, por usuario y para el backfill, ajustables en caliente
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from filenames import parse_video_name
+
+DEFAULT_LIVE_WINDOW = 7200  # segundos: un segmento que terminó hace menos es "en vivo"
+RELOAD_CHECK = 5  # segundos mínimos entre revisiones del archivo de configuración
+PRIORITIES = ('live', 'backfill')
+
+
+class TokenBucket:
+    """Tasa en bytes/s con ráfaga de un segundo; rate 0 es sin límite"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def consume(self, amount, now):
+        """Descuenta amount bytes y devuelve los segundos a esperar hasta saldar la deuda"""
+        if not self.rate:
+            return 0.0
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - amount
+        self.updated = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class UploadShaper:
+    """Límites de subida compartidos por todas las conexiones de un proceso
+
+    ip_kbps y user_kbps son diccionarios nombre -> KB/s con '*' como
+    valor por defecto; backfill_kbps es el techo conjunto de los uploads
+    de grabaciones viejas, que los segmentos en vivo no consumen.
+
+    Los buckets son de cada proceso. Con N workers (multiproc) cada uno
+    aplica 1/N de cada tasa (share), así la suma no pasa de lo configurado;
+    a cambio, si las conexiones de una IP caen todas en el mismo worker
+    esa IP recibe solo 1/N, y la prioridad entre en vivo y backfill se
+    respeta dentro de cada worker, no entre workers.
+    """
+
+    def __init__(self, ip_kbps=0, user_kbps=0, backfill_kbps=0, live_window=DEFAULT_LIVE_WINDOW, config_file=None, share=1.0):
+        self.config = {
+            'ip_kbps': {'*': ip_kbps},
+            'user_kbps': {'*': user_kbps},
+            'backfill_kbps': backfill_kbps,
+            'live_window': live_window,
+        }
+        self.config_file = config_file
+        self.share = share
+        self.config_mtime = None
+        self.checked = 0
+        self.buckets = {}  # (tipo, nombre) -> TokenBucket
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("DahuaFTPServer")
+        if config_file and os.path.exists(config_file):
+            self.reload()
+
+    @property
+    def enabled(self):
+        config = self.config
+        return bool(config['backfill_kbps'] or any(config['ip_kbps'].values()) or any(config['user_kbps'].values()))
+
+    # --- configuración
+
+    def configure(self, changes):
+        """Aplica cambios parciales; las transferencias en curso toman la tasa nueva"""
+        config = {key: dict(value) if isinstance(value, dict) else value for key, value in self.config.items()}
+        for key, value in changes.items():
+            if key in ('ip_kbps', 'user_kbps'):
+                if not isinstance(value, dict):
+                    value = {'*': value}
+                config[key].update({str(name): max(0, float(rate)) for name, rate in value.items()})
+            elif key in ('backfill_kbps', 'live_window'):
+                config[key] = max(0, float(value))
+            else:
+                raise ValueError(f"Opción de shaping desconocida: {key}")
+        with self.lock:
+            self.config = config
+            for (kind, name), bucket in self.buckets.items():
+                bucket.rate = self.rate_for(kind, name)
+        return config
+
+    def reload(self):
+        with open(self.config_file, 'r', encoding='utf-8') as f:
+            changes = json.load(f)
+        self.config_mtime = os.stat(self.config_file).st_mtime_ns
+        self.configure(changes)
+        self.logger.info(f"Límites de subida cargados de {self.config_file}", extra={'event': 'shaping'})
+
+    def maybe_reload(self):
+        """Relee el archivo si cambió (así se ajustan también los workers de multiproc)"""
+        if not self.config_file or time.monotonic() - self.checked < RELOAD_CHECK:
+            return
+        self.checked = time.monotonic()
+        try:
+            if os.stat(self.config_file).st_mtime_ns != self.config_mtime:
+                self.reload()
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Error leyendo {self.config_file}: {e}")
+
+    def save(self):
+        tmp = f"{self.config_file}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.config, f, indent=2)
+        os.replace(tmp, self.config_file)
+        self.config_mtime = os.stat(self.config_file).st_mtime_ns
+
+    # --- buckets
+
+    def rate_for(self, kind, name):
+        if kind == 'backfill':
+            return int(self.config['backfill_kbps'] * 1024 * self.share)
+        rates = self.config[f'{kind}_kbps']
+        return int(rates.get(name, rates.get('*', 0)) * 1024 * self.share)
+
+    def bucket(self, kind, name=''):
+        key = (kind, name)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.rate_for(kind, name))
+            return bucket
+
+    def classify(self, filename, now=None):
+        """'live' si el segmento terminó hace menos de live_window, 'backfill' si es viejo"""
+        info = parse_video_name(os.path.basename(filename))
+        if info is None:
+            return 'live'
+        age = ((now or datetime.now()) - (info.end or info.start)).total_seconds()
+        return 'live' if age <= self.config['live_window'] else 'backfill'
+
+    def buckets_for(self, ip, user, priority):
+        buckets = [self.bucket('ip', ip), self.bucket('user', user or '')]
+        if priority == 'backfill':
+            buckets.append(self.bucket('backfill'))
+        return buckets
+
+    def consume(self, buckets, amount):
+        """Descuenta de todos los buckets; la espera es la del más atrasado"""
+        now = time.monotonic()
+        with self.lock:
+            return max(bucket.consume(amount, now) for bucket in buckets)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'config': self.config,
+                'config_file': self.config_file,
+                'share': self.share,
+                'buckets': [{'kind': kind, 'name': name, 'kbps': bucket.rate / 1024}
+                            for (kind, name), bucket in sorted(self.buckets.items()) if bucket.rate],
+            }
@@ -4,23 +4,212 @@ Herramienta de diagnóstico para problemas de conexión FTP Dahua
 Identifica y soluciona problemas comunes de conectividad
 """
 
-import socket
 import ftplib
 import sys
 import time
 import subprocess
 import platform
-from pathlib import Path
+from pathlib import Path, PurePosixPath
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+import urllib.request
+import urllib.parse
+import http.cookiejar
+import io
+import os
+import json
+import re
+import asyncio
+import sqlite3
+import threading
 import argparse
 
+STATE_LABELS = {'open': 'abierto', 'closed': 'cerrado (rechaza la conexión)', 'filtered': 'filtrado (sin respuesta)'}
+PASV_REPLY = re.compile(r'(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)')
+
+
+class AsyncProbe:
+    """Sondeos TCP y FTP concurrentes con un tope de conexiones en vuelo
+
+    Un puerto pasivo 'cerrado' (RST) es buena señal: el firewall deja
+    pasar y simplemente no hay nadie escuchando todavía. 'Filtrado'
+    (timeout) es lo que rompe las transferencias del DVR.
+    """
+
+    def __init__(self, host, port, username, password, concurrency=500, timeout=1.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.slots = None
+        self.scan_done = None
+
+    async def connect(self, host, port, timeout=None):
+        """(estado, ms, reader, writer) de una conexión TCP"""
+        started = time.perf_counter()
+        async with self.slots:
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout or self.timeout)
+            except asyncio.TimeoutError:
+                return 'filtered', None, None, None
+            except ConnectionRefusedError:
+                return 'closed', round((time.perf_counter() - started) * 1000, 1), None, None
+            except OSError:
+                return 'filtered', None, None, None
+        return 'open', round((time.perf_counter() - started) * 1000, 1), reader, writer
+
+    @staticmethod
+    async def close(writer):
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    async def reply(self, reader):
+        """Una respuesta FTP completa (incluidas las multilínea 'NNN-')"""
+        lines = [await asyncio.wait_for(reader.readline(), self.timeout * 5)]
+        code = lines[0][:3]
+        if lines[0][3:4] == b'-':
+            while not (lines[-1][:3] == code and lines[-1][3:4] == b' ') and lines[-1]:
+                lines.append(await asyncio.wait_for(reader.readline(), self.timeout * 5))
+        text = b''.join(lines).decode('utf-8', errors='replace').strip()
+        return int(code) if code.isdigit() else 0, text
+
+    async def command(self, reader, writer, line):
+        writer.write(line.encode('utf-8') + b'\r\n')
+        await writer.drain()
+        return await self.reply(reader)
+
+    async def probe_port(self, port):
+        state, ms, _reader, writer = await self.connect(self.host, port)
+        if writer is not None:
+            await self.close(writer)
+        return {'port': port, 'state': state, 'ms': ms}
+
+    async def probe_control(self):
+        """Puerto de control, tiempo de conexión y banner"""
+        state, ms, reader, writer = await self.connect(self.host, self.port, self.timeout * 5)
+        result = {'port': self.port, 'state': state, 'ms': ms}
+        if writer is not None:
+            try:
+                result['banner'] = (await self.reply(reader))[1]
+            except (asyncio.TimeoutError, OSError, ValueError):
+                result['banner'] = ''
+            await self.close(writer)
+        return result
+
+    async def probe_login(self):
+        """USER/PASS, PASV y conexión al puerto de datos que entrega el servidor"""
+        started = time.perf_counter()
+        result = {'ok': False}
+        state, _ms, reader, writer = await self.connect(self.host, self.port, self.timeout * 5)
+        if writer is None:
+            result['error'] = f"Puerto {self.port} {STATE_LABELS[state]}"
+            return result
+        try:
+            await self.reply(reader)
+            code, text = await self.command(reader, writer, f"USER {self.username}")
+            if code == 331:
+                code, text = await self.command(reader, writer, f"PASS {self.password}")
+            if code != 230:
+                result['error'] = f"Credenciales inválidas: {text}"
+                return result
+            result['ok'] = True
+            result['ms'] = round((time.perf_counter() - started) * 1000, 1)
+            # Si el barrido se conecta primero al puerto del PASV, el servidor lo consume
+            await self.scan_done.wait()
+            code, text = await self.command(reader, writer, "PASV")
+            match = PASV_REPLY.search(text) if code == 227 else None
+            if match is None:
+                result['error'] = text
+                return result
+            numbers = [int(n) for n in match.groups()]
+            result['pasv_host'] = '.'.join(map(str, numbers[:4]))
+            result['pasv_port'] = numbers[4] * 256 + numbers[5]
+            # El DVR se conecta a la IP anunciada: si es privada y el DVR está afuera, falla
+            data_state, _ms, _r, data_writer = await self.connect(result['pasv_host'], result['pasv_port'], self.timeout * 5)
+            result['pasv_state'] = data_state
+            if data_writer is not None:
+                await self.close(data_writer)
+            await self.command(reader, writer, "QUIT")
+        except (asyncio.TimeoutError, OSError, ValueError) as e:
+            result['error'] = str(e) or type(e).__name__
+        finally:
+            await self.close(writer)
+        return result
+
+    async def scan(self, ports):
+        started = time.perf_counter()
+        try:
+            results = await asyncio.gather(*(self.probe_port(port) for port in ports))
+        finally:
+            self.scan_done.set()
+        counts = {'open': 0, 'closed': 0, 'filtered': 0}
+        for r in results:
+            counts[r['state']] += 1
+        return {
+            'ports': len(results),
+            'seconds': round(time.perf_counter() - started, 2),
+            'counts': counts,
+            'ranges': self.group_ranges(results),
+            'results': results,
+        }
+
+    @staticmethod
+    def group_ranges(results):
+        """Puertos consecutivos con el mismo estado como (primero, último, estado)"""
+        ranges = []
+        for r in sorted(results, key=lambda r: r['port']):
+            if ranges and ranges[-1][2] == r['state'] and ranges[-1][1] == r['port'] - 1:
+                ranges[-1][1] = r['port']
+            else:
+                ranges.append([r['port'], r['port'], r['state']])
+        return [tuple(r) for r in ranges]
+
+    async def run(self, passive_ports=()):
+        """Todos los sondeos en paralelo; el rango pasivo comparte el tope de conexiones"""
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.scan_done = asyncio.Event()
+        started = time.perf_counter()
+        control, login, scan = await asyncio.gather(
+            self.probe_control(), self.probe_login(), self.scan(passive_ports))
+        return {
+            'host': self.host,
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'seconds': round(time.perf_counter() - started, 2),
+            'control': control,
+            'login': login,
+            'scan': scan,
+        }
+
+def parse_port_range(value):
+    """'60000-65534' o '21,2000,60000-60100' -> lista de puertos"""
+    ports = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        ports.extend(range(int(first), int(last or first) + 1))
+    return ports
+
 class FTPDiagnostic:
     """Herramienta de diagnóstico FTP"""
     
-    def __init__(self, host, port=2000, username="dahua", password="dahua123"):
+    def __init__(self, host, port=2000, username="dahua", password="dahua123",
+                 passive_ports=range(60000, 65535), probe_concurrency=500, probe_timeout=1.0):
         self.host = host
         self.port = port
         self.username = username
         self.password = password
+        self.passive_ports = passive_ports
+        self.probe_concurrency = probe_concurrency
+        self.probe_timeout = probe_timeout
+        self.probe_report = None
         self.results = []
     
     def log_result(self, test_name, status, message):
@@ -34,103 +223,50 @@ class FTPDiagnostic:
         status_icon = "✓" if status == "PASS" else "✗" if status == "FAIL" else "⚠"
         print(f"{status_icon} {test_name}: {message}")
     
-    def test_network_connectivity(self):
-        """Prueba conectividad de red básica"""
-        print("\n=== PRUEBAS DE CONECTIVIDAD ===")
-        
-        # Test 1: Ping
-        try:
-            if platform.system().lower() == "windows":
-                result = subprocess.run(['ping', '-n', '4', self.host], 
-                                      capture_output=True, text=True, timeout=10)
-            else:
-                result = subprocess.run(['ping', '-c', '4', self.host], 
-                                      capture_output=True, text=True, timeout=10)
-            
-            if result.returncode == 0:
-                self.log_result("Ping", "PASS", f"Host {self.host} responde")
-            else:
-                self.log_result("Ping", "FAIL", f"Host {self.host} no responde")
-                return False
-        except Exception as e:
-            self.log_result("Ping", "WARN", f"No se pudo hacer ping: {e}")
-        
-        # Test 2: Socket connection
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(5)
-            result = sock.connect_ex((self.host, self.port))
-            sock.close()
-            
-            if result == 0:
-                self.log_result("Puerto TCP", "PASS", f"Puerto {self.port} abierto")
-                return True
-            else:
-                self.log_result("Puerto TCP", "FAIL", f"Puerto {self.port} cerrado o filtrado")
-                return False
-        except Exception as e:
-            self.log_result("Puerto TCP", "FAIL", f"Error conectando: {e}")
-            return False
-    
-    def test_ftp_banner(self):
-        """Prueba banner FTP"""
-        print("\n=== PRUEBAS FTP BÁSICAS ===")
-        
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(10)
-            sock.connect((self.host, self.port))
-            
-            # Leer banner
-            banner = sock.recv(1024).decode('utf-8').strip()
-            sock.close()
-            
-            if banner.startswith('220'):
-                self.log_result("Banner FTP", "PASS", f"Servidor responde: {banner}")
-                return True
+    def run_probe(self):
+        """Puerto de control, banner, login, datos PASV y rango pasivo, todo a la vez"""
+        print("\n=== SONDEO CONCURRENTE ===")
+        probe = AsyncProbe(self.host, self.port, self.username, self.password,
+                           concurrency=self.probe_concurrency, timeout=self.probe_timeout)
+        report = asyncio.run(probe.run(self.passive_ports))
+        self.probe_report = report
+
+        control = report['control']
+        if control['state'] == 'open':
+            self.log_result("Puerto TCP", "PASS", f"Puerto {self.port} abierto ({control['ms']} ms)")
+            if control.get('banner', '').startswith('220'):
+                self.log_result("Banner FTP", "PASS", f"Servidor responde: {control['banner']}")
             else:
-                self.log_result("Banner FTP", "FAIL", f"Banner inválido: {banner}")
-                return False
-                
-        except Exception as e:
-            self.log_result("Banner FTP", "FAIL", f"Error obteniendo banner: {e}")
-            return False
-    
-    def test_ftp_login(self):
-        """Prueba login FTP"""
-        try:
-            ftp = ftplib.FTP()
-            ftp.set_debuglevel(0)  # Sin debug para prueba limpia
-            ftp.connect(self.host, self.port, timeout=10)
-            
-            # Probar login
-            ftp.login(self.username, self.password)
-            
-            # Obtener directorio actual
-            pwd = ftp.pwd()
-            
-            # Listar archivos
-            files = ftp.nlst()
-            
-            ftp.quit()
-            
-            self.log_result("Login FTP", "PASS", 
-                          f"Login exitoso. Dir: {pwd}, Archivos: {len(files)}")
-            return True
-            
-        except ftplib.error_perm as e:
-            if "530" in str(e):
-                self.log_result("Login FTP", "FAIL", f"Credenciales inválidas: {e}")
+                self.log_result("Banner FTP", "FAIL", f"Banner inválido: {control.get('banner') or 'sin respuesta'}")
+        else:
+            self.log_result("Puerto TCP", "FAIL", f"Puerto {self.port} {STATE_LABELS[control['state']]}")
+
+        login = report['login']
+        if login['ok']:
+            self.log_result("Login FTP", "PASS", f"Login exitoso en {login['ms']} ms")
+            if login.get('pasv_port') is None:
+                self.log_result("Datos PASV", "FAIL", f"El servidor no entregó un puerto pasivo: {login.get('error')}")
+            elif login.get('pasv_state') == 'open':
+                self.log_result("Datos PASV", "PASS", f"Conexión de datos al puerto {login['pasv_port']} ({login['pasv_host']})")
             else:
-                self.log_result("Login FTP", "FAIL", f"Error de permisos: {e}")
-            return False
-        except ftplib.error_temp as e:
-            self.log_result("Login FTP", "FAIL", f"Error temporal: {e}")
-            return False
-        except Exception as e:
-            self.log_result("Login FTP", "FAIL", f"Error de conexión: {e}")
-            return False
-    
+                self.log_result("Datos PASV", "FAIL", f"Puerto {login['pasv_port']} ({login['pasv_host']}) "
+                                f"{STATE_LABELS[login['pasv_state']]}: revisar firewall o masquerade_address")
+        else:
+            self.log_result("Login FTP", "FAIL", login.get('error') or "Login rechazado")
+
+        scan = report['scan']
+        if scan['ports']:
+            counts = scan['counts']
+            message = (f"{scan['ports']} puertos en {scan['seconds']} s: {counts['open']} abiertos, "
+                       f"{counts['closed']} cerrados, {counts['filtered']} filtrados")
+            status = "FAIL" if counts['filtered'] else "PASS"
+            self.log_result("Puertos pasivos", status, message)
+            for first, last, state in scan['ranges']:
+                if state == 'filtered':
+                    span = f"{first}" if first == last else f"{first}-{last}"
+                    print(f"    filtrados: {span}")
+        return report
+
     def test_passive_mode(self):
         """Prueba modo pasivo FTP"""
         print("\n=== PRUEBAS DE MODO FTP ===")
@@ -163,27 +299,6 @@ class FTPDiagnostic:
         except Exception as e:
             self.log_result("Modo Activo", "FAIL", f"Error en modo activo: {e}")
     
-    def test_firewall_ports(self):
-        """Prueba puertos comunes que pueden estar bloqueados"""
-        print("\n=== PRUEBAS DE FIREWALL ===")
-        
-        # Puertos pasivos comunes
-        passive_ports = [20, 2000, 60000, 60001, 65000, 65534]
-        
-        for port in passive_ports:
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(2)
-                result = sock.connect_ex((self.host, port))
-                sock.close()
-                
-                if result == 0:
-                    self.log_result(f"Puerto {port}", "PASS", "Abierto")
-                else:
-                    self.log_result(f"Puerto {port}", "FAIL", "Cerrado/Filtrado")
-            except:
-                self.log_result(f"Puerto {port}", "FAIL", "Error de conexión")
-    
     def test_server_running(self):
         """Verifica si hay un servidor FTP ejecutándose localmente"""
         print("\n=== VERIFICACIÓN SERVIDOR LOCAL ===")
@@ -217,12 +332,8 @@ class FTPDiagnostic:
         solutions = []
         
         for test in failed_tests:
-            if test['test'] == "Ping":
+            if test['test'] == "Puerto TCP":
                 solutions.append("• Verificar que la IP del servidor sea correcta")
-                solutions.append("• Verificar conectividad de red")
-                solutions.append("• Verificar que no haya firewall bloqueando")
-            
-            elif test['test'] == "Puerto TCP":
                 solutions.append("• Verificar que el servidor FTP esté ejecutándose")
                 solutions.append("• Verificar que el puerto 2000 esté abierto")
                 solutions.append("• Verificar firewall del servidor")
@@ -236,7 +347,7 @@ class FTPDiagnostic:
                 solutions.append("• Verificar contraseña: 'dahua123'")
                 solutions.append("• Verificar configuración de usuarios en servidor")
             
-            elif "Modo" in test['test']:
+            elif test['test'] in ("Puertos pasivos", "Datos PASV") or "Modo" in test['test']:
                 solutions.append("• Configurar firewall para permitir puertos pasivos")
                 solutions.append("• Verificar configuración de NAT/Router")
         
@@ -271,17 +382,12 @@ class FTPDiagnostic:
         # Ejecutar pruebas en orden
         self.test_server_running()
         
-        if not self.test_network_connectivity():
+        report = self.run_probe()
+        if report['control']['state'] != 'open':
             print("\n⚠ Problemas de conectividad básica detectados")
-        
-        if not self.test_ftp_banner():
-            print("\n⚠ El servidor no responde como servidor FTP")
-        else:
-            self.test_ftp_login()
+        elif report['login']['ok']:
             self.test_passive_mode()
         
-        self.test_firewall_ports()
-        
         # Mostrar resumen
         print(f"\n=== RESUMEN ===")
         passed = len([r for r in self.results if r['status'] == 'PASS'])
@@ -319,6 +425,336 @@ def quick_server_test():
             print(f"✗ Error verificando puerto 2000: {e}")
             return False
 
+def json_logging_test():
+    """Verifica que el log JSON del servidor deja el traceback en el campo 'exception'"""
+    import tempfile
+    import logging
+    from server import DahuaFTPServer
+    print("=== PRUEBA LOG JSON ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        server = DahuaFTPServer(host='127.0.0.1', port=0, video_dir=tmp / 'videos', log_dir=tmp / 'logs',
+                                catalog_db=tmp / 'catalog.db', credentials_file=tmp / 'users.json',
+                                health_port=0, log_format='json')
+        try:
+            raise ValueError("error de prueba")
+        except ValueError:
+            logging.getLogger("DahuaFTPServer").exception("Fallo registrado por la prueba")
+        server.stop_logging()
+        server.server.close_all()
+        server.catalog.close()
+        logging.getLogger().handlers.clear()
+        entries = [json.loads(line) for line in (tmp / 'logs' / 'ftp_server.log').read_text(encoding='utf-8').splitlines()]
+    entry = next((e for e in entries if e['message'] == "Fallo registrado por la prueba"), None)
+    if entry is None:
+        print("✗ El registro de la excepción no llegó al log")
+        return False
+    if 'ValueError: error de prueba' not in entry.get('exception', ''):
+        print(f"✗ Falta el campo 'exception' en la línea JSON: {entry}")
+        return False
+    if '\n' in entry['message']:
+        print("✗ El traceback quedó dentro de 'message'")
+        return False
+    print("✓ El traceback va en 'exception' y 'message' queda en una línea")
+    return True
+
+def _load_client(task):
+    """Sube files_per_client archivos con nombre Dahua desde un proceso cliente"""
+    host, port, username, password, client_id, files_per_client, size = task
+    payload = b'\0' * size
+    base = datetime(2025, 1, 1) + timedelta(days=client_id)
+    uploaded = 0
+    errors = 0
+    ftp = ftplib.FTP()
+    ftp.connect(host, port, timeout=30)
+    ftp.login(username, password)
+    for i in range(files_per_client):
+        start = base + timedelta(hours=i)
+        end = start + timedelta(hours=1)
+        name = f"Load_ch{client_id + 1}_main_{start:%Y%m%d%H%M%S}_{end:%Y%m%d%H%M%S}.dav"
+        try:
+            ftp.storbinary(f'STOR {name}', io.BytesIO(payload), blocksize=65536)
+            uploaded += size
+        except ftplib.all_errors:
+            errors += 1
+    ftp.quit()
+    return uploaded, errors
+
+def stor_load_test(host, port, username, password, clients=8, files_per_client=4, size_mb=16):
+    """Mide el throughput agregado de STOR con varios clientes en paralelo"""
+    print("=== PRUEBA DE CARGA STOR ===")
+    print(f"Clientes: {clients}, archivos por cliente: {files_per_client}, tamaño: {size_mb} MB")
+    tasks = [(host, port, username, password, i, files_per_client, size_mb * 1024 * 1024)
+             for i in range(clients)]
+    started = time.perf_counter()
+    with Pool(clients) as pool:
+        results = pool.map(_load_client, tasks)
+    elapsed = time.perf_counter() - started
+    total_bytes = sum(r[0] for r in results)
+    errors = sum(r[1] for r in results)
+    throughput = total_bytes / (1024 * 1024) / elapsed if elapsed else 0
+    print(f"Transferido: {total_bytes / (1024 * 1024):.0f} MB en {elapsed:.2f} s")
+    print(f"Throughput agregado: {throughput:.1f} MB/s")
+    print(f"Transferencias fallidas: {errors}")
+    return throughput
+
+def _percentile(values, pct):
+    """Percentil por rango más cercano de una lista ya ordenada"""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, max(0, int(round(pct / 100 * len(values))) - 1))]
+
+def _latency_summary(values):
+    values = sorted(values)
+    return {
+        'p50': round(_percentile(values, 50), 4),
+        'p90': round(_percentile(values, 90), 4),
+        'p95': round(_percentile(values, 95), 4),
+        'p99': round(_percentile(values, 99), 4),
+        'max': round(values[-1], 4) if values else 0,
+    }
+
+def _fleet_channel(host, port, username, password, source_ip, camera, channel, segments, payload, rate_kbps, start):
+    """Un canal de un DVR: sube sus segmentos uno tras otro por su propia conexión"""
+    samples = []
+    ftp = ftplib.FTP(source_address=(source_ip, 0) if source_ip else None)
+    try:
+        ftp.connect(host, port, timeout=60)
+        ftp.login(username, password)
+        ftp.voidcmd('TYPE I')
+    except ftplib.all_errors as e:
+        return [{'name': None, 'ok': False, 'bytes': 0, 'latency': 0, 'done_at': time.time(), 'error': str(e)}] * segments
+    block = 65536
+    for i in range(segments):
+        seg_start = start + timedelta(minutes=i)
+        seg_end = seg_start + timedelta(seconds=59)
+        name = f"{camera}_ch{channel}_main_{seg_start:%Y%m%d%H%M%S}_{seg_end:%Y%m%d%H%M%S}.dav"
+        started = time.perf_counter()
+        sent = 0
+        error = None
+        try:
+            with ftp.transfercmd(f'STOR {name}') as conn:
+                view = memoryview(payload)
+                while sent < len(payload):
+                    conn.sendall(view[sent:sent + block])
+                    sent += min(block, len(payload) - sent)
+                    if rate_kbps:
+                        # Ritmo del DVR: no adelantarse a rate_kbps
+                        ahead = sent / (rate_kbps * 1024) - (time.perf_counter() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            ftp.voidresp()
+        except ftplib.all_errors as e:
+            error = str(e)
+        samples.append({'name': name, 'ok': error is None, 'bytes': sent if error is None else 0,
+                        'latency': time.perf_counter() - started, 'done_at': time.time(), 'error': error})
+    try:
+        ftp.quit()
+    except ftplib.all_errors:
+        pass
+    return samples
+
+def _fleet_dvr(task):
+    """Un DVR simulado (un proceso): todos sus canales suben en paralelo"""
+    host, port, username, password, dvr_id, channels, segments, size, rate_kbps, source_ip, start = task
+    # Cabecera DHAV para que el servidor detecte el contenedor; el resto no se repite entre DVRs
+    payload = b'DHAV' + os.urandom(size - 4)
+    camera = f"Fleet{dvr_id:03d}"
+    with ThreadPoolExecutor(channels) as pool:
+        futures = [pool.submit(_fleet_channel, host, port, username, password, source_ip, camera,
+                               ch + 1, segments, payload, rate_kbps, start)
+                   for ch in range(channels)]
+        return [sample for f in futures for sample in f.result()]
+
+def _sample_health(health_url, stop, peaks):
+    """Registra los picos de cola de post-procesamiento y lag del loop durante la prueba"""
+    while not stop.is_set():
+        try:
+            with urllib.request.urlopen(health_url, timeout=2) as response:
+                health = json.loads(response.read().decode('utf-8'))
+            depth = sum(w.get('post_queue_depth', 0) for w in health.get('workers', []))
+            peaks['post_queue_depth'] = max(peaks['post_queue_depth'], depth)
+            peaks['loop_lag_ms'] = max(peaks['loop_lag_ms'], health.get('loop_lag_ms', 0))
+            peaks['connections'] = max(peaks['connections'], health.get('connections', 0))
+            peaks['samples'] += 1
+        except (OSError, ValueError):
+            pass
+        stop.wait(0.5)
+
+def _catalog_lag(catalog_db, samples, timeout=30):
+    """Segundos entre el 226 y la fila en el catálogo (servidor en la misma máquina)"""
+    done = {s['name']: s['done_at'] for s in samples if s['ok']}
+    lags = {}
+    deadline = time.time() + timeout
+    conn = sqlite3.connect(f"file:{catalog_db}?mode=ro", uri=True, timeout=10)
+    try:
+        while len(lags) < len(done) and time.time() < deadline:
+            # path incluye el layout: las filas de la prueba se reconocen por la cámara
+            rows = conn.execute(
+                "SELECT path, received_at FROM videos WHERE camera LIKE 'Fleet%' AND received_at >= ?",
+                (min(done.values(), default=0) - 3600,)).fetchall()
+            for path, received_at in rows:
+                name = PurePosixPath(path).name
+                if name in done and name not in lags:
+                    lags[name] = max(0.0, received_at - done[name])
+            if len(lags) < len(done):
+                time.sleep(0.5)
+    finally:
+        conn.close()
+    return list(lags.values()), len(done) - len(lags)
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).resolve().parent,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def fleet_load_test(host, port, username, password, dvrs=8, channels=4, segments=4, segment_mb=8,
+                    rate_kbps=0, source_ips=True, health_url=None, catalog_db=None, output=None, label=None):
+    """Simula una flota de DVR subiendo segmentos con nombre Dahua y mide al servidor
+
+    Cada DVR es un proceso con una conexión por canal. Con el servidor en
+    loopback cada DVR sale de su propia IP 127.0.1.N, así max-cons-per-ip
+    y los límites por IP se comportan como con equipos reales.
+    """
+    print("=== FLOTA DE DVR SIMULADA ===")
+    print(f"DVRs: {dvrs}, canales: {channels}, segmentos por canal: {segments}, "
+          f"tamaño: {segment_mb} MB, ritmo: {f'{rate_kbps} KB/s' if rate_kbps else 'sin límite'}")
+    size = int(segment_mb * 1024 * 1024)
+    loopback = host in ('localhost', '127.0.0.1')
+    start = datetime.now().replace(microsecond=0) - timedelta(minutes=segments)
+    tasks = [(host, port, username, password, i, channels, segments, size, rate_kbps,
+              f"127.0.1.{i % 250 + 1}" if source_ips and loopback else None, start)
+             for i in range(dvrs)]
+    peaks = {'post_queue_depth': 0, 'loop_lag_ms': 0, 'connections': 0, 'samples': 0}
+    stop = threading.Event()
+    sampler = None
+    if health_url:
+        sampler = threading.Thread(target=_sample_health, args=(health_url, stop, peaks), daemon=True)
+        sampler.start()
+    started = time.perf_counter()
+    with Pool(dvrs) as pool:
+        samples = [s for result in pool.map(_fleet_dvr, tasks) for s in result]
+    elapsed = time.perf_counter() - started
+    stop.set()
+    if sampler is not None:
+        sampler.join()
+
+    ok = [s for s in samples if s['ok']]
+    failed = [s for s in samples if not s['ok']]
+    total_bytes = sum(s['bytes'] for s in ok)
+    results = {
+        'label': label,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': _git_revision(),
+        'config': {'host': host, 'port': port, 'dvrs': dvrs, 'channels': channels, 'segments': segments,
+                   'segment_mb': segment_mb, 'rate_kbps': rate_kbps},
+        'elapsed_s': round(elapsed, 3),
+        'files_ok': len(ok),
+        'files_failed': len(failed),
+        'errors': sorted({s['error'] for s in failed})[:10],
+        'throughput_mb_s': round(total_bytes / (1024 * 1024) / elapsed, 2) if elapsed else 0,
+        'files_per_s': round(len(ok) / elapsed, 2) if elapsed else 0,
+        'stor_latency_s': _latency_summary([s['latency'] for s in ok]),
+    }
+    if peaks['samples']:
+        results['server_peaks'] = {k: v for k, v in peaks.items() if k != 'samples'}
+    if catalog_db:
+        lags, missing = _catalog_lag(catalog_db, ok)
+        results['post_processing_lag_s'] = _latency_summary(lags)
+        results['post_processing_missing'] = missing
+
+    print(f"Transferido: {total_bytes / (1024 * 1024):.0f} MB en {elapsed:.2f} s "
+          f"({results['throughput_mb_s']} MB/s, {results['files_per_s']} archivos/s)")
+    lat = results['stor_latency_s']
+    print(f"Latencia STOR: p50 {lat['p50']:.3f} s, p95 {lat['p95']:.3f} s, p99 {lat['p99']:.3f} s, máx {lat['max']:.3f} s")
+    if 'post_processing_lag_s' in results:
+        lag = results['post_processing_lag_s']
+        print(f"Lag de post-procesamiento: p50 {lag['p50']:.3f} s, p95 {lag['p95']:.3f} s, máx {lag['max']:.3f} s"
+              f" ({results['post_processing_missing']} sin catalogar)")
+    if 'server_peaks' in results:
+        pk = results['server_peaks']
+        print(f"Picos del servidor: cola {pk['post_queue_depth']}, lag del loop {pk['loop_lag_ms']} ms, "
+              f"{pk['connections']} conexiones")
+    print(f"Transferencias fallidas: {len(failed)}")
+    for error in results['errors']:
+        print(f"  - {error}")
+    if output:
+        Path(output).write_text(json.dumps(results, indent=2), encoding='utf-8')
+        print(f"Resultados guardados en {output}")
+    return results
+
+def compare_results(baseline_file, results, tolerance=10):
+    """Compara con una corrida anterior y marca regresiones mayores a tolerance %"""
+    baseline = json.loads(Path(baseline_file).read_text(encoding='utf-8'))
+    print(f"=== COMPARACIÓN CON {baseline_file} ({baseline.get('git_revision') or 'sin revisión'}) ===")
+    checks = [
+        ('throughput_mb_s', baseline.get('throughput_mb_s'), results.get('throughput_mb_s'), True),
+        ('stor p95', baseline.get('stor_latency_s', {}).get('p95'), results.get('stor_latency_s', {}).get('p95'), False),
+        ('stor p99', baseline.get('stor_latency_s', {}).get('p99'), results.get('stor_latency_s', {}).get('p99'), False),
+        ('post p95', baseline.get('post_processing_lag_s', {}).get('p95'), results.get('post_processing_lag_s', {}).get('p95'), False),
+        ('files_failed', baseline.get('files_failed'), results.get('files_failed'), False),
+    ]
+    regressions = 0
+    for name, before, after, higher_is_better in checks:
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else (100.0 if after else 0.0)
+        worse = -change if higher_is_better else change
+        flag = "REGRESIÓN" if worse > tolerance else "ok"
+        regressions += flag != "ok"
+        print(f"{name:<16} {before:>10} -> {after:<10} ({change:+.1f}%) {flag}")
+    return regressions
+
+def _web_login(base_url, username, password):
+    """Inicia sesión en el panel y devuelve la cabecera Cookie de la sesión"""
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    data = urllib.parse.urlencode({'username': username, 'password': password}).encode()
+    opener.open(f"{base_url}/login", data, timeout=10).read()
+    cookie = '; '.join(f"{c.name}={c.value}" for c in jar)
+    if 'session=' not in cookie:
+        raise RuntimeError("Login rechazado por el panel web")
+    return cookie
+
+def _web_request(url, cookie):
+    """Un GET autenticado; devuelve (latencia, ok)"""
+    started = time.perf_counter()
+    try:
+        request = urllib.request.Request(url, headers={'Cookie': cookie})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+            ok = response.status == 200 and not response.url.endswith('/login')
+    except OSError:
+        ok = False
+    return time.perf_counter() - started, ok
+
+def web_benchmark(base_url, username, password, paths=('/api/stats', '/videos'), requests=500, concurrency=16):
+    """Mide requests/s y latencias del panel web (correr contra dev, waitress o gunicorn)"""
+    print("=== BENCHMARK PANEL WEB ===")
+    print(f"URL: {base_url}, requests por ruta: {requests}, concurrencia: {concurrency}")
+    base_url = base_url.rstrip('/')
+    cookie = _web_login(base_url, username, password)
+    results = {}
+    for path in paths:
+        url = base_url + path
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            samples = list(pool.map(lambda _: _web_request(url, cookie), range(requests)))
+        elapsed = time.perf_counter() - started
+        latencies = sorted(s[0] * 1000 for s in samples)
+        errors = sum(1 for s in samples if not s[1])
+        results[path] = {
+            'rps': requests / elapsed if elapsed else 0,
+            'p50_ms': latencies[len(latencies) // 2],
+            'p95_ms': latencies[int(len(latencies) * 0.95) - 1],
+            'errors': errors,
+        }
+        r = results[path]
+        print(f"{path}: {r['rps']:.0f} req/s, p50 {r['p50_ms']:.1f} ms, p95 {r['p95_ms']:.1f} ms, errores {errors}")
+    return results
+
 def main():
     parser = argparse.ArgumentParser(description='Diagnóstico FTP Dahua')
     parser.add_argument('host', nargs='?', default='localhost', help='IP del servidor FTP')
@@ -326,14 +762,65 @@ def main():
     parser.add_argument('-u', '--username', default='dahua', help='Usuario FTP')
     parser.add_argument('--password', default='dahua123', help='Contraseña FTP')
     parser.add_argument('--quick', action='store_true', help='Prueba rápida del servidor local')
+    parser.add_argument('--check-logging', action='store_true', help='Verificar que el log JSON del servidor separa los tracebacks')
+    parser.add_argument('--probe', action='store_true', help='Solo el sondeo concurrente: control, login, PASV y rango pasivo')
+    parser.add_argument('--passive-range', default='60000-65534', help='Puertos pasivos a sondear, ej. 60000-65534 o 60000-60100,2121 (default: 60000-65534)')
+    parser.add_argument('--probe-concurrency', type=int, default=500, help='Conexiones de sondeo en vuelo a la vez (default: 500)')
+    parser.add_argument('--probe-timeout', type=float, default=1.0, help='Segundos antes de dar un puerto por filtrado (default: 1.0)')
+    parser.add_argument('--load', action='store_true', help='Prueba de carga STOR (throughput agregado)')
+    parser.add_argument('--clients', type=int, default=8, help='Clientes concurrentes en la prueba de carga')
+    parser.add_argument('--files', type=int, default=4, help='Archivos por cliente en la prueba de carga')
+    parser.add_argument('--size-mb', type=int, default=16, help='Tamaño de cada archivo en MB')
+    parser.add_argument('--web-bench', metavar='URL', help='Benchmark del panel web (ej: http://localhost:5000)')
+    parser.add_argument('--requests', type=int, default=500, help='Requests por ruta en el benchmark web')
+    parser.add_argument('--concurrency', type=int, default=16, help='Requests concurrentes en el benchmark web')
+    parser.add_argument('--fleet', action='store_true', help='Simular una flota de DVR subiendo segmentos (benchmark)')
+    parser.add_argument('--dvrs', type=int, default=8, help='DVRs simulados en --fleet (default: 8)')
+    parser.add_argument('--channels', type=int, default=4, help='Canales por DVR, una conexión cada uno (default: 4)')
+    parser.add_argument('--segments', type=int, default=4, help='Segmentos por canal (default: 4)')
+    parser.add_argument('--segment-mb', type=float, default=8, help='Tamaño de cada segmento en MB (default: 8)')
+    parser.add_argument('--rate-kbps', type=float, default=0, help='Ritmo de subida de cada canal en KB/s; 0 a máxima velocidad (default: 0)')
+    parser.add_argument('--no-source-ips', action='store_true', help='En loopback, no repartir los DVR en IPs 127.0.1.N')
+    parser.add_argument('--health-url', help='Endpoint /health del servidor para registrar picos de cola y lag (ej: http://127.0.0.1:8021/health)')
+    parser.add_argument('--catalog-db', help='Catálogo del servidor local, para medir el lag de post-procesamiento')
+    parser.add_argument('--output', help='Guardar los resultados de --fleet o el reporte por puerto del diagnóstico en este JSON')
+    parser.add_argument('--label', help='Etiqueta de la corrida en el JSON (ej: versión probada)')
+    parser.add_argument('--compare', metavar='JSON', help='Resultados anteriores: marcar regresiones de --fleet')
+    parser.add_argument('--tolerance', type=float, default=10, help='Porcentaje de empeoramiento que cuenta como regresión (default: 10)')
     
     args = parser.parse_args()
     
     if args.quick:
         quick_server_test()
+    elif args.check_logging:
+        if not json_logging_test():
+            sys.exit(1)
+    elif args.web_bench:
+        web_benchmark(args.web_bench, args.username, args.password,
+                      requests=args.requests, concurrency=args.concurrency)
+    elif args.fleet:
+        results = fleet_load_test(args.host, args.port, args.username, args.password,
+                                  dvrs=args.dvrs, channels=args.channels, segments=args.segments,
+                                  segment_mb=args.segment_mb, rate_kbps=args.rate_kbps,
+                                  source_ips=not args.no_source_ips, health_url=args.health_url,
+                                  catalog_db=args.catalog_db, output=args.output, label=args.label)
+        if args.compare and compare_results(args.compare, results, args.tolerance):
+            sys.exit(1)
+    elif args.load:
+        stor_load_test(args.host, args.port, args.username, args.password,
+                       args.clients, args.files, args.size_mb)
     else:
-        diagnostic = FTPDiagnostic(args.host, args.port, args.username, args.password)
-        diagnostic.run_all_tests()
+        diagnostic = FTPDiagnostic(args.host, args.port, args.username, args.password,
+                                   passive_ports=parse_port_range(args.passive_range),
+                                   probe_concurrency=args.probe_concurrency,
+                                   probe_timeout=args.probe_timeout)
+        if args.probe:
+            diagnostic.run_probe()
+        else:
+            diagnostic.run_all_tests()
+        if args.output and diagnostic.probe_report:
+            Path(args.output).write_text(json.dumps(diagnostic.probe_report, indent=2), encoding='utf-8')
+            print(f"Reporte por puerto guardado en {args.output}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Tiers de almacenamiento de los videos organizados
+Mueve los días más viejos que hot_days del directorio de videos (disco
+rápido) a un directorio frío más grande, sin competir con la ingesta
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+from layout import DEFAULT_LAYOUT, resolve_layout, iter_day_dirs
+from catalog import VideoCatalog, DEFAULT_DB, COLD_TIER
+from filenames import PART_SUFFIX
+from shaping import TokenBucket
+
+COPY_CHUNK = 1024 * 1024
+TMP_SUFFIX = ".tiering"
+SETTLE_SECONDS = 600  # archivos modificados hace menos quedan para la próxima pasada
+BUSY_WAIT = 1.0  # segundos de pausa mientras la ingesta está ocupada
+
+
+class TieringEngine:
+    """Mueve días completos al tier frío, archivo por archivo y con tasa limitada
+
+    Con ambos directorios en el mismo disco cada archivo solo se renombra.
+    Si no, se copia a un temporal con tasa máxima mbps, se hace fsync y
+    recién entonces se renombra en destino, se marca en el catálogo y se
+    borra el original: en todo momento el archivo existe en algún tier.
+    busy es una función que devuelve True mientras conviene no leer del
+    disco caliente (por ejemplo, cola de post-procesamiento con trabajo).
+    """
+
+    def __init__(self, video_dir, cold_dir, catalog=None, layout=DEFAULT_LAYOUT, hot_days=7, mbps=20, busy=None, batch_size=200):
+        self.video_dir = Path(video_dir)
+        self.cold_dir = Path(cold_dir)
+        self.catalog = catalog
+        self.layout = layout
+        self.hot_days = hot_days
+        self.bucket = TokenBucket(int(mbps * 1024 * 1024)) if mbps else None
+        self.busy = busy
+        self.batch_size = batch_size
+        self.logger = logging.getLogger("DahuaFTPServer")
+
+    def run(self, now=None, dry_run=False):
+        """Mueve los días anteriores al corte y devuelve lo movido"""
+        now = now or datetime.now()
+        cutoff = (now - timedelta(days=self.hot_days)).date()
+        result = {'days': 0, 'files': 0, 'bytes': 0}
+        self.cold_dir.mkdir(parents=True, exist_ok=True)
+        same_device = os.stat(self.video_dir).st_dev == os.stat(self.cold_dir).st_dev
+        for day_dir, day, _values in iter_day_dirs(self.video_dir, self.layout):
+            if day >= cutoff:
+                continue
+            files, size = self.move_day(day_dir, same_device, now.timestamp(), dry_run)
+            result['days'] += 1 if files else 0
+            result['files'] += files
+            result['bytes'] += size
+        return result
+
+    def move_day(self, day_dir, same_device, now_ts, dry_run=False):
+        pending = []
+        files = size = 0
+        for source in sorted(day_dir.rglob("*")):
+            if source.suffix in (PART_SUFFIX, TMP_SUFFIX) or not source.is_file():
+                continue
+            st = source.stat()
+            if now_ts - st.st_mtime < SETTLE_SECONDS:
+                # Un backfill recién terminado: todavía puede estar en post-procesamiento
+                continue
+            rel_path = source.relative_to(self.video_dir).as_posix()
+            if not dry_run:
+                self.move_file(source, self.cold_dir / rel_path, st, same_device)
+                pending.append(rel_path)
+            files += 1
+            size += st.st_size
+            if len(pending) >= self.batch_size:
+                self.commit(pending)
+                pending = []
+        self.commit(pending)
+        if not dry_run:
+            self.remove_empty_parents(day_dir)
+        if files:
+            self.logger.info(f"Tier frío: {day_dir.relative_to(self.video_dir)} ({files} archivos, "
+                             f"{size / (1024**2):.2f} MB)", extra={'event': 'tiering'})
+        return files, size
+
+    def move_file(self, source, target, st, same_device):
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if same_device:
+            os.replace(source, target)
+            return
+        if not (target.exists() and target.stat().st_size == st.st_size):
+            tmp = target.with_name(target.name + TMP_SUFFIX)
+            self.copy_throttled(source, tmp)
+            shutil.copystat(source, tmp)
+            os.replace(tmp, target)
+
+    def commit(self, rel_paths):
+        """Marca el lote como frío y recién después borra los originales"""
+        if not rel_paths:
+            return
+        if self.catalog is not None:
+            self.catalog.set_tier(rel_paths, COLD_TIER)
+        for rel_path in rel_paths:
+            try:
+                (self.video_dir / rel_path).unlink()
+            except FileNotFoundError:
+                pass  # mismo disco: ya se renombró
+
+    def copy_throttled(self, source, target):
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            while True:
+                self.wait_idle()
+                chunk = src.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                if self.bucket is not None:
+                    delay = self.bucket.consume(len(chunk), time.monotonic())
+                    if delay:
+                        time.sleep(delay)
+            dst.flush()
+            os.fsync(dst.fileno())
+            if hasattr(os, 'posix_fadvise'):
+                # Lo copiado no se vuelve a leer: que no desplace del cache a la ingesta
+                os.posix_fadvise(src.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                os.posix_fadvise(dst.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def wait_idle(self):
+        while self.busy is not None and self.busy():
+            time.sleep(BUSY_WAIT)
+
+    def remove_empty_parents(self, directory):
+        directory = Path(directory)
+        while directory != self.video_dir and self.video_dir in directory.parents:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                return
+            directory = directory.parent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mueve los días viejos de videos al directorio del tier frío")
+    parser.add_argument('--video-dir', default="dahua_videos", help="Directorio de videos (default: dahua_videos)")
+    parser.add_argument('--cold-dir', required=True, help="Directorio del tier frío")
+    parser.add_argument('--db', default=DEFAULT_DB, help=f"Catálogo a actualizar (default: {DEFAULT_DB})")
+    parser.add_argument('--layout', default='date', help="Layout de organized/, el mismo del servidor (default: date)")
+    parser.add_argument('--hot-days', type=int, default=7, help="Días que se quedan en el directorio de videos (default: 7)")
+    parser.add_argument('--mbps', type=float, default=20, help="Tasa máxima de copia entre discos en MB/s; 0 sin límite (default: 20)")
+    parser.add_argument('--dry-run', action='store_true', help="Solo contar lo que se movería")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    catalog = VideoCatalog(args.db) if not args.dry_run else None
+    engine = TieringEngine(args.video_dir, args.cold_dir, catalog, resolve_layout(args.layout),
+                           hot_days=args.hot_days, mbps=args.mbps)
+    print(f"Moviendo a {args.cold_dir} los días de {args.video_dir} con más de {args.hot_days} días...")
+    result = engine.run(dry_run=args.dry_run)
+    print(f"- {result['days']} días, {result['files']} archivos, {result['bytes'] / (1024**3):.2f} GB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())